@@ -3,12 +3,15 @@
 
 from __future__ import absolute_import
 
-from .client import KafkaClient
+from .client import (
+    KafkaClient, TRAFFIC_CONTROL, TRAFFIC_PRODUCE, TRAFFIC_FETCH,
+)
 from .kafkacodec import (
     create_message, create_message_set,
-    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY,
+    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4,
 )
 from .producer import Producer
+from .timingwheel import TimingWheel
 from .partitioner import RoundRobinPartitioner, HashedPartitioner
 from .consumer import Consumer
 from .common import (OFFSET_EARLIEST, OFFSET_LATEST, OFFSET_COMMITTED,)
@@ -21,9 +24,10 @@ __license__ = 'Apache License 2.0'
 __copyright__ = 'Copyright 2015, Cyan Inc. under Apache License, v2.0'
 
 __all__ = [
-    'KafkaClient', 'Producer', 'Consumer',
+    'KafkaClient', 'Producer', 'Consumer', 'TimingWheel',
+    'TRAFFIC_CONTROL', 'TRAFFIC_PRODUCE', 'TRAFFIC_FETCH',
     'RoundRobinPartitioner', 'HashedPartitioner',
     'create_message', 'create_message_set',
-    'CODEC_NONE', 'CODEC_GZIP', 'CODEC_SNAPPY',
+    'CODEC_NONE', 'CODEC_GZIP', 'CODEC_SNAPPY', 'CODEC_LZ4',
     'OFFSET_EARLIEST', 'OFFSET_LATEST', 'OFFSET_COMMITTED',
 ]
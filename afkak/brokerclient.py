@@ -9,8 +9,7 @@ Low level network client for the Apache Kafka Message Broker.
 from __future__ import absolute_import
 
 import logging
-from collections import OrderedDict
-from functools import partial
+from collections import OrderedDict, deque
 
 from twisted.internet.error import (ConnectionDone, UserError)
 from twisted.internet.protocol import ReconnectingClientFactory
@@ -18,11 +17,11 @@ from twisted.internet.defer import (
     Deferred, DeferredList, maybeDeferred, fail, succeed,
 )
 
-from .protocol import KafkaProtocol
+from .protocol import KafkaProtocol, check_socket_options
 from .kafkacodec import KafkaCodec
 from .common import (
     ClientError, DuplicateRequestError, DefaultKafkaPort,
-    CancelledError,
+    CancelledError, RequestQueueFullError, ConnectionError,
 )
 
 log = logging.getLogger(__name__)
@@ -36,18 +35,29 @@ class _Request(object):
 
     """Private class to encapsulate requests we are processing."""
 
-    sent = False  # Have we written this request to our protocol?
+    __slots__ = ('id', 'data', 'expect', 'canceller', 'd', 'size', 'sent')
 
     def __init__(self, requestId, data, expectResponse, canceller=None):
         self.id = requestId
         self.data = data
         self.expect = expectResponse
         self.canceller = canceller
-        self.d = Deferred(canceller=canceller)
-        self._repr = '_Request:{}:{}'.format(self.id, self.expect)
+        self.d = Deferred(
+            canceller=None if canceller is None else self._cancel)
+        # Bytes the request occupies while queued
+        if isinstance(data, list):
+            self.size = sum(len(s) for s in data)
+        else:
+            self.size = len(data)
+        self.sent = False  # Have we written this request to our protocol?
+
+    def _cancel(self, d):
+        # The error is only built for the few requests actually cancelled
+        self.canceller(self.id, CancelledError(
+            "Request:{} was cancelled".format(self.id)))
 
     def __repr__(self):
-        return self._repr
+        return '_Request:{}:{}'.format(self.id, self.expect)
 
 
 class KafkaBrokerClient(ReconnectingClientFactory):
@@ -71,7 +81,8 @@ class KafkaBrokerClient(ReconnectingClientFactory):
     def __init__(self, host, port=DefaultKafkaPort,
                  clientId=CLIENT_ID, subscribers=None,
                  maxDelay=MAX_RECONNECT_DELAY_SECONDS, maxRetries=None,
-                 reactor=None):
+                 reactor=None, maxInFlight=None, maxQueuedBytes=None,
+                 socketOptions=None, failOnDisconnect=False):
         """Create a KafkaBrokerClient for a given host/port.
 
         Create a new object to manage the connection to a single Kafka broker.
@@ -93,6 +104,21 @@ class KafkaBrokerClient(ReconnectingClientFactory):
                 made.
             reactor: the twisted reactor to use when making connections or
                 scheduling iDelayedCall calls. Used primarily for testing.
+            maxInFlight (int): The maximum number of requests sent to the
+                broker and awaiting responses. Further requests are queued
+                until responses arrive. Unlimited if None.
+            maxQueuedBytes (int): The maximum size of the requests queued
+                unsent, while disconnected or at maxInFlight. Requests which
+                would exceed it fail with RequestQueueFullError. Unlimited
+                if None.
+            socketOptions (dict): Socket options to set on each connection
+                to the broker, from: 'nodelay' and 'keepalive' (bool), and
+                'sndbuf' and 'rcvbuf' (int, bytes). Those not given are left
+                at the system defaults.
+            failOnDisconnect (bool): When the connection is lost, fail the
+                requests in flight with ConnectionError, rather than send
+                them again once reconnected. Requests not yet sent are held
+                to send once connected either way.
         """
         # Set the broker host & port
         self.host = host
@@ -108,11 +134,25 @@ class KafkaBrokerClient(ReconnectingClientFactory):
         self.maxDelay = maxDelay
         # clock/reactor for testing...
         self.clock = reactor
+        check_socket_options(socketOptions)
+        self.socketOptions = socketOptions
 
         # The protocol object for the current connection
         self.proto = None
         # ordered dict of _Requests, keyed by requestId
         self.requests = OrderedDict()
+        # FIFO of the _Requests not yet sent. Requests cancelled while
+        # queued are left in it, and skipped when reached
+        self._unsent = deque()
+        # Limits on, and the current number of, requests sent and awaiting
+        # responses and bytes of requests queued unsent
+        self.maxInFlight = maxInFlight
+        self.maxQueuedBytes = maxQueuedBytes
+        self.failOnDisconnect = failOnDisconnect
+        self._inFlight = 0
+        self._queuedBytes = 0
+        # Deferreds to fire when the queue next has room
+        self._roomWaiters = []
         # deferred which fires when the close() completes
         self.dDown = None
         # Deferred list for any on-going notification
@@ -133,12 +173,17 @@ class KafkaBrokerClient(ReconnectingClientFactory):
     def makeRequest(self, requestId, request, expectResponse=True):
         """
         Send a request to our broker via our self.proto KafkaProtocol object.
+        The request is either a string, or a list of strings which are sent
+        as one request, without being joined first.
 
         Return a deferred which will fire when the reply matching the requestId
         comes back from the server, or, if expectResponse is False, then
         return None instead.
-        If we are not currently connected, then we buffer the request to send
-        when the connection comes back up.
+        If we are not currently connected, or maxInFlight requests are
+        awaiting responses, then we buffer the request to send when we can.
+        If buffering it would exceed maxQueuedBytes, the returned deferred
+        fails with a RequestQueueFullError, whose deferred fires when there
+        is room.
         """
         if requestId in self.requests:
             # Id is duplicate to 'in-flight' request. Reject it, as we
@@ -156,27 +201,46 @@ class KafkaBrokerClient(ReconnectingClientFactory):
             return fail(ClientError('makeRequest() called after close()'))
 
         # Ok, we are going to save/send it, create a _Request object to track
-        canceller = partial(
-            self.cancelRequest, requestId,
-            CancelledError("Request:{} was cancelled".format(requestId)))
-        tReq = _Request(requestId, request, expectResponse, canceller)
+        tReq = _Request(requestId, request, expectResponse, self.cancelRequest)
+
+        # Refuse it if it must be queued, but the queue is full. A request
+        # bigger than the whole limit is still queued alone.
+        if (not self._canSend() and self.maxQueuedBytes is not None and
+                self._queuedBytes and
+                self._queuedBytes + tReq.size > self.maxQueuedBytes):
+            waiter = Deferred()
+            self._roomWaiters.append(waiter)
+            return fail(RequestQueueFullError(
+                '{!r}: queue full, request:{} refused'.format(
+                    self, requestId), waiter))
 
         # add it to our requests dict
         self.requests[requestId] = tReq
+        self._queuedBytes += tReq.size
 
         # Add an errback to the tReq.d to remove it from our requests dict
         # if something goes wrong...
         tReq.d.addErrback(self._handleRequestFailure, requestId)
 
-        # Do we have a connection over which to send the request?
-        if self.proto:
+        # Can we send the request now?
+        if self._canSend():
             # Send the request
             self._sendRequest(tReq)
-        # Have we not even started trying to connect yet? Do so now
-        elif not self.connector:
-            self._connect()
+        else:
+            self._unsent.append(tReq)
+            # Have we not even started trying to connect yet? Do so now
+            if not self.connector:
+                self._connect()
         return tReq.d
 
+    def connect(self):
+        """Start connecting to the broker now, rather than on first request.
+
+        Does nothing if already connecting or connected, or if closed.
+        """
+        if not self.connector and not self.dDown:
+            self._connect()
+
     def addSubscriber(self, cb):
         """Add a callback to be called when the connection changes state."""
         self.connSubscribers.append(cb)
@@ -210,18 +274,36 @@ class KafkaBrokerClient(ReconnectingClientFactory):
         # Cancel any requests
         for tReq in self.requests.values():  # can't use itervalues() may del()
             tReq.d.cancel()
+        self._unsent.clear()
+        # Release anyone waiting for room: their requests will now fail
+        self._notifyRoom()
         return self.dDown
 
     def buildProtocol(self, addr):
         """Create a KafkaProtocol object, store it in self.proto, return it."""
+        # Connected, so should it be lost, reconnect after the initial delay
+        # rather than one grown by earlier failures
+        self.resetDelay()
         # Schedule notification of subscribers
         self._get_clock().callLater(0, self._notify, True)
         # Build the protocol
         self.proto = ReconnectingClientFactory.buildProtocol(self, addr)
         # point it at us for notifications of arrival of messages
         self.proto.factory = self
+        # and give it the options to set on its socket once connected
+        self.proto.socketOptions = self.socketOptions
         return self.proto
 
+    def getSocketOptions(self):
+        """Return the socket options in effect on our current connection.
+
+        A dict of those of our `socketOptions` which were applied, as read
+        back from the socket, or None if not connected.
+        """
+        if self.proto is None:
+            return None
+        return self.proto.appliedSocketOptions
+
     def clientConnectionLost(self, connector, reason):
         """Handle notification from the lower layers of connection loss.
 
@@ -284,21 +366,29 @@ class KafkaBrokerClient(ReconnectingClientFactory):
         """
         requestId = KafkaCodec.get_response_correlation_id(response)
         # Protect against responses coming back we didn't expect
-        tReq = self.requests.pop(requestId, None)
+        tReq = self._popRequest(requestId)
         if tReq is None:
             # This could happen if we've sent it, are waiting on the response
             # when it's cancelled, causing us to remove it from self.requests
             log.warning('Unexpected response:%r, %r', requestId, response)
         else:
+            # Keep the pipeline full before handing on the response
+            self._sendQueued()
             tReq.d.callback(response)
 
     # # Private Methods # #
 
     def _sendRequest(self, tReq):
         """Send a single request over our protocol to the Kafka broker."""
+        self._queuedBytes -= tReq.size
+        self._notifyRoom()
         try:
             tReq.sent = True
-            self.proto.sendString(tReq.data)
+            if isinstance(tReq.data, list):
+                # A request encoded as a sequence of strings
+                self.proto.sendSequence(tReq.data)
+            else:
+                self.proto.sendString(tReq.data)
         except Exception as e:
             log.exception(
                 '%r: request id: %d send failed:', self, tReq.id)
@@ -311,13 +401,46 @@ class KafkaBrokerClient(ReconnectingClientFactory):
                 # with 'None', since there is no reply to be expected
                 del self.requests[tReq.id]
                 tReq.d.callback(None)
+            else:
+                self._inFlight += 1
 
     def _sendQueued(self):
-        """Connection just came up, send the unsent requests."""
-        for tReq in self.requests.values():  # can't use itervalues() may del()
-            if not tReq.sent:
+        """Send the unsent requests, as far as maxInFlight allows.
+
+        Called when the connection comes up, and when responses arrive.
+        """
+        unsent = self._unsent
+        while unsent and self._canSend():
+            tReq = unsent.popleft()
+            # Skip those cancelled, or failed, while queued
+            if not tReq.sent and self.requests.get(tReq.id) is tReq:
                 self._sendRequest(tReq)
 
+    def _canSend(self):
+        """Can a request be sent now, rather than queued?"""
+        return self.proto is not None and self.dDown is None and (
+            self.maxInFlight is None or self._inFlight < self.maxInFlight)
+
+    def _popRequest(self, requestId):
+        """Remove a request from our bookkeeping, returning it, or None"""
+        tReq = self.requests.pop(requestId, None)
+        if tReq is not None:
+            if tReq.sent:
+                self._inFlight -= 1
+            else:
+                self._queuedBytes -= tReq.size
+                self._notifyRoom()
+        return tReq
+
+    def _notifyRoom(self):
+        """Fire the deferreds waiting for room in the queue, if there is"""
+        if self._roomWaiters and (self.maxQueuedBytes is None or
+                                  self._queuedBytes < self.maxQueuedBytes or
+                                  self.dDown):
+            waiters, self._roomWaiters = self._roomWaiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+
     def cancelRequest(self, requestId, reason=CancelledError(), _=None):
         """Cancel a request: remove it from requests, & errback the deferred.
 
@@ -325,21 +448,42 @@ class KafkaBrokerClient(ReconnectingClientFactory):
           (expectResponse == False and already sent, or response already
           received) will raise KeyError
         """
-        tReq = self.requests.pop(requestId)
+        if requestId not in self.requests:
+            raise KeyError(requestId)
+        tReq = self._popRequest(requestId)
         tReq.d.errback(reason)
+        self._sendQueued()
 
     def _handlePending(self, reason):
         """Connection went down: handle in-flight & unsent as configured.
 
-        Note: for now, we just 'requeue' all the in-flight by setting their
-          'sent' variable to False and let '_sendQueued()' handle resending
-          when the connection comes back.
-          In the future, we may want to extend this so we can errback()
-          to our client's any in-flight (and possibly queued) so they can deal
-          with it at the application level.
+        If failOnDisconnect is set, errback() the in-flight requests with
+        ConnectionError, so our client can send them elsewhere (a new
+        leader, say) rather than wait on this broker to come back. Those
+        never sent are held, as when it isn't set, so a failed connection
+        attempt fails nothing.
+        Otherwise 'requeue' all the in-flight by setting their 'sent'
+        variable to False and let '_sendQueued()' handle resending when the
+        connection comes back.
         """
+        if not self._inFlight:
+            return reason
+        if self.failOnDisconnect:
+            sent = [tReq for tReq in self.requests.itervalues() if tReq.sent]
+            for tReq in sent:
+                self._popRequest(tReq.id)
+                tReq.d.errback(ConnectionError(
+                    '{!r}: connection lost with request:{} sent: {}'.format(
+                        self, tReq.id, reason)))
+            return reason
         for tReq in self.requests.itervalues():
-            tReq.sent = False
+            if tReq.sent:
+                tReq.sent = False
+                self._queuedBytes += tReq.size
+        # The in-flight requests go back ahead of those never sent, all
+        # in the order they were made
+        self._unsent = deque(self.requests.itervalues())
+        self._inFlight = 0
         return reason
 
     def _handleRequestFailure(self, failure, requestId):
@@ -347,7 +491,7 @@ class KafkaBrokerClient(ReconnectingClientFactory):
 
         Not an error if already removed (canceller removes).
         """
-        self.requests.pop(requestId, None)
+        self._popRequest(requestId)
         return failure
 
     def _get_clock(self):
@@ -9,14 +9,18 @@ from __future__ import absolute_import
 
 import logging
 import random
+import socket
 import collections
 from functools import partial
 from twisted.names import client as DNSclient
 from twisted.names import dns
-from twisted.internet.abstract import isIPAddress
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, DeferredList, succeed,
+    inlineCallbacks, returnValue, Deferred, DeferredList, succeed,
+    maybeDeferred,
     CancelledError as t_CancelledError,
 )
 
@@ -26,14 +30,32 @@ from .common import (
     UnknownTopicOrPartitionError, NotLeaderForPartitionError, check_error,
     DefaultKafkaPort, RequestTimedOutError, KafkaError, kafka_errors,
     NotCoordinatorForConsumerError, OffsetsLoadInProgressError, UnknownError,
-    ConsumerCoordinatorNotAvailableError, CancelledError,
+    ConsumerCoordinatorNotAvailableError, CancelledError, ConnectionError,
+    ProduceRequest, OffsetAndMessage,
+)
+from .kafkacodec import (
+    KafkaCodec, CRC_CHECK_ALL, validate_check_crcs,
+    _decode_message_set_batch_task,
 )
-from .kafkacodec import KafkaCodec
 from .brokerclient import KafkaBrokerClient
+from .protocol import check_socket_options
+from .timingwheel import TimingWheel
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Classes of request traffic. Each class named in a KafkaClient's
+# dedicated_connections gets its own connection to each broker. All other
+# requests share the broker's control connection.
+TRAFFIC_CONTROL = 'control'  # Metadata, offsets, and other short requests
+TRAFFIC_PRODUCE = 'produce'
+TRAFFIC_FETCH = 'fetch'
+
+# Fraction of metadata_max_age_ms after which a topic's metadata is
+# refreshed in the background, and how often, as a fraction of it, to check
+METADATA_REFRESH_FRACTION = 0.75
+METADATA_CHECK_FRACTION = 0.125
+
 
 class KafkaClient(object):
     """Cluster-aware Kafka client.
@@ -44,6 +66,59 @@ class KafkaClient(object):
     the topic and partition of the request. It maintains a map of
     topics/partitions to brokers.
 
+    A broker handles the requests on a connection strictly in order, so a
+    long-polling fetch request delays every request queued behind it. To
+    avoid that, pass ``dedicated_connections=(TRAFFIC_FETCH,)`` (and/or
+    :data:`TRAFFIC_PRODUCE`), to give that class of request its own
+    connection, and request queue, to each broker.
+
+    Each connection sends at most ``max_in_flight`` requests before waiting
+    for responses, and queues at most ``max_queued_bytes`` of unsent
+    requests, beyond which requests fail with
+    :exc:`~afkak.common.RequestQueueFullError`. Both are unlimited by
+    default.
+
+    ``socket_options`` sets options on the socket of every broker
+    connection: a dict of ``nodelay`` and ``keepalive`` (bool) and
+    ``sndbuf`` and ``rcvbuf`` (bytes). A larger ``rcvbuf`` speeds big
+    fetches over high-bandwidth, high-latency links, and ``nodelay`` cuts
+    the latency of produce requests awaiting acks. The values in effect on
+    a connection are returned by
+    :meth:`~afkak.brokerclient.KafkaBrokerClient.getSocketOptions`.
+
+    Brokers are connected to when first sent a request, unless
+    ``connect_eagerly`` is set, when every broker is connected to as it
+    appears in the cluster metadata. Brokers close connections left idle
+    for 10 minutes, so the next request waits to reconnect. With
+    ``keepalive_every_ms`` set, a trivial request is sent that often over
+    each connection with no requests outstanding, to keep it open.
+
+    When a connection to a broker is lost, the requests sent on it and
+    awaiting responses are sent again once it reconnects. Set
+    ``fail_on_disconnect`` to instead have them fail at once, rather than
+    wait for it to reconnect, or to time out. Those sent to a partition's
+    leader, or a group's coordinator, are then sent again, once, after
+    reloading the metadata of just the topics (or group) affected, so they
+    reach the new leader when the old one has failed. Produce requests are
+    not sent again unless ``resend_produce_on_disconnect`` is also set, as
+    the old leader may have written their messages before the connection
+    was lost: set it only if duplicated messages are acceptable (that is,
+    for at-least-once delivery). Otherwise they fail with
+    :class:`~afkak.common.FailedPayloadsError`, for the caller to decide.
+    Either way, requests not yet sent, such as those made while a broker is
+    being connected to, or between attempts to reconnect, wait for the
+    connection, until they time out.
+
+    The metadata of topics is loaded when first needed, and reloaded when
+    a request hits an error which shows it to be out of date. Set
+    ``metadata_max_age_ms`` to also refresh the metadata of each topic in
+    the background as it nears that age. The old metadata is used until the
+    new arrives, so requests don't wait on it. Metadata older than that is
+    reloaded before it is used, should the refresh have failed.
+
+    Pass a :class:`~afkak.timingwheel.TimingWheel` as ``timing_wheel`` to
+    schedule request timeouts on it, rather than directly on the reactor.
+
     A KafkaBrokerClient object maintains connections (reconnected as needed) to
     the various brokers.  It must be bootstrapped with at least one host to
     retrieve the cluster metadata.
@@ -66,13 +141,27 @@ class KafkaClient(object):
     # Default number of msecs the lead-broker will wait for replics to
     # ack Produce requests before failing the request
     DEFAULT_REPLICAS_ACK_MSECS = 1000
+    # Message sets smaller than this are decoded in-process, even when a
+    # decode_pool is passed to send_fetch_request(), as shipping them to a
+    # worker would cost more than decoding them.
+    DECODE_POOL_MIN_BYTES = 1024 * 1024
 
     clientId = "afkak-client"
 
     def __init__(self, hosts, clientId=None,
                  timeout=DEFAULT_REQUEST_TIMEOUT_MSECS,
                  correlation_id=0,
-                 reactor=None):
+                 reactor=None,
+                 dedicated_connections=(),
+                 max_in_flight=None,
+                 max_queued_bytes=None,
+                 timing_wheel=None,
+                 socket_options=None,
+                 connect_eagerly=False,
+                 keepalive_every_ms=None,
+                 fail_on_disconnect=False,
+                 resend_produce_on_disconnect=False,
+                 metadata_max_age_ms=None):
 
         if timeout is not None:
             timeout /= 1000.0  # msecs to secs
@@ -80,16 +169,60 @@ class KafkaClient(object):
         if clientId is not None:
             self.clientId = clientId
 
+        dedicated_connections = frozenset(dedicated_connections)
+        for traffic in dedicated_connections:
+            if traffic not in (TRAFFIC_PRODUCE, TRAFFIC_FETCH):
+                raise ValueError(
+                    "dedicated_connections: %r unsupported" % (traffic,))
+        self.dedicated_connections = dedicated_connections
+        self.max_in_flight = max_in_flight
+        self.max_queued_bytes = max_queued_bytes
+        if timing_wheel is not None and \
+                not isinstance(timing_wheel, TimingWheel):
+            raise TypeError("timing_wheel: %r unsupported" % (timing_wheel,))
+        self.timing_wheel = timing_wheel
+        check_socket_options(socket_options)
+        self.socket_options = socket_options
+        self.connect_eagerly = connect_eagerly
+        self.fail_on_disconnect = fail_on_disconnect
+        self.resend_produce_on_disconnect = resend_produce_on_disconnect
+        if keepalive_every_ms is not None and keepalive_every_ms <= 0:
+            raise ValueError(
+                "keepalive_every_ms: %r unsupported" % (keepalive_every_ms,))
+        self._keepalive_looper = None
+        if metadata_max_age_ms is not None and metadata_max_age_ms <= 0:
+            raise ValueError("metadata_max_age_ms: %r unsupported" % (
+                metadata_max_age_ms,))
+        self.metadata_max_age = None
+        if metadata_max_age_ms is not None:
+            self.metadata_max_age = metadata_max_age_ms / 1000.0
+        self._metadata_looper = None
+        self._metadata_refresh_d = None  # Background refresh in progress
+
         # Setup all our initial attributes
-        self.clients = {}  # (host,port) -> KafkaBrokerClient instance
+        # (host,port) -> KafkaBrokerClient for control traffic, and
+        # (host,port,traffic class) -> KafkaBrokerClient for the traffic
+        # classes in dedicated_connections
+        self.clients = {}
         self.topics_to_brokers = {}  # TopicAndPartition -> BrokerMetadata
         self.partition_meta = {}  # TopicAndPartition -> PartitionMetadata
         self.consumer_group_to_brokers = {}  # consumer_group -> BrokerMetadata
         self.coordinator_fetches = {}  # consumer_group -> deferred
         self.topic_partitions = {}  # topic_id -> [0, 1, 2, ...]
         self.topic_errors = {}  # topic_id -> topic_error_code
+        self.topic_loaded_at = {}  # topic_id -> time its metadata arrived
+        # Topics requests were routed for since their metadata was loaded
+        self._topics_used = set()
+        # hostname -> (expiry time, [IP-addr]) of the bootstrap hosts' DNS
+        # answers, so re-resolving them isn't gated on DNS round-trips
+        self._dns_cache = {}
         self.correlation_id = correlation_id
         self.load_metadata = None  # Deferred waiting on loading of metadata
+        # Single-flight loading of the metadata of particular topics:
+        # topic -> [deferreds waiting on its load, queued or in progress]
+        self._topic_waiters = {}
+        self._topics_to_load = []  # Topics queued to be loaded
+        self._load_topics_dc = None  # Delayed call to load them
         self.close_dlist = None  # Deferred wait on broker client disconnects
         self._brokers = {}  # Broker-NodeID -> BrokerMetadata
         self._topics = {}  # Topic-Name -> TopicMetadata
@@ -98,6 +231,25 @@ class KafkaClient(object):
         # clock/reactor for testing...
         self.clock = reactor
 
+        # Set up the keepalive timer, if needed
+        if keepalive_every_ms:
+            self._keepalive_looper = LoopingCall(self._send_keepalives)
+            self._keepalive_looper.clock = self._get_timer()
+            self._keepalive_looper.start(
+                keepalive_every_ms / 1000.0, now=False).addErrback(
+                    lambda f: log.error(
+                        '%r: keepalive timer failed: %r', self, f))
+
+        # Set up the metadata refresh timer, if needed
+        if self.metadata_max_age:
+            self._metadata_looper = LoopingCall(self._refresh_metadata)
+            self._metadata_looper.clock = self._get_timer()
+            self._metadata_looper.start(
+                self.metadata_max_age * METADATA_CHECK_FRACTION,
+                now=False).addErrback(
+                    lambda f: log.error(
+                        '%r: metadata refresh timer failed: %r', self, f))
+
     def __repr__(self):
         """return a string representing this KafkaClient."""
         return '<KafkaClient clientId={0} brokers={1} timeout={2}>'.format(
@@ -125,6 +277,8 @@ class KafkaClient(object):
         None
         """
         self._hosts = hosts
+        # Resolve them afresh, as they may have new addresses already
+        self._dns_cache.clear()
         self._collect_hosts_d = True
 
     def reset_topic_metadata(self, *topics):
@@ -141,6 +295,8 @@ class KafkaClient(object):
             del self.topic_partitions[topic]
             if topic in self.topic_errors:
                 del self.topic_errors[topic]
+            self.topic_loaded_at.pop(topic, None)
+            self._topics_used.discard(topic)
 
     def reset_consumer_group_metadata(self, *groups):
         """Reset cache of what broker manages the offset for specified groups
@@ -160,6 +316,8 @@ class KafkaClient(object):
         self.topics_to_brokers.clear()
         self.topic_partitions.clear()
         self.topic_errors.clear()
+        self.topic_loaded_at.clear()
+        self._topics_used.clear()
 
     def has_metadata_for_topic(self, topic):
         return topic in self.topic_partitions
@@ -173,6 +331,12 @@ class KafkaClient(object):
         # make sure we continue to wait for them...
         log.debug("%r: close", self)
         self._closing = True
+        if self._keepalive_looper is not None:
+            looper, self._keepalive_looper = self._keepalive_looper, None
+            looper.stop()
+        if self._metadata_looper is not None:
+            looper, self._metadata_looper = self._metadata_looper, None
+            looper.stop()
         if not self.clients:
             # No clients to shutdown, just 'succeed'
             return succeed(None)
@@ -191,6 +355,15 @@ class KafkaClient(object):
         if self.load_metadata:
             d, self.load_metadata = self.load_metadata, None
             d.cancel()
+        if self._load_topics_dc is not None:
+            # Drop the queued loads, as a cancelled load does
+            dc, self._load_topics_dc = self._load_topics_dc, None
+            dc.cancel()
+            topics, self._topics_to_load = self._topics_to_load, []
+            for topic in topics:
+                for waiter in self._topic_waiters.pop(topic, ()):
+                    if not waiter.called:
+                        waiter.callback(None)
         self.clients = {}
         self.reset_all_metadata()
         self.consumer_group_to_brokers.clear()
@@ -207,6 +380,57 @@ class KafkaClient(object):
         # just return the outstanding deferred
         if self.load_metadata and fetch_all_metadata:
             return self.load_metadata
+        if fetch_all_metadata:
+            return self._send_metadata_request(topics)
+
+        # Wait on the loads of the topics already in progress, or queued,
+        # and queue the others, to be sent in one request at the end of
+        # this reactor tick
+        waiters = []
+        for topic in topics:
+            if topic not in self._topic_waiters:
+                self._topic_waiters[topic] = []
+                self._topics_to_load.append(topic)
+            waiter = Deferred()
+            self._topic_waiters[topic].append(waiter)
+            waiters.append(waiter)
+        if self._topics_to_load and self._load_topics_dc is None:
+            self._load_topics_dc = self._get_clock().callLater(
+                0, self._load_queued_topics)
+        if len(waiters) == 1:
+            return waiters[0]
+        d = DeferredList(waiters, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(lambda results: all(r for (_, r) in results),
+                       lambda f: f.value.subFailure)
+        return d
+
+    def _load_queued_topics(self):
+        """Load the metadata of the queued topics, in one request
+
+        Each of the deferreds waiting on the topics fires with the result.
+        """
+        self._load_topics_dc = None
+        topics, self._topics_to_load = self._topics_to_load, []
+        d = self._send_metadata_request(topics)
+
+        def _fire_waiters(result):
+            for topic in topics:
+                for waiter in self._topic_waiters.pop(topic, ()):
+                    if not waiter.called:  # Cancelled, perhaps
+                        if isinstance(result, Failure):
+                            waiter.errback(result)
+                        else:
+                            waiter.callback(result)
+
+        d.addBoth(_fire_waiters)
+
+    def _send_metadata_request(self, topics):
+        """Send a MetadataRequest, and update our metadata from the reply
+
+        Returns a deferred which fires with True when the metadata has
+        been updated, or fails with KafkaUnavailableError.
+        """
+        fetch_all_metadata = not topics
 
         # create the request
         requestId = self._next_id()
@@ -238,6 +462,7 @@ class KafkaClient(object):
 
             # Now loop through all the topics/partitions in the response
             # and setup our cache/data-structures
+            now = self._get_clock().seconds()
             for topic, topic_metadata in topics.items():
                 _, topic_error, partitions = topic_metadata
                 self.reset_topic_metadata(topic)
@@ -246,6 +471,8 @@ class KafkaClient(object):
                     log.warning('No partitions for %s, Err:%d',
                                 topic, topic_error)
                     continue
+                if not topic_error:
+                    self.topic_loaded_at[topic] = now
 
                 self.topic_partitions[topic] = []
                 for partition, meta in partitions.items():
@@ -378,7 +605,7 @@ class KafkaClient(object):
         """
 
         encoder = partial(
-            KafkaCodec.encode_produce_request,
+            KafkaCodec.encode_produce_request_sequence,
             acks=acks,
             timeout=timeout)
 
@@ -388,7 +615,7 @@ class KafkaClient(object):
             decoder = KafkaCodec.decode_produce_response
 
         resps = yield self._send_broker_aware_request(
-            payloads, encoder, decoder)
+            payloads, encoder, decoder, traffic=TRAFFIC_PRODUCE)
 
         returnValue(self._handle_responses(resps, fail_on_error, callback))
 
@@ -396,13 +623,28 @@ class KafkaClient(object):
     def send_fetch_request(self, payloads=None, fail_on_error=True,
                            callback=None,
                            max_wait_time=DEFAULT_FETCH_SERVER_WAIT_MSECS,
-                           min_bytes=DEFAULT_FETCH_MIN_BYTES):
+                           min_bytes=DEFAULT_FETCH_MIN_BYTES,
+                           raw_message_sets=False, decode_pool=None,
+                           check_crcs=CRC_CHECK_ALL):
         """
         Encode and send a FetchRequest
 
         Payloads are grouped by topic and partition so they can be pipelined
         to the same brokers.
 
+        If raw_message_sets is true, the messages of the returned
+        FetchResponses are undecoded MessageSet buffers. See
+        :meth:`KafkaCodec.decode_fetch_response`.
+
+        If decode_pool, a :class:`multiprocessing.Pool`, is given, message
+        sets of at least DECODE_POOL_MIN_BYTES are decoded by its worker
+        processes, off the reactor thread, and the messages of each returned
+        FetchResponse are a :class:`afkak.common.MessageBatch`. Should a
+        message set fail to decode, iterating its messages raises the error.
+
+        check_crcs is the policy for verifying the CRCs of fetched messages.
+        See :meth:`KafkaCodec.decode_fetch_response`.
+
         Raises
         ======
         FailedPayloadsError, LeaderUnavailableError, PartitionUnavailableError
@@ -411,16 +653,27 @@ class KafkaClient(object):
             raise ValueError(
                 "%r: max_wait_time: %d must be less than client.timeout by "
                 "at least 100 milliseconds.", self, max_wait_time)
+        validate_check_crcs(check_crcs)
 
         encoder = partial(KafkaCodec.encode_fetch_request,
                           max_wait_time=max_wait_time,
                           min_bytes=min_bytes)
 
+        # Messages before the requested offsets can only be unwanted parts
+        # of compressed messages, so skip them while decoding.
+        min_offsets = dict(((p.topic, p.partition), p.offset)
+                           for p in payloads or ())
+        decoder = partial(KafkaCodec.decode_fetch_response,
+                          raw_message_sets=(raw_message_sets or
+                                            decode_pool is not None),
+                          min_offsets=min_offsets, check_crcs=check_crcs)
         # resps is a list of FetchResponse() objects, each of which can hold
         # 1-n messages.
         resps = yield self._send_broker_aware_request(
-            payloads, encoder,
-            KafkaCodec.decode_fetch_response)
+            payloads, encoder, decoder, traffic=TRAFFIC_FETCH)
+        if decode_pool is not None:
+            resps = yield self._decode_in_pool(
+                decode_pool, resps, min_offsets, check_crcs)
 
         returnValue(self._handle_responses(resps, fail_on_error, callback))
 
@@ -510,6 +763,82 @@ class KafkaClient(object):
                 out.append(resp)
         return out
 
+    def _decode_in_pool(self, pool, responses, min_offsets,
+                        check_crcs=CRC_CHECK_ALL):
+        """Decode the raw message sets of FetchResponses into MessageBatches
+
+        Large message sets are sent to the worker processes of `pool`, the
+        rest are decoded here. Returns a Deferred which fires with the list
+        of FetchResponses, once all are decoded. It fails if the pool
+        refuses a task (having been closed, say), or with
+        RequestTimedOutError if a task isn't done within the client's
+        timeout, as when its worker died, or the pool was terminated, and
+        the pool will never call back.
+        """
+        reactor = self._get_clock()
+
+        def batch_decoded(result, resp, data):
+            success, batch = result
+            if not success:
+                # A ChecksumError has the messages before the bad one
+                error, batch = batch, getattr(batch, 'batch', None)
+            if batch is not None and batch.data is None:
+                # The worker didn't send back the data we gave it
+                batch.data = data
+            if not success:
+                return resp._replace(
+                    messages=_raise_iter(error, batch or ()))
+            return resp._replace(messages=batch)
+
+        def task_done(d, result):
+            # Unless it timed out already
+            if not d.called:
+                d.callback(result)
+
+        def task_timed_out(d, resp):
+            d.errback(RequestTimedOutError(
+                'decode_pool task for topic: {} partition: {} timed out '
+                'after: {} seconds'.format(
+                    resp.topic, resp.partition, self.timeout)))
+
+        def cancel_timeout(result, dc):
+            if dc.active():
+                dc.cancel()
+            return result
+
+        ds = []
+        for resp in responses:
+            min_offset = min_offsets.get((resp.topic, resp.partition))
+            if len(resp.messages) < self.DECODE_POOL_MIN_BYTES:
+                data = resp.messages
+                result = _decode_message_set_batch_task(
+                    resp.topic, resp.partition, data, min_offset, check_crcs)
+                ds.append(succeed(batch_decoded(result, resp, data)))
+                continue
+            # Buffers can't be pickled, so the worker gets a copy
+            data = str(resp.messages)
+            d = Deferred()
+            try:
+                pool.apply_async(
+                    _decode_message_set_batch_task,
+                    (resp.topic, resp.partition, data, min_offset,
+                     check_crcs),
+                    callback=partial(reactor.callFromThread, task_done, d))
+            except Exception as e:
+                d.errback(e)
+            else:
+                if self.timeout is not None:
+                    dc = self._get_timer().callLater(
+                        self.timeout, task_timed_out, d, resp)
+                    d.addBoth(cancel_timeout, dc)
+                d.addCallback(batch_decoded, resp, data)
+            ds.append(d)
+
+        d = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(lambda results: [resp for (_, resp) in results],
+                       lambda f: f.value.subFailure)
+        return d
+
     def _get_clock(self):
         # Reactor to use for connecting, callLater, etc [test]
         if self.clock is None:
@@ -517,31 +846,51 @@ class KafkaClient(object):
             self.clock = reactor
         return self.clock
 
-    def _get_brokerclient(self, host, port):
+    def _get_timer(self):
+        # Our timing wheel if we have one, else the reactor, for timeouts
+        if self.timing_wheel is not None:
+            return self.timing_wheel
+        return self._get_clock()
+
+    def _get_brokerclient(self, host, port, traffic=TRAFFIC_CONTROL):
         """
         Get or create a connection to a broker using host and port.
         Returns the broker immediately, but the broker may have just been
         created and be in an unconnected state. The broker will connect on
         an as-needed basis when processing a request.
+
+        If the traffic class is one of our dedicated_connections, the
+        connection is that class's own, rather than the broker's control
+        connection.
         """
-        host_key = (host, port)
+        if traffic in self.dedicated_connections:
+            host_key = (host, port, traffic)
+            clientId = '{}:{}'.format(self.clientId, traffic)
+        else:
+            host_key = (host, port)
+            clientId = self.clientId
         if host_key not in self.clients:
             # We don't have a brokerclient for that host/port, create one,
             # ask it to connect
             log.debug("%r: creating new KafkaBrokerClient: %r", self,
                       host_key)
             self.clients[host_key] = KafkaBrokerClient(
-                host, port, clientId=self.clientId,
+                host, port, clientId=clientId,
                 subscribers=[self._update_broker_state],
+                maxInFlight=self.max_in_flight,
+                maxQueuedBytes=self.max_queued_bytes,
+                socketOptions=self.socket_options,
+                failOnDisconnect=self.fail_on_disconnect,
+                reactor=self.clock,
                 )
         return self.clients[host_key]
 
     def _update_broker_state(self, broker, connected, reason):
         """
         Handle updates of a broker's connection state.  If we get an update
-        with a state other than 'connected', reset our metadata, as it
-        indicates that a connection to one of our brokers ended, or failed to
-        come up correctly
+        with a state other than 'connected', reset our metadata for the
+        partitions it leads, as it indicates that a connection to one of our
+        brokers ended, or failed to come up correctly
         """
         state = "Connected" if connected else "Disconnected"
         log.debug(
@@ -549,15 +898,16 @@ class KafkaClient(object):
         # If one of our broker clients disconnected, there may be a metadata
         # change. Make sure we check...
         if not connected:
-            self.reset_all_metadata()
+            self._reset_broker_metadata(broker.host, broker.port)
             if not self._closing:
                 # If we're not shutting down, and we're not already doing a
                 # lookup, then mark ourselves as needing to re-resolve, and
-                # then start a metadata lookup, which will do the lookup as
-                # needed...
+                # then start a lookup of the metadata of the topics we use,
+                # which will do the lookup as needed...
                 if self._collect_hosts_d is None:
                     self._collect_hosts_d = True
-                self.load_metadata_for_topics()
+                if self.topic_partitions:
+                    self.load_metadata_for_topics(*self.topic_partitions)
 
     def _update_brokers(self, new_brokers, remove=False):
         """ Update our self.clients based on brokers in received metadata
@@ -569,9 +919,10 @@ class KafkaClient(object):
         log.debug("%r: _update_brokers: %r remove: %r",
                   self, new_brokers, remove)
 
-        # Work with the brokers as sets
+        # Work with the brokers as sets, of (host, port) without any
+        # traffic class
         new_brokers = set(new_brokers)
-        current_brokers = set(self.clients.keys())
+        current_brokers = set(key[:2] for key in self.clients)
 
         # set of added
         added_brokers = new_brokers - current_brokers
@@ -580,7 +931,12 @@ class KafkaClient(object):
 
         # Create any new brokers based on the new metadata
         for broker in added_brokers:
-            self._get_brokerclient(*broker)
+            brokerClient = self._get_brokerclient(*broker)
+            if self.connect_eagerly:
+                # Connect now, for the control and any dedicated connections
+                brokerClient.connect()
+                for traffic in self.dedicated_connections:
+                    self._get_brokerclient(*broker, traffic=traffic).connect()
 
         # Disconnect and remove from self.clients any removed
         if remove and removed_brokers:
@@ -590,33 +946,77 @@ class KafkaClient(object):
                 log.debug("%r: _update_brokers has nested deferredlist: %r",
                           self, self.close_dlist)
                 dList = [self.close_dlist]
-            for broker in removed_brokers:
-                # broker better be in self.clients if not, weirdness
-                brokerClient = self.clients.pop(broker)
-                log.debug("Calling close on: %r", brokerClient)
-                dList.append(brokerClient.close())
+            # Close all of each removed broker's connections
+            for key in self.clients.keys():
+                if key[:2] in removed_brokers:
+                    brokerClient = self.clients.pop(key)
+                    log.debug("Calling close on: %r", brokerClient)
+                    dList.append(brokerClient.close())
             self.close_dlist = DeferredList(dList)
 
-    @inlineCallbacks
-    def _get_leader_for_partition(self, topic, partition):
+    def _metadata_age(self, topic):
+        """Seconds since the metadata for the topic arrived, or None"""
+        loaded_at = self.topic_loaded_at.get(topic)
+        if loaded_at is None:
+            return None
+        return self._get_clock().seconds() - loaded_at
+
+    def _metadata_expired(self, topic):
+        """Is the metadata for the topic older than metadata_max_age?"""
+        if self.metadata_max_age is None:
+            return False
+        age = self._metadata_age(topic)
+        return age is not None and age >= self.metadata_max_age
+
+    def _refresh_metadata(self):
+        """Reload the metadata of the topics nearing metadata_max_age
+
+        Called periodically, so the metadata is refreshed before it expires,
+        while the old metadata is still used. Requests then don't wait on
+        loading metadata unless the refresh fails. Only the topics requests
+        have been sent for since their metadata was loaded are refreshed,
+        not every topic an all-topics load returned, nor those in error.
         """
-        Returns the leader for a partition or None if the partition exists
-        but has no leader.
+        if self._metadata_refresh_d is not None:
+            return
+        refresh_age = self.metadata_max_age * METADATA_REFRESH_FRACTION
+        topics = [topic for topic in self._topics_used
+                  if topic in self.topic_loaded_at and
+                  self._metadata_age(topic) >= refresh_age]
+        if not topics:
+            return
+        log.debug('%r: refreshing metadata for: %r', self, topics)
+        d = self._metadata_refresh_d = self.load_metadata_for_topics(*topics)
 
-        PartitionUnavailableError will be raised if the topic or partition
-        is not part of the metadata.
-        """
+        def _refreshed(result):
+            self._metadata_refresh_d = None
+            if isinstance(result, Failure):
+                log.warning('%r: metadata refresh for %r failed: %r',
+                            self, topics, result)
 
-        key = TopicAndPartition(topic, partition)
-        # reload metadata whether the partition is not available
-        # or has no leader (broker is None)
-        if self.topics_to_brokers.get(key) is None:
-            yield self.load_metadata_for_topics(topic)
+        d.addBoth(_refreshed)
 
-        if key not in self.topics_to_brokers:
-            raise PartitionUnavailableError("%s not available" % str(key))
+    def _send_keepalives(self):
+        """Send a request over each idle connection to keep it open
 
-        returnValue(self.topics_to_brokers[key])
+        Brokers close connections idle for connections.max.idle.ms (10
+        minutes by default), and the next request then waits to reconnect.
+        The request sent is an OffsetRequest for no partitions, which the
+        broker answers with an empty response.
+        """
+        for brokerClient in self.clients.values():
+            if brokerClient.proto is None or brokerClient.requests:
+                # Not connected, or not idle
+                continue
+            requestId = self._next_id()
+            request = KafkaCodec.encode_offset_request(
+                self.clientId, requestId)
+            d = self._make_request_to_broker(brokerClient, requestId, request)
+            d.addErrback(self._keepalive_failed, brokerClient)
+
+    def _keepalive_failed(self, failure, brokerClient):
+        log.debug('%r: keepalive to %r failed: %r', self, brokerClient,
+                  failure)
 
     @inlineCallbacks
     def _get_coordinator_for_group(self, consumer_group):
@@ -665,11 +1065,12 @@ class KafkaClient(object):
         # Make the request to the specified broker
         d = broker.makeRequest(requestId, request, **kwArgs)
         if self.timeout is not None:
+            timer = self._get_timer()
             # Set a delayedCall to fire if we don't get a reply in time
-            dc = self._get_clock().callLater(
+            dc = timer.callLater(
                 self.timeout, _timeout_request, broker, requestId)
             # Set a delayedCall to complain if the reactor has been blocked
-            rc = self._get_clock().callLater(
+            rc = timer.callLater(
                 (self.timeout * 0.9), _alert_blocked_reactor, self.timeout,
                 self._get_clock().seconds())
             # Setup a callback on the request deferred to cancel both callLater
@@ -689,7 +1090,8 @@ class KafkaClient(object):
         if self._collect_hosts_d:
             if self._collect_hosts_d is True:
                 # Lookup needed, but not yet started. Start it.
-                self._collect_hosts_d = _collect_hosts(self._hosts)
+                self._collect_hosts_d = _collect_hosts(
+                    self._hosts, self._dns_cache, self._get_clock())
             broker_list = yield self._collect_hosts_d
             self._clear_collect_hosts()
             if broker_list:
@@ -702,8 +1104,14 @@ class KafkaClient(object):
                 self._collect_hosts_d = True
 
         if brokers is None:
-            brokers = self.clients.values()[:]
+            # Only the control connections, not the dedicated ones
+            brokers = [brokerClient for key, brokerClient
+                       in self.clients.items() if len(key) == 2]
             random.shuffle(brokers)
+            # Try those connected first, then those not yet tried, and last
+            # those trying to (re)connect, which may well be down
+            brokers.sort(key=lambda b: (b.proto is None,
+                                        b.connector is not None))
         for broker in brokers:
             try:
                 log.debug('_sbur: sending request: %d to broker: %r',
@@ -716,14 +1124,17 @@ class KafkaClient(object):
                             "trying next server. Err: %r",
                             request, broker.host, broker.port, e)
 
-        # Anytime we fail a request to every broker, setup for a re-resolve
+        # Anytime we fail a request to every broker, setup for a re-resolve,
+        # bypassing the cache, as the brokers may have new addresses
+        self._dns_cache.clear()
         self._collect_hosts_d = True
         raise KafkaUnavailableError(
             "All servers [%r] failed to process request" % self.clients.keys())
 
     @inlineCallbacks
     def _send_broker_aware_request(self, payloads, encoder_fn, decode_fn,
-                                   consumer_group=None):
+                                   consumer_group=None,
+                                   traffic=TRAFFIC_CONTROL):
         """
         Group a list of request payloads by topic+partition and send them to
         the leader broker for that partition using the supplied encode/decode
@@ -743,6 +1154,8 @@ class KafkaClient(object):
         consumer_group: [string], optional. Indicates the request should be
                    directed to the Offset Coordinator for the specified
                    consumer_group.
+        traffic: the traffic class of the request, which selects the
+                   connection to each broker it is sent over.
 
         Return
         ======
@@ -759,36 +1172,9 @@ class KafkaClient(object):
         if not payloads:
             raise ValueError("Payloads parameter is empty")
 
-        # Group the requests by topic+partition
-        original_keys = []
-        payloads_by_broker = collections.defaultdict(list)
-
-        # Go through all the payloads, lookup the leader/coordinator for that
-        # payload's topic/partition or consumer group. If there's no
-        # leader/coordinator (broker), raise. For each broker, keep
-        # a list of the payloads to be sent to it. Also, for each payload in
-        # the list of payloads, make a corresponding list (original_keys) with
-        # the topic/partition in the same order, so we can lookup the returned
-        # result(s) by that topic/partition key in the set of returned results
-        # and return them in a list the same order the payloads were supplied
-        for payload in payloads:
-            # get leader/coordinator, depending on consumer_group
-            if consumer_group is None:
-                leader = yield self._get_leader_for_partition(
-                    payload.topic, payload.partition)
-                if leader is None:
-                    raise LeaderUnavailableError(
-                        "Leader not available for topic %s partition %s" %
-                        (payload.topic, payload.partition))
-            else:
-                leader = yield self._get_coordinator_for_group(consumer_group)
-                if leader is None:
-                    raise ConsumerCoordinatorNotAvailableError(
-                        "Coordinator not available for group: %s" %
-                        (consumer_group))
-
-            payloads_by_broker[leader].append(payload)
-            original_keys.append((payload.topic, payload.partition))
+        # The keys of the payloads, so we can return the responses in the
+        # same order as the payloads
+        original_keys = [(p.topic, p.partition) for p in payloads]
 
         # Accumulate the responses in a dictionary
         acc = {}
@@ -805,40 +1191,73 @@ class KafkaClient(object):
 
         # keep a list of payloads that were failed to be sent to brokers
         failed_payloads = []
+        # and the (host, port) of the brokers whose requests failed
+        failed_brokers = set()
+
+        # Payloads whose requests failed because the connection to their
+        # broker was lost are sent again, once, to their new leader. Not
+        # produce requests, unless duplicates are acceptable, as the old
+        # leader may have written them before the connection was lost.
+        resend = self.fail_on_disconnect and (
+            self.resend_produce_on_disconnect or
+            not any(isinstance(p, ProduceRequest) for p in payloads))
+        while payloads:
+            payloads_by_broker = yield self._payloads_by_leader(
+                payloads, consumer_group)
+
+            # Keep track of outstanding requests in a list of deferreds
+            inFlight = []
+            # and the brokers and payloads that go along with them
+            brokersList = []
+            payloadsList = []
+            # For each broker, send the list of request payloads,
+            for broker_meta, broker_payloads in payloads_by_broker.items():
+                broker = self._get_brokerclient(
+                    broker_meta.host, broker_meta.port, traffic)
+                requestId = self._next_id()
+                request = encoder_fn(client_id=self.clientId,
+                                     correlation_id=requestId,
+                                     payloads=broker_payloads)
+
+                # Make the request
+                d = self._make_request_to_broker(broker, requestId, request,
+                                                 expectResponse=expectResponse)
+                inFlight.append(d)
+                brokersList.append(broker_meta)
+                payloadsList.append(broker_payloads)
+
+            # Wait for all the responses to come back, or the requests to fail
+            results = yield DeferredList(inFlight, consumeErrors=True)
+            payloads = []
+            # We now have a list of (succeeded, response/Failure) tuples.
+            # Check 'em
+            for (success, response), broker_meta, broker_payloads in zip(
+                    results, brokersList, payloadsList):
+                if not success:
+                    # The brokerclient deferred was errback()'d:
+                    #   The send failed, the connection was lost, or this
+                    #   request was cancelled (by timeout)
+                    log.debug("%r: request:%r to broker failed: %r", self,
+                              broker_payloads, response)
+                    # Look up afresh where to send anything routed to it
+                    failed_brokers.add((broker_meta.host, broker_meta.port))
+                    if resend and response.check(ConnectionError):
+                        payloads.extend(broker_payloads)
+                    else:
+                        failed_payloads.extend(
+                            [(p, response) for p in broker_payloads])
+                    continue
+                if not expectResponse:
+                    continue
+                # Successful request/response. Decode it
+                for response in decode_fn(response):
+                    acc[(response.topic, response.partition)] = response
 
-        # Keep track of outstanding requests in a list of deferreds
-        inFlight = []
-        # and the payloads that go along with them
-        payloadsList = []
-        # For each broker, send the list of request payloads,
-        for broker_meta, payloads in payloads_by_broker.items():
-            broker = self._get_brokerclient(broker_meta.host, broker_meta.port)
-            requestId = self._next_id()
-            request = encoder_fn(client_id=self.clientId,
-                                 correlation_id=requestId, payloads=payloads)
-
-            # Make the request
-            d = self._make_request_to_broker(broker, requestId, request,
-                                             expectResponse=expectResponse)
-            inFlight.append(d)
-            payloadsList.append(payloads)
-
-        # Wait for all the responses to come back, or the requests to fail
-        results = yield DeferredList(inFlight, consumeErrors=True)
-        # We now have a list of (succeeded, response/Failure) tuples. Check 'em
-        for (success, response), payloads in zip(results, payloadsList):
-            if not success:
-                # The brokerclient deferred was errback()'d:
-                #   The send failed, or this request was cancelled (by timeout)
-                log.debug("%r: request:%r to broker failed: %r", self,
-                          payloads, response)
-                failed_payloads.extend([(p, response) for p in payloads])
-                continue
-            if not expectResponse:
-                continue
-            # Successful request/response. Decode it
-            for response in decode_fn(response):
-                acc[(response.topic, response.partition)] = response
+            for host, port in failed_brokers:
+                self._reset_broker_metadata(host, port)
+            failed_brokers.clear()
+            if payloads:
+                resend = False
 
         # Order the accumulated responses by the original key order
         # Note that this scheme will throw away responses which we did
@@ -849,55 +1268,187 @@ class KafkaClient(object):
         # If any of the payloads failed, fail
         responses = (acc[k] for k in original_keys) if acc else ()
         if failed_payloads:
-            self.reset_all_metadata()
             raise FailedPayloadsError(responses, failed_payloads)
 
         returnValue(responses)
 
+    def _payloads_by_leader(self, payloads, consumer_group=None):
+        """Group payloads by the broker to send them to
+
+        Lookup the leader of each payload's topic/partition, or the
+        coordinator of the consumer group. If there's no leader/coordinator
+        (broker), raise.
+
+        Return a dict of BrokerMetadata to the list of payloads to be sent
+        to that broker, or a deferred of it, should the metadata of any of
+        the payloads' topics (or of the group) need loading first. The
+        leaders already known are looked up together, without a deferred
+        per payload.
+        """
+        if consumer_group is not None:
+            d = maybeDeferred(self._get_coordinator_for_group, consumer_group)
+            d.addCallback(self._payloads_by_coordinator, payloads,
+                          consumer_group)
+            return d
+
+        topics_to_brokers = self.topics_to_brokers
+        missing = set()
+        for payload in payloads:
+            # reload metadata whether the partition is not available
+            # or has no leader (broker is None), or has expired
+            if topics_to_brokers.get(
+                    TopicAndPartition(payload.topic, payload.partition)) is \
+                    None or self._metadata_expired(payload.topic):
+                missing.add(payload.topic)
+        if not missing:
+            return self._group_by_leader(payloads)
+        d = self.load_metadata_for_topics(*missing)
+        d.addCallback(lambda _: self._group_by_leader(payloads))
+        return d
+
+    def _group_by_leader(self, payloads):
+        """Group payloads by their leader, from the metadata we have"""
+        payloads_by_broker = collections.defaultdict(list)
+        topics_to_brokers = self.topics_to_brokers
+        used = self._topics_used
+        for payload in payloads:
+            used.add(payload.topic)
+            key = TopicAndPartition(payload.topic, payload.partition)
+            try:
+                leader = topics_to_brokers[key]
+            except KeyError:
+                raise PartitionUnavailableError("%s not available" % str(key))
+            if leader is None:
+                raise LeaderUnavailableError(
+                    "Leader not available for topic %s partition %s" %
+                    (payload.topic, payload.partition))
+            payloads_by_broker[leader].append(payload)
+        return payloads_by_broker
+
+    def _payloads_by_coordinator(self, coordinator, payloads,
+                                 consumer_group):
+        if coordinator is None:
+            raise ConsumerCoordinatorNotAvailableError(
+                "Coordinator not available for group: %s" %
+                (consumer_group))
+        return {coordinator: list(payloads)}
+
+    def _reset_broker_metadata(self, host, port):
+        """Forget the partitions led, and the groups coordinated, by a broker
+
+        Their leader or coordinator is looked up again when next needed,
+        while the rest of our metadata is kept.
+        """
+        for key, broker in self.topics_to_brokers.items():
+            if broker is not None and (broker.host, broker.port) == (host,
+                                                                     port):
+                del self.topics_to_brokers[key]
+        for group, broker in self.consumer_group_to_brokers.items():
+            if broker is not None and (broker.host, broker.port) == (host,
+                                                                     port):
+                del self.consumer_group_to_brokers[group]
+
     def _clear_collect_hosts(self):
         self._collect_hosts_d = None
 
 
+def _split_host_port(host_port):
+    """
+    Split a <host>:<port>, <host>, [<IPv6-addr>]:<port> or [<IPv6-addr>]
+    string into a (<host>, <port>) tuple
+    """
+    host_port = host_port.strip()
+    if host_port.startswith('['):
+        host, _, port = host_port[1:].partition(']')
+        port = port[1:]
+    else:
+        host, _, port = host_port.partition(':')
+    return host.strip(), int(port) if port else DefaultKafkaPort
+
+
 @inlineCallbacks
-def _collect_hosts(hosts):
+def _collect_hosts(hosts, cache=None, clock=None):
     """
     Turn hosts args into a list of tuples
     Takes a list of string or a string with comma separated entries
     of the form <host>:<port> or <host> and returns a list of
     (<IP-addr>, <port>) tuples
+
+    The names are resolved concurrently, so the whole lookup takes about
+    as long as the slowest name rather than the sum of them. If a `cache`
+    dict is given, answers are kept in it (see :func:`_get_IP_addresses`).
     """
     if isinstance(hosts, basestring):
         hosts = hosts.strip().split(',')
-    result = set()
-    for host_port in hosts:
-        res = host_port.split(':')
-        host = res[0].strip()
-        port = int(res[1]) if len(res) > 1 else DefaultKafkaPort
+    host_ports = [_split_host_port(host_port) for host_port in hosts]
+    # Resolve each distinct name once, in the order first given
+    lookups = collections.OrderedDict()
+    for host, port in host_ports:
+        if host not in lookups:
+            lookups[host] = maybeDeferred(
+                _get_IP_addresses, host, cache, clock)
+    results = yield DeferredList(lookups.values(), consumeErrors=True)
+    ip_addresses = {}
+    for host, (success, addresses) in zip(lookups, results):
+        if not success:
+            log.error('Failed to resolve %r: %r', host, addresses)
+            continue
+        ip_addresses[host] = addresses
 
-        ip_addresses = yield _get_IP_addresses(host)
-        if not ip_addresses:
+    result = set()
+    for host, port in host_ports:
+        if not ip_addresses.get(host):
             continue
-        result |= set(_make_IPHost_tuples(ip_addresses, port))
+        result |= set(_make_IPHost_tuples(ip_addresses[host], port))
     returnValue(list(result))
 
 
 @inlineCallbacks
-def _get_IP_addresses(hostname):
+def _get_IP_addresses(hostname, cache=None, clock=None):
     """
-    Resolves an an address/URL to a list of IPv4 addresses
+    Resolves an an address/URL to a list of IPv4 and IPv6 addresses
+
+    The A and AAAA lookups are made concurrently, and either may fail
+    without the other's answers being lost. If a `cache` dict is given
+    (with the `clock` to age its entries by), the addresses are stored in
+    it for the smallest TTL of the answers, and served from it without
+    any DNS round-trips until then. Failed lookups are not cached.
     """
-    if isIPAddress(hostname):
+    if isIPAddress(hostname) or isIPv6Address(hostname):
         returnValue([hostname])
-    else:
-        try:
-            answers, auth, addit = yield DNSclient.lookupAddress(hostname)
-        except Exception as exc:  # Too many different DNS failures to catch...
-            log.error('DNS Resolution failure: %r for name: %r', exc, hostname)
-            returnValue([])
 
-        returnValue(
-            [answer.payload.dottedQuad()
-                for answer in answers if answer.type == dns.A])
+    if cache is not None:
+        expires_at, addresses = cache.get(hostname, (None, None))
+        if expires_at is not None and expires_at > clock.seconds():
+            returnValue(list(addresses))
+        cache.pop(hostname, None)
+
+    results = yield DeferredList([
+        maybeDeferred(DNSclient.lookupAddress, hostname),
+        maybeDeferred(DNSclient.lookupIPV6Address, hostname),
+    ], consumeErrors=True)
+    if not any(success for success, _ in results):
+        # Too many different DNS failures to pick out any particular ones
+        log.error('DNS Resolution failure: %r for name: %r',
+                  results[0][1].value, hostname)
+        returnValue([])
+
+    addresses, ttls = [], []
+    for success, result in results:
+        if not success:
+            continue
+        answers, auth, addit = result
+        for answer in answers:
+            if answer.type == dns.A:
+                addresses.append(answer.payload.dottedQuad())
+            elif answer.type == dns.AAAA:
+                addresses.append(socket.inet_ntop(
+                    socket.AF_INET6, answer.payload.address))
+            ttls.append(answer.ttl)
+
+    if cache is not None and addresses and min(ttls) > 0:
+        cache[hostname] = (clock.seconds() + min(ttls), addresses)
+    returnValue(addresses)
 
 
 def _make_IPHost_tuples(IP_addresses, port):
@@ -906,3 +1457,14 @@ def _make_IPHost_tuples(IP_addresses, port):
     which each 2-tuple is a (IP address, port)
     """
     return [(address, port) for address in IP_addresses]
+
+
+def _raise_iter(exc, messages=()):
+    """
+    Return an iterator which yields an OffsetAndMessage for each of the
+    SourcedMessages given, then raises exc, standing in for the messages of
+    a FetchResponse whose message set failed to decode part way
+    """
+    for message in messages:
+        yield OffsetAndMessage(message.offset, message.message)
+    raise exc
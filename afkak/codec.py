@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2015 Cyan, Inc.
 
-from cStringIO import StringIO
-import gzip
 import struct
+import zlib
 
 _XERIAL_V1_HEADER = (-126, 'S', 'N', 'A', 'P', 'P', 'Y', 0, 1, 1)
 _XERIAL_V1_FORMAT = 'bccccccBii'
+_XERIAL_V1_STRUCT = struct.Struct('!' + _XERIAL_V1_FORMAT)
+_XERIAL_V1_HEADER_BYTES = _XERIAL_V1_STRUCT.pack(*_XERIAL_V1_HEADER)
+_XERIAL_BLOCK_LENGTH = struct.Struct('!i')
+# Uncompressed bytes per block of a xerial stream, as the xerial library
+XERIAL_DEFAULT_BLOCKSIZE = 32 * 1024
+
+# zlib wbits value selecting gzip framing (16) with a 32K window (15)
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Compression level used unless one is given, that of gzip.GzipFile
+GZIP_DEFAULT_LEVEL = 9
+# Number of bytes fed to, and at most returned by, each inflate step of
+# gzip_decode_iter()
+GZIP_DECODE_CHUNK_SIZE = 64 * 1024
 
 try:
     import snappy
@@ -14,6 +26,13 @@ try:
 except ImportError:
     _has_snappy = False
 
+try:
+    import lz4.frame
+    import xxhash
+    _has_lz4 = True
+except ImportError:
+    _has_lz4 = False
+
 
 def has_gzip():
     return True
@@ -23,28 +42,109 @@ def has_snappy():
     return _has_snappy
 
 
-def gzip_encode(payload):
-    buffer = StringIO()
-    handle = gzip.GzipFile(fileobj=buffer, mode="w")
-    handle.write(payload)
-    handle.close()
-    buffer.seek(0)
-    result = buffer.read()
-    buffer.close()
-    return result
+def has_lz4():
+    return _has_lz4
+
+
+def gzip_encode(payload, compresslevel=GZIP_DEFAULT_LEVEL):
+    """Encode the given data with gzip framing
+
+    :param int compresslevel:
+        zlib compression level: 1 is fastest, 9 compresses best and 0 is no
+        compression.
+    """
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def _gzip_member_ended(decompressor):
+    """Has the decompressor reached the end of its gzip member?
+
+    Python 2's decompressors don't say, and flush() returns what it can of
+    a truncated member without complaint. Once the end (whose CRC zlib
+    checks) is reached, further data is left as unused_data, so a byte is
+    fed to copies of the decompressor to see. Two different bytes are
+    tried, as a member truncated by a byte could be completed by one.
+    """
+    if decompressor.unused_data:
+        return True
+    for probe in ('\x00', '\x01'):
+        copy = decompressor.copy()
+        try:
+            copy.decompress(probe)
+        except zlib.error:
+            return False
+        if copy.unused_data != probe:
+            return False
+    return True
 
 
 def gzip_decode(payload):
-    buffer = StringIO(payload)
-    handle = gzip.GzipFile(fileobj=buffer, mode='r')
-    result = handle.read()
-    handle.close()
-    buffer.close()
-    return result
+    """Decode the given gzip data
+
+    Concatenated gzip members are decoded in turn, and trailing zero padding
+    is ignored, as with :class:`gzip.GzipFile`. Raises IOError if the data
+    is truncated.
+    """
+    out = []
+    data = payload
+    while data:
+        decompressor = zlib.decompressobj(_GZIP_WBITS)
+        out.append(decompressor.decompress(data))
+        if not _gzip_member_ended(decompressor):
+            raise IOError("Truncated gzip data")
+        data = decompressor.unused_data.lstrip('\x00')
+    return ''.join(out)
+
+
+def gzip_decode_iter(payload, chunk_size=GZIP_DECODE_CHUNK_SIZE):
+    """Incrementally decode the given gzip data
+
+    Yields the decompressed data in pieces of at most `chunk_size` bytes as
+    it is inflated, so the whole of it need never be held in memory at once.
+    Concatenated gzip members are decoded in turn, and trailing zero padding
+    is ignored, as with :class:`gzip.GzipFile`. Raises IOError, once all
+    the data there is has been yielded, if it is truncated.
+    """
+    view = buffer(payload)
+    pos = 0
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    fresh = True
+    pending = ''
+    while True:
+        if not pending:
+            if pos >= len(view):
+                break
+            pending = view[pos:pos + chunk_size]
+            pos += chunk_size
+        if fresh:
+            # Skip any zero padding before (or instead of) the next member
+            pending = pending.lstrip('\x00')
+            if not pending:
+                continue
+            fresh = False
+        out = decompressor.decompress(pending, chunk_size)
+        if out:
+            yield out
+        if decompressor.unused_data:
+            # The end of a gzip member. What follows may be another.
+            pending = decompressor.unused_data
+            decompressor = zlib.decompressobj(_GZIP_WBITS)
+            fresh = True
+        else:
+            pending = decompressor.unconsumed_tail
+    if fresh:
+        return
+    if not _gzip_member_ended(decompressor):
+        raise IOError("Truncated gzip data")
+    out = decompressor.flush()
+    if out:
+        yield out
 
 
 def snappy_encode(payload, xerial_compatible=False,
-                  xerial_blocksize=32 * 1024):
+                  xerial_blocksize=XERIAL_DEFAULT_BLOCKSIZE):
     """Encodes the given data with snappy if xerial_compatible is set then the
        stream is encoded in a fashion compatible with the xerial snappy library
 
@@ -68,24 +168,12 @@ def snappy_encode(payload, xerial_compatible=False,
         raise NotImplementedError("Snappy codec is not available")
 
     if xerial_compatible:
-        def _chunker():
-            for i in xrange(0, len(payload), xerial_blocksize):
-                yield payload[i:i+xerial_blocksize]
-
-        out = StringIO()
-
-        header = ''.join([struct.pack('!' + fmt, dat) for fmt, dat
-                          in zip(_XERIAL_V1_FORMAT, _XERIAL_V1_HEADER)])
-
-        out.write(header)
-        for chunk in _chunker():
-            block = snappy.compress(chunk)
-            block_size = len(block)
-            out.write(struct.pack('!i', block_size))
-            out.write(block)
-
-        out.seek(0)
-        return out.read()
+        blocks = [_XERIAL_V1_HEADER_BYTES]
+        for i in xrange(0, len(payload), xerial_blocksize):
+            block = snappy.compress(payload[i:i + xerial_blocksize])
+            blocks.append(_XERIAL_BLOCK_LENGTH.pack(len(block)))
+            blocks.append(block)
+        return ''.join(blocks)
 
     else:
         return snappy.compress(payload)
@@ -114,32 +202,79 @@ def _detect_xerial_stream(payload):
     """
 
     if len(payload) > 16:
-        header = header = struct.unpack(
-            '!' + _XERIAL_V1_FORMAT, bytes(payload)[:16])
-        return header == _XERIAL_V1_HEADER
+        return _XERIAL_V1_STRUCT.unpack_from(payload) == _XERIAL_V1_HEADER
     return False
 
 
 def snappy_decode(payload):
+    """Decode the given snappy data, plain or xerial framed
+
+    Raises IOError if a xerial stream is truncated.
+    """
     if not has_snappy():
         raise NotImplementedError("Snappy codec is not available")
 
     if _detect_xerial_stream(payload):
-        # TODO ? Should become a fileobj ?
-        out = StringIO()
-        byt = buffer(payload[16:])
-        length = len(byt)
-        cursor = 0
-
+        # Read each block's length in place, and decompress straight from a
+        # buffer onto the payload, rather than slicing out copies
+        blocks = []
+        length = len(payload)
+        cursor = _XERIAL_V1_STRUCT.size
         while cursor < length:
-            block_size = struct.unpack_from('!i', byt[cursor:])[0]
-            # Skip the block size
-            cursor += 4
-            end = cursor + block_size
-            out.write(snappy.decompress(byt[cursor:end]))
-            cursor = end
-
-        out.seek(0)
-        return out.read()
+            if cursor + _XERIAL_BLOCK_LENGTH.size > length:
+                raise IOError("Truncated xerial snappy data")
+            block_size = _XERIAL_BLOCK_LENGTH.unpack_from(payload, cursor)[0]
+            cursor += _XERIAL_BLOCK_LENGTH.size
+            if block_size < 0 or cursor + block_size > length:
+                raise IOError("Truncated xerial snappy data")
+            blocks.append(snappy.decompress(
+                buffer(payload, cursor, block_size)))
+            cursor += block_size
+        return ''.join(blocks)
     else:
         return snappy.decompress(payload)
+
+
+def _lz4_header_checksum(data):
+    """The HC byte of an LZ4 frame header: the second byte of its xxh32"""
+    return chr((xxhash.xxh32(data).intdigest() >> 8) & 0xff)
+
+
+def _lz4_header_size(payload):
+    # Magic(4) FLG BD [ContentSize(8)] HC
+    if ord(payload[4]) & 0x08:
+        return 15
+    return 7
+
+
+def lz4_encode(payload):
+    """Encodes the given data with LZ4 in the framing Kafka expects
+
+    Kafka's LZ4 codec (for message format 0, as spoken by this client) uses
+    the standard LZ4 frame format with independent blocks, except that the
+    header checksum (HC) is computed over the frame's magic number as well
+    as its frame descriptor, which standard LZ4 libraries reject.
+    """
+    if not has_lz4():
+        raise NotImplementedError("LZ4 codec is not available")
+
+    data = lz4.frame.compress(payload, block_linked=False, store_size=False)
+    size = _lz4_header_size(data)
+    return ''.join([
+        data[:size - 1], _lz4_header_checksum(data[:size - 1]), data[size:]])
+
+
+def lz4_decode(payload):
+    """Decodes the given LZ4 data, as framed by Kafka
+
+    The header checksum is recomputed, so frames with either Kafka's or the
+    standard header checksum are accepted.
+    """
+    if not has_lz4():
+        raise NotImplementedError("LZ4 codec is not available")
+
+    payload = bytes(payload)
+    size = _lz4_header_size(payload)
+    return lz4.frame.decompress(''.join([
+        payload[:size - 1], _lz4_header_checksum(payload[4:size - 1]),
+        payload[size:]]))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2015 Cyan, Inc.
 
+from array import array
 from collections import namedtuple
 
 # Constants
@@ -76,6 +77,101 @@ TopicAndPartition = namedtuple("TopicAndPartition", ["topic", "partition"])
 SourcedMessage = namedtuple(
     "SourcedMessage", TopicAndPartition._fields + OffsetAndMessage._fields)
 
+# Python 2's array has no 'q' typecode, but 'l' is 64 bits on LP64 platforms
+try:
+    OFFSET_TYPECODE = array('q').typecode
+except ValueError:
+    OFFSET_TYPECODE = 'l'
+
+
+class MessageBatch(object):
+    """A columnar batch of messages fetched from a single topic/partition
+
+    Rather than a tuple (or three) per message, a MessageBatch stores the
+    topic and partition once, the message offsets and attributes in arrays,
+    and the keys and values as (start, length) arrays indexing into a single
+    shared buffer, `data`. A length of -1 indicates a null key or value.
+
+    A batch is a read-only sequence of :class:`SourcedMessage`, built on
+    access, so it can be handed to processors expecting a list of them.
+    Slicing returns a new batch sharing the same buffer. Processors which
+    handle messages in bulk can use :attr:`offsets`, :meth:`keys` and
+    :meth:`values` to avoid creating a tuple per message at all.
+
+    The magic byte of the messages isn't stored: afkak only sends version 0
+    FetchRequests, to which brokers only reply with magic 0 messages.
+    """
+    __slots__ = ('topic', 'partition', 'data', 'offsets', 'attributes',
+                 'key_starts', 'key_lengths', 'value_starts', 'value_lengths')
+
+    def __init__(self, topic, partition, data='', offsets=None,
+                 attributes=None, key_starts=None, key_lengths=None,
+                 value_starts=None, value_lengths=None):
+        self.topic = topic
+        self.partition = partition
+        self.data = data
+        self.offsets = array(OFFSET_TYPECODE, offsets or ())
+        self.attributes = array('B', attributes or ())
+        self.key_starts = array('l', key_starts or ())
+        self.key_lengths = array('l', key_lengths or ())
+        self.value_starts = array('l', value_starts or ())
+        self.value_lengths = array('l', value_lengths or ())
+
+    def __repr__(self):
+        return '<MessageBatch topic={} partition={} messages={}>'.format(
+            self.topic, self.partition, len(self.offsets))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for i in xrange(len(self.offsets)):
+            yield self._sourced_message(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MessageBatch(
+                self.topic, self.partition, self.data,
+                self.offsets[index], self.attributes[index],
+                self.key_starts[index], self.key_lengths[index],
+                self.value_starts[index], self.value_lengths[index])
+        if index < 0:
+            index += len(self.offsets)
+        if not 0 <= index < len(self.offsets):
+            raise IndexError('MessageBatch index out of range')
+        return self._sourced_message(index)
+
+    def key(self, index):
+        """Return the key of the message at index, or None if null"""
+        return self._bytes(self.key_starts[index], self.key_lengths[index])
+
+    def value(self, index):
+        """Return the value of the message at index, or None if null"""
+        return self._bytes(
+            self.value_starts[index], self.value_lengths[index])
+
+    def keys(self):
+        """Iterate over the keys of the messages in the batch"""
+        for start, length in zip(self.key_starts, self.key_lengths):
+            yield self._bytes(start, length)
+
+    def values(self):
+        """Iterate over the values of the messages in the batch"""
+        for start, length in zip(self.value_starts, self.value_lengths):
+            yield self._bytes(start, length)
+
+    def _bytes(self, start, length):
+        if length == -1:
+            return None
+        return str(buffer(self.data, start, length))
+
+    def _sourced_message(self, index):
+        # Always magic 0, see above
+        return SourcedMessage(
+            self.topic, self.partition, self.offsets[index],
+            Message(0, self.attributes[index], self.key(index),
+                    self.value(index)))
+
 
 #################
 #   Exceptions  #
@@ -99,6 +195,21 @@ class DuplicateRequestError(KafkaError):
     """
 
 
+class RequestQueueFullError(KafkaError):
+    """
+    Error caused by calling makeRequest() while a broker client's queue of
+    unsent requests is full
+    """
+    def __init__(self, message=None, deferred=None):
+        """Create a RequestQueueFullError exception
+
+        deferred is an optional argument which fires when the queue has room
+        for more requests.
+        """
+        super(RequestQueueFullError, self).__init__(message)
+        self.deferred = deferred
+
+
 class BrokerResponseError(KafkaError):
     pass
 
@@ -213,7 +324,17 @@ class BufferUnderflowError(KafkaError):
 
 
 class ChecksumError(KafkaError):
-    pass
+    """
+    Error caused by a fetched message whose CRC doesn't match its contents
+    """
+    def __init__(self, message=None, batch=None):
+        """Create a ChecksumError exception
+
+        batch is an optional :class:`MessageBatch` of the messages decoded
+        before the bad one, which can still be delivered.
+        """
+        super(ChecksumError, self).__init__(message)
+        self.batch = batch
 
 
 class ConsumerFetchSizeTooSmall(KafkaError):
@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 import sys
 import logging
+from bisect import bisect_left
 from numbers import Integral
 
 from twisted.python.failure import Failure
@@ -13,13 +14,15 @@ from twisted.internet.task import LoopingCall
 from twisted.internet.defer import Deferred, maybeDeferred, CancelledError
 from twisted.internet.defer import succeed, fail
 
+from afkak.kafkacodec import KafkaCodec, CRC_CHECK_ALL, validate_check_crcs
 from afkak.common import (
-    SourcedMessage, FetchRequest, OffsetRequest, OffsetFetchRequest,
-    OffsetCommitRequest,
+    SourcedMessage, MessageBatch, FetchRequest, OffsetRequest,
+    OffsetFetchRequest, OffsetCommitRequest,
     KafkaError, ConsumerFetchSizeTooSmall, InvalidConsumerGroupError,
-    OperationInProgress,
+    ChecksumError, OperationInProgress,
     OFFSET_EARLIEST, OFFSET_LATEST, OFFSET_COMMITTED, TIMESTAMP_INVALID,
 )
+from afkak.timingwheel import TimingWheel
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -112,6 +115,22 @@ class Consumer(object):
         Maximum number of attempts to make for any request. Default of zero
         means retry forever; other values must be positive and indicate
         the number of attempts to make before returning failure.
+    :ivar bool message_batches:
+        If true, the processor is passed a :class:`afkak.common.MessageBatch`
+        rather than a list of :class:`afkak.common.SourcedMessage`. A batch
+        can be indexed, sliced and iterated like the list, but holds its
+        messages in columns over the fetched buffer, which is much cheaper
+        for high-volume partitions. Defaults to false.
+    :ivar decode_pool:
+        Optional :class:`multiprocessing.Pool` in whose worker processes
+        large fetched message sets are decoded, so that decoding them doesn't
+        block the reactor. See :meth:`KafkaClient.send_fetch_request`.
+    :ivar check_crcs:
+        Which fetched messages to verify the CRCs of:
+        :data:`afkak.kafkacodec.CRC_CHECK_ALL` (the default),
+        :data:`afkak.kafkacodec.CRC_CHECK_OUTER` to trust the messages inside
+        compressed messages, whose own CRCs cover them, or a number between
+        0 and 1, the fraction of messages to verify, at random.
 
     """
     def __init__(self, client, topic, partition, processor,
@@ -125,7 +144,9 @@ class Consumer(object):
                  max_buffer_size=None,
                  request_retry_init_delay=REQUEST_RETRY_MIN_DELAY,
                  request_retry_max_delay=REQUEST_RETRY_MAX_DELAY,
-                 request_retry_max_attempts=0):
+                 request_retry_max_attempts=0,
+                 message_batches=False, decode_pool=None,
+                 check_crcs=CRC_CHECK_ALL):
         # Store away parameters
         self.client = client  # KafkaClient
         self.topic = topic  # The topic from which we consume
@@ -172,6 +193,10 @@ class Consumer(object):
             raise ValueError(
                 'request_retry_max_attempts must be non-negative integer')
         self._fetch_attempt_count = 1
+        self.message_batches = message_batches
+        self.decode_pool = decode_pool
+        validate_check_crcs(check_crcs)
+        self.check_crcs = check_crcs
 
         # # Internal state tracking attributes
         self._fetch_offset = None  # We don't know at what offset to fetch yet
@@ -398,10 +423,14 @@ class Consumer(object):
                 self._commit_ds.append(d)
 
     def _get_clock(self):
-        # Reactor to use for callLater
+        # Reactor to use for callLater, or our client's timing wheel
         if self._clock is None:
-            from twisted.internet import reactor
-            self._clock = reactor
+            wheel = getattr(self.client, 'timing_wheel', None)
+            if isinstance(wheel, TimingWheel):
+                self._clock = wheel
+            else:
+                from twisted.internet import reactor
+                self._clock = reactor
         return self._clock
 
     def _retry_fetch(self, after=None):
@@ -684,7 +713,24 @@ class Consumer(object):
                         "%r: Got response with partition: %r not our own: %r",
                         self, resp.partition, self.partition)
                     continue
-                # resp.messages is a KafkaCodec._decode_message_set_iter
+                if isinstance(resp.messages, MessageBatch):
+                    # Decoded by the client's decode_pool
+                    messages = self._add_batch(resp.messages, messages)
+                    continue
+                if self.message_batches and self.decode_pool is None:
+                    try:
+                        batch = KafkaCodec.decode_message_set_batch(
+                            self.topic, self.partition, resp.messages,
+                            check_crcs=self.check_crcs)
+                    except ChecksumError as e:
+                        # Deliver the messages before the bad one, as
+                        # iterating over the message set would
+                        messages = self._add_batch(e.batch, messages)
+                        raise
+                    messages = self._add_batch(batch, messages)
+                    continue
+                # resp.messages is a KafkaCodec._decode_message_set_iter, or
+                # raises the error with which the decode_pool failed
                 # Note that 'message' here is really an OffsetAndMessage
                 for message in resp.messages:
                     # Check for messages included which are from prior to our
@@ -739,6 +785,29 @@ class Consumer(object):
         # start another fetch, if needed, but use callLater to avoid recursion
         self._retry_fetch(0)
 
+    def _add_batch(self, batch, messages):
+        """Add a MessageBatch to the messages fetched so far
+
+        Messages from before our fetch offset (which can be included due to
+        compressed message sets) are sliced off the front of the batch. The
+        batch is converted to a list of SourcedMessage unless we deliver
+        batches to the processor.
+        """
+        skip = bisect_left(batch.offsets, self._fetch_offset)
+        if skip:
+            log.debug(
+                'Skipping %d messages, because their offsets are less '
+                'than our fetch offset: %d.', skip, self._fetch_offset)
+            batch = batch[skip:]
+        if not batch:
+            return messages
+        # Update our notion of from where to fetch.
+        self._fetch_offset = batch.offsets[-1] + 1
+        if messages or not self.message_batches:
+            # We only ever expect one response for our partition
+            return list(messages) + list(batch)
+        return batch
+
     def _process_messages(self, messages):
         """Send messages to the `processor` callback to be processed
 
@@ -839,9 +908,16 @@ class Consumer(object):
                 self.topic, self.partition, self._fetch_offset,
                 self.buffer_size)
             # Send request and add handlers for the response
+            kwargs = {}
+            if self.decode_pool is not None:
+                kwargs['decode_pool'] = self.decode_pool
+            elif self.message_batches:
+                kwargs['raw_message_sets'] = True
+            if self.check_crcs != CRC_CHECK_ALL:
+                kwargs['check_crcs'] = self.check_crcs
             self._request_d = self.client.send_fetch_request(
                 [request], max_wait_time=self.fetch_max_wait_time,
-                min_bytes=self.fetch_min_bytes)
+                min_bytes=self.fetch_min_bytes, **kwargs)
             # We need a temp for this because if the response is already
             # available, _handle_fetch_response() will clear self._request_d
             d = self._request_d
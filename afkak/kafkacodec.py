@@ -4,22 +4,27 @@
 from __future__ import absolute_import
 
 import logging
-import struct
+import numbers
+import random
 import zlib
+from bisect import bisect_left
 
 from .codec import (
-    gzip_encode, gzip_decode, snappy_encode, snappy_decode
+    gzip_encode, gzip_decode, gzip_decode_iter, snappy_encode, snappy_decode,
+    lz4_encode, lz4_decode, GZIP_DEFAULT_LEVEL,
 )
 from .common import (
     BrokerMetadata, PartitionMetadata, Message, OffsetAndMessage,
-    ProduceResponse, FetchResponse, OffsetResponse, TopicMetadata,
-    OffsetCommitResponse, OffsetFetchResponse, ProtocolError,
+    MessageBatch, ProduceResponse, FetchResponse, OffsetResponse,
+    TopicMetadata, OffsetCommitResponse, OffsetFetchResponse, ProtocolError,
     BufferUnderflowError, ChecksumError, ConsumerFetchSizeTooSmall,
     UnsupportedCodecError, InvalidMessageError, ConsumerMetadataResponse,
 )
 from .util import (
-    read_short_string, read_int_string, relative_unpack,
-    write_short_string, write_int_string, group_by_topic_and_partition
+    read_short_string, read_int_string_bounds, relative_unpack,
+    relative_pack, short_string_size, int_string_size,
+    write_short_string_into, write_int_string_into,
+    group_by_topic_and_partition, get_struct, INT16, INT32, INT64,
 )
 
 log = logging.getLogger(__name__)
@@ -29,13 +34,69 @@ ATTRIBUTE_CODEC_MASK = 0x03
 CODEC_NONE = 0x00
 CODEC_GZIP = 0x01
 CODEC_SNAPPY = 0x02
-ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY)
+CODEC_LZ4 = 0x03
+ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4)
 MAX_BROKERS = 1024
 
+# Policies for verifying the CRCs of fetched messages. A number between 0 and
+# 1 may be given instead, to verify that fraction of messages, at random.
+CRC_CHECK_ALL = 'all'  # Verify every message
+CRC_CHECK_OUTER = 'outer'  # Trust messages inside verified compressed ones
+
 # Default number of msecs the lead-broker will wait for replics to
 # ack produce requests before failing the request
 DEFAULT_REPLICAS_ACK_TIMEOUT_MSECS = 1000
 
+# Message values of at least this many bytes are not copied into the
+# request by encode_produce_request_sequence(), but handed to the transport
+# as they are (which still copies them once, joining its write buffer)
+SCATTER_VALUE_SIZE = 16 * 1024
+
+# Precompiled layouts of the fixed-size parts of the wire protocol. Each is
+# compiled once here, rather than a format string being parsed (and often
+# built) on every encode/decode call. Variable-length fields are written as
+# a length from INT16/INT32 followed by the raw bytes.
+_REQUEST_HEADER = get_struct('>hhih')  # ApiKey ApiVersion CorrId ClientIdLen
+_INT32_PAIR = get_struct('>ii')  # CorrelationId/Count, Partition/Size, etc
+_PRODUCE_HEADER = get_struct('>hii')  # Acks Timeout TopicCount
+_FETCH_HEADER = get_struct('>iiii')  # ReplicaId MaxWait MinBytes TopicCount
+_PARTITION_OFFSET_SIZE = get_struct('>iqi')  # Partition Offset/Time MaxSize
+_PARTITION_ERROR_OFFSET = get_struct('>ihq')  # Partition Error Offset
+_PARTITION_ERROR_COUNT = get_struct('>ihi')  # Partition Error NumOffsets
+_PARTITION_ERROR = get_struct('>ih')  # Partition Error
+_PARTITION_OFFSET = get_struct('>iq')  # Partition Offset
+_COMMIT_PARTITION = get_struct('>iqq')  # Partition Offset Timestamp
+_OFFSET_SIZE = get_struct('>qi')  # MessageSet entry: Offset MessageSize
+_MESSAGE_HEADER = get_struct('>iBB')  # Crc MagicByte Attributes
+_METADATA_PARTITION = get_struct('>hiii')  # Error Partition Leader NReplicas
+_CORRELATION_ERROR_NODE = get_struct('>ihi')  # CorrId Error NodeId
+
+
+def _should_check_crc(check_crcs, nested):
+    """Whether to verify the CRC of a message, under the check_crcs policy"""
+    if check_crcs == CRC_CHECK_ALL:
+        return True
+    if check_crcs == CRC_CHECK_OUTER:
+        return not nested
+    return random.random() < check_crcs
+
+
+def validate_check_crcs(check_crcs):
+    """Raise ValueError unless check_crcs is a CRC verification policy"""
+    if check_crcs in (CRC_CHECK_ALL, CRC_CHECK_OUTER):
+        return
+    if (isinstance(check_crcs, numbers.Real) and
+            not isinstance(check_crcs, bool) and 0 <= check_crcs <= 1):
+        return
+    raise ValueError("check_crcs: %r unsupported" % (check_crcs,))
+
+
+def _copy_bytes(data, start, length):
+    """Copy `length` bytes at `start` out of `data`, or None if null (-1)"""
+    if length == -1:
+        return None
+    return str(buffer(data, start, length))
+
 
 class KafkaCodec(object):
     """
@@ -62,12 +123,33 @@ class KafkaCodec(object):
         """
         Encode the common request envelope
         """
-        return struct.pack('>hhih%ds' % len(client_id),
-                           request_key,          # ApiKey
-                           api_version,          # ApiVersion
-                           correlation_id,       # CorrelationId
-                           len(client_id),       # ClientId size
-                           client_id)            # ClientId
+        buf = bytearray(cls._message_header_size(client_id))
+        cls._write_message_header(buf, 0, client_id, correlation_id,
+                                  request_key, api_version)
+        return bytes(buf)
+
+    @classmethod
+    def _message_header_size(cls, client_id):
+        """
+        Return the encoded size of the common request envelope
+        """
+        return _REQUEST_HEADER.size + len(client_id)
+
+    @classmethod
+    def _write_message_header(cls, buf, cur, client_id, correlation_id,
+                              request_key, api_version=0):
+        """
+        Write the common request envelope into the bytearray buf at cur,
+        returning the offset just past it
+        """
+        cur = relative_pack(_REQUEST_HEADER, buf, cur,
+                            request_key,          # ApiKey
+                            api_version,          # ApiVersion
+                            correlation_id,       # CorrelationId
+                            len(client_id))       # ClientId size
+        end = cur + len(client_id)
+        buf[cur:end] = client_id                  # ClientId
+        return end
 
     @classmethod
     def _encode_message_set(cls, messages, offset=None):
@@ -79,18 +161,84 @@ class KafkaCodec(object):
               Offset => int64
               MessageSize => int32
         """
-        message_set = ""
+        buf = bytearray(cls._message_set_size(messages))
+        cls._write_message_set(buf, 0, messages, offset)
+        return bytes(buf)
+
+    @classmethod
+    def _message_set_size(cls, messages):
+        """
+        Return the encoded size of a MessageSet of the given messages
+        """
+        size = 0
+        for message in messages:
+            size += (_OFFSET_SIZE.size + _MESSAGE_HEADER.size +
+                     int_string_size(message.key) +
+                     int_string_size(message.value))
+        return size
+
+    @classmethod
+    def _write_message_set(cls, buf, cur, messages, offset=None):
+        """
+        Write a MessageSet into the bytearray buf at cur, returning the
+        offset just past it. buf must have been sized with
+        :meth:`_message_set_size`.
+        """
         incr = 1
         if offset is None:
             incr = 0
             offset = 0
         for message in messages:
-            encoded_message = KafkaCodec._encode_message(message)
-            message_set += struct.pack(
-                '>qi%ds' % len(encoded_message), offset, len(encoded_message),
-                encoded_message)
+            msg_start = cur + _OFFSET_SIZE.size
+            cur = KafkaCodec._write_message(buf, msg_start, message)
+            # Now we know the size, go back and fill in the entry header
+            _OFFSET_SIZE.pack_into(buf, msg_start - _OFFSET_SIZE.size,
+                                   offset, cur - msg_start)
             offset += incr
-        return message_set
+        return cur
+
+    @classmethod
+    def _scattered_values(cls, messages):
+        """
+        Return the values of messages which are left out of the buffer by
+        :meth:`_write_message_set_scattered`
+        """
+        return [message.value for message in messages
+                if isinstance(message.value, str) and
+                len(message.value) >= SCATTER_VALUE_SIZE]
+
+    @classmethod
+    def _write_message_set_scattered(cls, buf, cur, messages, splits):
+        """
+        Write a MessageSet into the bytearray buf at cur, as
+        :meth:`_write_message_set`, except that each value given by
+        :meth:`_scattered_values` is left out. Instead, a (position, value)
+        pair is appended to splits, where the value belongs in the encoding.
+        buf must have been sized for the MessageSet, less those values.
+        """
+        for message in messages:
+            msg_start = cur + _OFFSET_SIZE.size
+            value = message.value
+            if not isinstance(value, str) or len(value) < SCATTER_VALUE_SIZE:
+                cur = KafkaCodec._write_message(buf, msg_start, message)
+                msg_size = cur - msg_start
+            else:
+                if message.magic != 0:
+                    raise ProtocolError(
+                        "Unexpected magic number: %d" % message.magic)
+                cur = relative_pack(_MESSAGE_HEADER, buf, msg_start,
+                                    0, message.magic, message.attributes)
+                cur = write_int_string_into(buf, cur, message.key)
+                cur = relative_pack(INT32, buf, cur, len(value))
+                # The CRC runs on from the buffered fields over the value
+                crc = zlib.crc32(
+                    buffer(buf, msg_start + 4, cur - msg_start - 4))
+                INT32.pack_into(buf, msg_start, zlib.crc32(value, crc))
+                splits.append((cur, value))
+                msg_size = cur - msg_start + len(value)
+            _OFFSET_SIZE.pack_into(buf, msg_start - _OFFSET_SIZE.size,
+                                   0, msg_size)
+        return cur
 
     @classmethod
     def _encode_message(cls, message):
@@ -107,18 +255,33 @@ class KafkaCodec(object):
               Key => bytes
               Value => bytes
         """
-        if message.magic == 0:
-            msg = struct.pack('>BB', message.magic, message.attributes)
-            msg += write_int_string(message.key)
-            msg += write_int_string(message.value)
-            crc = zlib.crc32(msg)
-            msg = struct.pack('>i%ds' % len(msg), crc, msg)
-        else:
+        buf = bytearray(_MESSAGE_HEADER.size + int_string_size(message.key) +
+                        int_string_size(message.value))
+        cls._write_message(buf, 0, message)
+        return bytes(buf)
+
+    @classmethod
+    def _write_message(cls, buf, cur, message):
+        """
+        Write a single message into the bytearray buf at cur, returning the
+        offset just past it. See :meth:`_encode_message` for the format.
+        """
+        if message.magic != 0:
             raise ProtocolError("Unexpected magic number: %d" % message.magic)
-        return msg
+        start = cur
+        # The CRC covers everything after it, so it's filled in last
+        cur = relative_pack(_MESSAGE_HEADER, buf, cur,
+                            0, message.magic, message.attributes)
+        cur = write_int_string_into(buf, cur, message.key)
+        cur = write_int_string_into(buf, cur, message.value)
+        crc = zlib.crc32(buffer(buf, start + 4, cur - start - 4))
+        INT32.pack_into(buf, start, crc)
+        return cur
 
     @classmethod
-    def _decode_message_set_iter(cls, data):
+    def _decode_message_set_iter(cls, data, start=0, end=None,
+                                 min_offset=None, check_crcs=CRC_CHECK_ALL,
+                                 nested=False):
         """
         Iteratively decode a MessageSet
 
@@ -126,14 +289,35 @@ class KafkaCodec(object):
         to decode a single message. Since compressed messages contain futher
         MessageSets, these two methods have been decoupled so that they may
         recurse easily.
+
+        The message set is decoded in place: `start` and `end` delimit the
+        message set within `data` (which may be a whole response frame), so
+        no intermediate copies of the message set or its messages are made.
+
+        Messages with offsets less than `min_offset`, if given, are skipped
+        without being decoded. `check_crcs` is the CRC verification policy,
+        and `nested` is true for the MessageSet of a compressed message.
         """
-        cur = 0
+        if end is None:
+            end = len(data)
+        cur = start
         read_message = False
-        while cur < len(data):
+        while cur < end:
             try:
-                ((offset, ), cur) = relative_unpack('>q', data, cur)
-                (msg, cur) = read_int_string(data, cur)
-                msgIter = KafkaCodec._decode_message(msg, offset)
+                if end < cur + 12:
+                    raise BufferUnderflowError("Not enough data left")
+                (offset, msg_size) = _OFFSET_SIZE.unpack_from(data, cur)
+                cur += 12
+                if msg_size < 0 or end < cur + msg_size:
+                    raise BufferUnderflowError("Not enough data left")
+                msg_start, cur = cur, cur + msg_size
+                if min_offset is not None and offset < min_offset:
+                    # A compressed message's offset is that of its last
+                    # inner message, so this skips only unwanted messages.
+                    continue
+                msgIter = KafkaCodec._decode_message(
+                    data, offset, msg_start, cur, min_offset, check_crcs,
+                    nested)
                 for (offset, message) in msgIter:
                     read_message = True
                     yield OffsetAndMessage(offset, message)
@@ -154,7 +338,152 @@ class KafkaCodec(object):
                     raise StopIteration()
 
     @classmethod
-    def _decode_message(cls, data, offset):
+    def _message_bounds(cls, data, start=0, end=None, check_crc=True,
+                        offset=None):
+        """
+        Check the CRC of the Message delimited by `start` and `end` within
+        `data` (if `check_crc`), and return (magic, attributes, key_start,
+        key_length, value_start, value_length), with a length of -1 for a
+        null field. The message's `offset` is only used to report errors.
+        """
+        if end is None:
+            end = len(data)
+        if end < start + 6:
+            raise BufferUnderflowError("Not enough data left")
+        (crc, magic, att) = _MESSAGE_HEADER.unpack_from(data, start)
+        # zlib.crc32() can't read a memoryview under Python 2, but it can
+        # read a buffer(), which is just as copy-free.
+        if check_crc and \
+                crc != zlib.crc32(buffer(data, start + 4, end - start - 4)):
+            raise ChecksumError(
+                "Message checksum failed at offset {}".format(offset))
+
+        (key_start, key_len, cur) = read_int_string_bounds(
+            data, start + 6, end)
+        (value_start, value_len, cur) = read_int_string_bounds(
+            data, cur, end)
+        return (magic, att, key_start, key_len, value_start, value_len)
+
+    @classmethod
+    def _batch_message_set(cls, batch, chunks, data, start=0, end=None,
+                           check_crcs=CRC_CHECK_ALL, nested=False):
+        """
+        Append the messages of a MessageSet to the columns of `batch`
+
+        Like _decode_message_set_iter(), but rather than building a tuple
+        per message the offset, attributes and key/value bounds of each are
+        appended to the batch's arrays. Compressed MessageSets are
+        decompressed and appended to `chunks`, as the batch's bounds can
+        only refer to one buffer; the list of (chunk, first_index) pairs is
+        reconciled by decode_message_set_batch().
+        """
+        if end is None:
+            end = len(data)
+        chunks.append((data, len(batch.offsets)))
+        cur = start
+        read_message = False
+        while cur < end:
+            try:
+                if end < cur + 12:
+                    raise BufferUnderflowError("Not enough data left")
+                (offset, msg_size) = _OFFSET_SIZE.unpack_from(data, cur)
+                cur += 12
+                if msg_size < 0 or end < cur + msg_size:
+                    raise BufferUnderflowError("Not enough data left")
+                msg_start, cur = cur, cur + msg_size
+                (_, att, key_start, key_len, value_start, value_len) = \
+                    KafkaCodec._message_bounds(
+                        data, msg_start, cur,
+                        _should_check_crc(check_crcs, nested), offset)
+
+                codec = att & ATTRIBUTE_CODEC_MASK
+                if codec == CODEC_NONE:
+                    batch.offsets.append(offset)
+                    batch.attributes.append(att)
+                    batch.key_starts.append(key_start)
+                    batch.key_lengths.append(key_len)
+                    batch.value_starts.append(value_start)
+                    batch.value_lengths.append(value_len)
+                    read_message = True
+                    continue
+                elif codec == CODEC_GZIP:
+                    inner = gzip_decode(buffer(data, value_start, value_len))
+                elif codec == CODEC_SNAPPY:
+                    inner = snappy_decode(
+                        buffer(data, value_start, value_len))
+                elif codec == CODEC_LZ4:
+                    inner = lz4_decode(buffer(data, value_start, value_len))
+                else:
+                    continue
+                read_message = KafkaCodec._batch_message_set(
+                    batch, chunks, inner, check_crcs=check_crcs,
+                    nested=True) or read_message
+                chunks.append((data, len(batch.offsets)))
+            except BufferUnderflowError:
+                # Same semantics as _decode_message_set_iter()
+                if read_message is False:
+                    raise ConsumerFetchSizeTooSmall()
+                break
+        return read_message
+
+    @classmethod
+    def _decode_message_set_stream(cls, chunks, min_offset=None,
+                                   check_crcs=CRC_CHECK_ALL):
+        """
+        Iteratively decode a MessageSet delivered in pieces
+
+        Like _decode_message_set_iter(), but `chunks` is an iterable of
+        consecutive pieces of the MessageSet, such as gzip_decode_iter()
+        produces. Each message is decoded as soon as all of it has arrived,
+        and only the (partial) message at the end of the pieces so far is
+        retained. Messages with offsets less than `min_offset` are skipped
+        without being buffered or decoded. As only compressed messages are
+        streamed, the messages are nested for the `check_crcs` policy.
+        """
+        buf = bytearray()
+        skip = 0  # Bytes of a skipped message yet to arrive
+        read_message = False
+        for chunk in chunks:
+            if skip:
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                chunk = buffer(chunk, skip)
+                skip = 0
+            buf += chunk
+            cur = 0
+            end = len(buf)
+            while end >= cur + 12:
+                (offset, msg_size) = _OFFSET_SIZE.unpack_from(buf, cur)
+                if msg_size < 0:
+                    raise BufferUnderflowError("Not enough data left")
+                msg_start = cur + 12
+                msg_end = msg_start + msg_size
+                if min_offset is not None and offset < min_offset:
+                    if msg_end > end:
+                        skip = msg_end - end
+                        msg_end = end
+                    cur = msg_end
+                    continue
+                if msg_end > end:
+                    break
+                for (offset, message) in KafkaCodec._decode_message(
+                        buf, offset, msg_start, msg_end, min_offset,
+                        check_crcs, True):
+                    read_message = True
+                    yield OffsetAndMessage(offset, message)
+                cur = msg_end
+            del buf[:cur]
+
+        if buf or skip:
+            # Same semantics as _decode_message_set_iter()
+            if read_message is False:
+                raise ConsumerFetchSizeTooSmall()
+
+    @classmethod
+    def _decode_message(cls, data, offset, start=0, end=None,
+                        min_offset=None, check_crcs=CRC_CHECK_ALL,
+                        nested=False):
         """
         Decode a single Message
 
@@ -162,33 +491,132 @@ class KafkaCodec(object):
         They are decoupled to support nested messages (compressed MessageSets).
         The offset is actually read from decode_message_set_iter (it is part
         of the MessageSet payload).
-        """
-        ((crc, magic, att), cur) = relative_unpack('>iBB', data, 0)
-        if crc != zlib.crc32(data[4:]):
-            raise ChecksumError("Message checksum failed")
 
-        (key, cur) = read_int_string(data, cur)
-        (value, cur) = read_int_string(data, cur)
+        `start` and `end` delimit the message within `data`. The CRC is
+        computed over a zero-copy view of the message, and the key and value
+        are each copied out of `data` exactly once.
+
+        The MessageSet of a gzip-compressed message is decoded as it is
+        inflated, with messages before `min_offset` skipped.
+
+        Whether the CRC is verified depends on the `check_crcs` policy, and
+        on whether the message is `nested` within a compressed message.
+        """
+        (magic, att, key_start, key_len, value_start, value_len) = \
+            KafkaCodec._message_bounds(
+                data, start, end, _should_check_crc(check_crcs, nested),
+                offset)
 
         codec = att & ATTRIBUTE_CODEC_MASK
 
         if codec == CODEC_NONE:
+            key = _copy_bytes(data, key_start, key_len)
+            value = _copy_bytes(data, value_start, value_len)
             yield (offset, Message(magic, att, key, value))
 
         elif codec == CODEC_GZIP:
-            gz = gzip_decode(value)
-            for (offset, msg) in KafkaCodec._decode_message_set_iter(gz):
+            chunks = gzip_decode_iter(buffer(data, value_start, value_len))
+            for (offset, msg) in KafkaCodec._decode_message_set_stream(
+                    chunks, min_offset, check_crcs):
                 yield (offset, msg)
 
         elif codec == CODEC_SNAPPY:
-            snp = snappy_decode(value)
-            for (offset, msg) in KafkaCodec._decode_message_set_iter(snp):
+            snp = snappy_decode(buffer(data, value_start, value_len))
+            for (offset, msg) in KafkaCodec._decode_message_set_iter(
+                    snp, min_offset=min_offset, check_crcs=check_crcs,
+                    nested=True):
+                yield (offset, msg)
+
+        elif codec == CODEC_LZ4:
+            unlz4 = lz4_decode(buffer(data, value_start, value_len))
+            for (offset, msg) in KafkaCodec._decode_message_set_iter(
+                    unlz4, min_offset=min_offset, check_crcs=check_crcs,
+                    nested=True):
                 yield (offset, msg)
 
     ##################
     #   Public API   #
     ##################
 
+    @classmethod
+    def decode_message_set_batch(cls, topic, partition, data, start=0,
+                                 end=None, check_crcs=CRC_CHECK_ALL):
+        """
+        Decode a MessageSet into a :class:`afkak.common.MessageBatch`
+
+        The keys and values of uncompressed messages are not copied: the
+        batch refers to them where they lie in `data`. Compressed messages
+        are decompressed, and when a MessageSet mixes uncompressed messages
+        with compressed ones (or contains several compressed ones), the
+        pieces are joined into a single buffer for the batch.
+
+        :param str topic: topic the MessageSet was fetched from
+        :param int partition: partition the MessageSet was fetched from
+        :param data: buffer holding the MessageSet
+        :param int start: offset of the MessageSet within `data`
+        :param int end: end of the MessageSet within `data`, or None
+        :param check_crcs: CRC verification policy: :const:`CRC_CHECK_ALL`,
+            :const:`CRC_CHECK_OUTER`, or the fraction of messages to verify
+        :raises ConsumerFetchSizeTooSmall: if `data` doesn't hold at least
+            one complete message
+        :raises ChecksumError: if a verified message's CRC doesn't match.
+            Its `batch` holds the messages before the bad one, as
+            :meth:`_decode_message_set_iter` would have yielded them.
+        """
+        if end is None:
+            end = len(data)
+        batch = MessageBatch(topic, partition, data)
+        chunks = []
+        try:
+            cls._batch_message_set(batch, chunks, data, start, end,
+                                   check_crcs)
+        except ChecksumError as e:
+            e.batch = cls._join_batch_chunks(batch, chunks)
+            raise
+        return cls._join_batch_chunks(batch, chunks)
+
+    @classmethod
+    def _join_batch_chunks(cls, batch, chunks):
+        """
+        Point the bounds of `batch` into a single buffer, given the chunks
+        _batch_message_set() appended its messages from, and return it
+        """
+        # Each (chunk, first) pair says that the messages from index first
+        # up to the next pair's first refer to chunk.
+        count = len(batch.offsets)
+        spans = []
+        for i, (chunk, first) in enumerate(chunks):
+            last = chunks[i + 1][1] if i + 1 < len(chunks) else count
+            if last > first:
+                if spans and spans[-1][0] is chunk:
+                    spans[-1][2] = last
+                else:
+                    spans.append([chunk, first, last])
+
+        if len(spans) == 1:
+            batch.data = spans[0][0]
+        elif len(spans) > 1:
+            pieces = []
+            base = 0
+            for chunk, first, last in spans:
+                # Only copy the part of the chunk which holds the messages
+                lo = min(min(batch.key_starts[first:last]),
+                         min(batch.value_starts[first:last]))
+                hi = max(max(s + max(n, 0) for s, n in zip(
+                    batch.key_starts[first:last],
+                    batch.key_lengths[first:last])),
+                    max(s + max(n, 0) for s, n in zip(
+                        batch.value_starts[first:last],
+                        batch.value_lengths[first:last])))
+                pieces.append(str(buffer(chunk, lo, hi - lo)))
+                shift = base - lo
+                for i in xrange(first, last):
+                    batch.key_starts[i] += shift
+                    batch.value_starts[i] += shift
+                base += hi - lo
+            batch.data = b''.join(pieces)
+        return batch
+
     @classmethod
     def get_response_correlation_id(cls, data):
         """
@@ -196,7 +624,7 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
+        ((correlation_id,), cur) = relative_unpack(INT32, data, 0)
         return correlation_id
 
     @classmethod
@@ -222,24 +650,94 @@ class KafkaCodec(object):
             Maximum time the server will wait for acks from replicas.  This is
             _not_ a socket timeout.
         """
+        buf, _ = cls._write_produce_request(
+            client_id, correlation_id, payloads, acks, timeout)
+        return bytes(buf)
+
+    @classmethod
+    def encode_produce_request_sequence(
+            cls, client_id, correlation_id, payloads=None, acks=1,
+            timeout=DEFAULT_REPLICAS_ACK_TIMEOUT_MSECS):
+        """
+        Encode some ProduceRequest structs as a list of strings
+
+        The strings concatenate to the result of
+        :meth:`encode_produce_request` with the same arguments, and are
+        meant to be written with ``transport.writeSequence()``. Message
+        values of at least :data:`SCATTER_VALUE_SIZE` bytes appear in the
+        list as the original value objects, so their bytes are not copied
+        into the encoded request. Twisted's transports join the strings
+        written into one before sending, so they are still copied once
+        there. Only ``str`` values are passed through; other values are
+        copied as usual.
+
+        :param bytes client_id:
+        :param int correlation_id:
+        :param list payloads: list of ProduceRequest
+        :param int acks: as for :meth:`encode_produce_request`
+        :param int timeout: as for :meth:`encode_produce_request`
+        """
+        buf, splits = cls._write_produce_request(
+            client_id, correlation_id, payloads, acks, timeout, scatter=True)
+        sequence = []
+        cur = 0
+        for split, value in splits:
+            sequence.append(str(buffer(buf, cur, split - cur)))
+            sequence.append(value)
+            cur = split
+        sequence.append(str(buffer(buf, cur)))
+        return sequence
+
+    @classmethod
+    def _write_produce_request(cls, client_id, correlation_id, payloads,
+                               acks, timeout, scatter=False):
+        """
+        Encode a produce request into a bytearray, returning it and a list
+        of (position, value) pairs of the values left out of it, as
+        :meth:`_write_message_set_scattered` describes, if scatter is set.
+        """
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.PRODUCE_KEY)
-
-        message += struct.pack('>hii', acks, timeout, len(grouped_payloads))
+        # Size the whole request first, so it can be encoded directly into
+        # a single buffer, rather than by repeated concatenation
+        size = cls._message_header_size(client_id) + _PRODUCE_HEADER.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += short_string_size(topic) + INT32.size
+            for payload in topic_payloads.values():
+                size += (_INT32_PAIR.size +
+                         cls._message_set_size(payload.messages))
+                if scatter:
+                    size -= sum(len(value) for value in
+                                cls._scattered_values(payload.messages))
+
+        splits = []
+        buf = bytearray(size)
+        cur = cls._write_message_header(buf, 0, client_id, correlation_id,
+                                        KafkaCodec.PRODUCE_KEY)
+        cur = relative_pack(_PRODUCE_HEADER, buf, cur,
+                            acks, timeout, len(grouped_payloads))
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += struct.pack('>h%dsi' % len(topic),
-                                   len(topic), topic, len(topic_payloads))
+            cur = write_short_string_into(buf, cur, topic)
+            cur = relative_pack(INT32, buf, cur, len(topic_payloads))
 
             for partition, payload in topic_payloads.items():
-                msg_set = KafkaCodec._encode_message_set(payload.messages)
-                message += struct.pack('>ii%ds' % len(msg_set), partition,
-                                       len(msg_set), msg_set)
+                set_start = cur + _INT32_PAIR.size
+                if scatter:
+                    n_splits = len(splits)
+                    cur = KafkaCodec._write_message_set_scattered(
+                        buf, set_start, payload.messages, splits)
+                    set_size = cur - set_start + sum(
+                        len(value) for _, value in splits[n_splits:])
+                else:
+                    cur = KafkaCodec._write_message_set(
+                        buf, set_start, payload.messages)
+                    set_size = cur - set_start
+                _INT32_PAIR.pack_into(buf, set_start - _INT32_PAIR.size,
+                                      partition, set_size)
 
-        return struct.pack('>%ds' % len(message), message)
+        return buf, splits
 
     @classmethod
     def decode_produce_response(cls, data):
@@ -248,16 +746,15 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, num_topics), cur) = relative_unpack(
+            _INT32_PAIR, data, 0)
 
         for i in range(num_topics):
-            ((strlen,), cur) = relative_unpack('>h', data, cur)
-            topic = data[cur:cur + strlen]
-            cur += strlen
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            (topic, cur) = read_short_string(data, cur)
+            ((num_partitions,), cur) = relative_unpack(INT32, data, cur)
             for i in range(num_partitions):
-                ((partition, error, offset), cur) = relative_unpack('>ihq',
-                                                                    data, cur)
+                ((partition, error, offset), cur) = relative_unpack(
+                    _PARTITION_ERROR_OFFSET, data, cur)
 
                 yield ProduceResponse(topic, partition, error, offset)
 
@@ -278,68 +775,113 @@ class KafkaCodec(object):
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.FETCH_KEY)
-
         assert isinstance(max_wait_time, int)
 
+        size = cls._message_header_size(client_id) + _FETCH_HEADER.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += (short_string_size(topic) + INT32.size +
+                     len(topic_payloads) * _PARTITION_OFFSET_SIZE.size)
+
+        buf = bytearray(size)
+        cur = cls._write_message_header(buf, 0, client_id, correlation_id,
+                                        KafkaCodec.FETCH_KEY)
+
         # -1 is the replica id
-        message += struct.pack('>iiii', -1, max_wait_time, min_bytes,
-                               len(grouped_payloads))
+        cur = relative_pack(_FETCH_HEADER, buf, cur, -1, max_wait_time,
+                            min_bytes, len(grouped_payloads))
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = write_short_string_into(buf, cur, topic)
+            cur = relative_pack(INT32, buf, cur, len(topic_payloads))
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqi', partition, payload.offset,
-                                       payload.max_bytes)
+                cur = relative_pack(_PARTITION_OFFSET_SIZE, buf, cur,
+                                    partition, payload.offset,
+                                    payload.max_bytes)
 
-        return struct.pack('>%ds' % len(message), message)
+        return bytes(buf)
 
     @classmethod
-    def decode_fetch_response(cls, data):
+    def decode_fetch_response(cls, data, raw_message_sets=False,
+                              min_offsets=None, check_crcs=CRC_CHECK_ALL):
         """
         Decode bytes to a FetchResponse
 
         :param bytes data: bytes to decode
+        :param bool raw_message_sets:
+            If true, the messages of each FetchResponse are left undecoded, as
+            a zero-copy buffer of the MessageSet, for the caller to decode
+            with :meth:`decode_message_set_batch` or otherwise.
+        :param dict min_offsets:
+            Optional mapping of (topic, partition) to the offset which was
+            fetched. Messages before it, which the broker may return as part
+            of a compressed message, are skipped without being decoded.
+        :param check_crcs:
+            Which messages to verify the CRCs of: :const:`CRC_CHECK_ALL`
+            (the default), :const:`CRC_CHECK_OUTER` to trust the messages
+            inside compressed messages, whose own CRCs cover them, or a
+            number between 0 and 1, the fraction of messages to verify, at
+            random.
+            The ChecksumError raised for a failed verification gives the
+            offset of the message.
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, num_topics), cur) = relative_unpack(
+            _INT32_PAIR, data, 0)
 
         for i in range(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack(INT32, data, cur)
 
             for i in range(num_partitions):
                 ((partition, error, highwater_mark_offset), cur) = \
-                    relative_unpack('>ihq', data, cur)
-
-                (message_set, cur) = read_int_string(data, cur)
-
+                    relative_unpack(_PARTITION_ERROR_OFFSET, data, cur)
+
+                # Don't copy the message set out of the response, just note
+                # where it is and decode it in place.
+                (set_start, set_len, cur) = read_int_string_bounds(data, cur)
+                set_end = set_start + max(set_len, 0)
+
+                if raw_message_sets:
+                    yield FetchResponse(
+                        topic, partition, error, highwater_mark_offset,
+                        buffer(data, set_start, set_end - set_start))
+                    continue
+
+                min_offset = None
+                if min_offsets:
+                    min_offset = min_offsets.get((topic, partition))
                 yield FetchResponse(
                     topic, partition, error,
                     highwater_mark_offset,
-                    KafkaCodec._decode_message_set_iter(message_set))
+                    KafkaCodec._decode_message_set_iter(
+                        data, set_start, set_end, min_offset, check_crcs))
 
     @classmethod
     def encode_offset_request(cls, client_id, correlation_id, payloads=None):
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.OFFSET_KEY)
+        size = cls._message_header_size(client_id) + _INT32_PAIR.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += (short_string_size(topic) + INT32.size +
+                     len(topic_payloads) * _PARTITION_OFFSET_SIZE.size)
+
+        buf = bytearray(size)
+        cur = cls._write_message_header(buf, 0, client_id, correlation_id,
+                                        KafkaCodec.OFFSET_KEY)
 
         # -1 is the replica id
-        message += struct.pack('>ii', -1, len(grouped_payloads))
+        cur = relative_pack(_INT32_PAIR, buf, cur, -1, len(grouped_payloads))
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = write_short_string_into(buf, cur, topic)
+            cur = relative_pack(INT32, buf, cur, len(topic_payloads))
 
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqi', partition, payload.time,
-                                       payload.max_offsets)
+                cur = relative_pack(_PARTITION_OFFSET_SIZE, buf, cur,
+                                    partition, payload.time,
+                                    payload.max_offsets)
 
-        return struct.pack('>%ds' % len(message), message)
+        return bytes(buf)
 
     @classmethod
     def decode_offset_response(cls, data):
@@ -348,19 +890,20 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, num_topics), cur) = relative_unpack(
+            _INT32_PAIR, data, 0)
 
         for i in range(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack(INT32, data, cur)
 
             for i in range(num_partitions):
                 ((partition, error, num_offsets,), cur) = \
-                    relative_unpack('>ihi', data, cur)
+                    relative_unpack(_PARTITION_ERROR_COUNT, data, cur)
 
                 offsets = []
                 for j in range(num_offsets):
-                    ((offset,), cur) = relative_unpack('>q', data, cur)
+                    ((offset,), cur) = relative_unpack(INT64, data, cur)
                     offsets.append(offset)
 
                 yield OffsetResponse(topic, partition, error, tuple(offsets))
@@ -375,15 +918,21 @@ class KafkaCodec(object):
         :param list topics: list of bytes
         """
         topics = [] if topics is None else topics
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.METADATA_KEY)
 
-        message += struct.pack('>i', len(topics))
+        size = cls._message_header_size(client_id) + INT32.size
+        for topic in topics:
+            size += short_string_size(topic)
+
+        buf = bytearray(size)
+        cur = cls._write_message_header(buf, 0, client_id, correlation_id,
+                                        KafkaCodec.METADATA_KEY)
+
+        cur = relative_pack(INT32, buf, cur, len(topics))
 
         for topic in topics:
-            message += struct.pack('>h%ds' % len(topic), len(topic), topic)
+            cur = write_short_string_into(buf, cur, topic)
 
-        return message
+        return bytes(buf)
 
     @classmethod
     def decode_metadata_response(cls, data):
@@ -392,7 +941,8 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id, numbrokers), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, numbrokers), cur) = relative_unpack(
+            _INT32_PAIR, data, 0)
 
         # In testing, I saw this routine swap my machine to death when
         # passed bad data. So, some checks are in order...
@@ -403,30 +953,33 @@ class KafkaCodec(object):
         # Broker info
         brokers = {}
         for i in range(numbrokers):
-            ((nodeId, ), cur) = relative_unpack('>i', data, cur)
+            ((nodeId, ), cur) = relative_unpack(INT32, data, cur)
             (host, cur) = read_short_string(data, cur)
-            ((port,), cur) = relative_unpack('>i', data, cur)
+            ((port,), cur) = relative_unpack(INT32, data, cur)
             brokers[nodeId] = BrokerMetadata(nodeId, host, port)
 
         # Topic info
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+        ((num_topics,), cur) = relative_unpack(INT32, data, cur)
         topic_metadata = {}
 
         for i in range(num_topics):
-            ((topic_error,), cur) = relative_unpack('>h', data, cur)
+            ((topic_error,), cur) = relative_unpack(INT16, data, cur)
             (topic_name, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack(INT32, data, cur)
             partition_metadata = {}
 
             for j in range(num_partitions):
                 ((partition_error_code, partition, leader, numReplicas),
-                 cur) = relative_unpack('>hiii', data, cur)
+                 cur) = relative_unpack(_METADATA_PARTITION, data, cur)
 
+                # Replica/ISR lists are short, and repeat the same few
+                # lengths, so get_struct() caches a Struct for each length
                 (replicas, cur) = relative_unpack(
-                    '>%di' % numReplicas, data, cur)
+                    get_struct('>%di' % numReplicas), data, cur)
 
-                ((num_isr,), cur) = relative_unpack('>i', data, cur)
-                (isr, cur) = relative_unpack('>%di' % num_isr, data, cur)
+                ((num_isr,), cur) = relative_unpack(INT32, data, cur)
+                (isr, cur) = relative_unpack(
+                    get_struct('>%di' % num_isr), data, cur)
 
                 partition_metadata[partition] = \
                     PartitionMetadata(
@@ -448,13 +1001,14 @@ class KafkaCodec(object):
         :param int correlation_id: int
         :param bytes consumer_group: string
         """
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaCodec.CONSUMER_METADATA_KEY)
+        buf = bytearray(cls._message_header_size(client_id) +
+                        short_string_size(consumer_group))
+        cur = cls._write_message_header(buf, 0, client_id, correlation_id,
+                                        KafkaCodec.CONSUMER_METADATA_KEY)
 
-        message += struct.pack('>h%ds' % len(consumer_group),
-                               len(consumer_group), consumer_group)
+        write_short_string_into(buf, cur, consumer_group)
 
-        return message
+        return bytes(buf)
 
     @classmethod
     def decode_consumermetadata_response(cls, data):
@@ -464,9 +1018,9 @@ class KafkaCodec(object):
         :param bytes data: bytes to decode
         """
         (correlation_id, error_code, node_id), cur = \
-            relative_unpack('>ihi', data, 0)
+            relative_unpack(_CORRELATION_ERROR_NODE, data, 0)
         host, cur = read_short_string(data, cur)
-        (port,), cur = relative_unpack('>i', data, cur)
+        (port,), cur = relative_unpack(INT32, data, cur)
 
         return ConsumerMetadataResponse(
             error_code, node_id, host, port)
@@ -487,25 +1041,35 @@ class KafkaCodec(object):
         """
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(
-            client_id, correlation_id, KafkaCodec.OFFSET_COMMIT_KEY,
+        size = (cls._message_header_size(client_id) +
+                short_string_size(group) + INT32.size +
+                short_string_size(consumer_id) + INT32.size)
+        for topic, topic_payloads in grouped_payloads.items():
+            size += short_string_size(topic) + INT32.size
+            for payload in topic_payloads.values():
+                size += (_COMMIT_PARTITION.size +
+                         short_string_size(payload.metadata))
+
+        buf = bytearray(size)
+        cur = cls._write_message_header(
+            buf, 0, client_id, correlation_id, KafkaCodec.OFFSET_COMMIT_KEY,
             api_version=1)
 
-        message += write_short_string(group)
-        message += struct.pack('>i', group_generation_id)
-        message += write_short_string(consumer_id)
-        message += struct.pack('>i', len(grouped_payloads))
+        cur = write_short_string_into(buf, cur, group)
+        cur = relative_pack(INT32, buf, cur, group_generation_id)
+        cur = write_short_string_into(buf, cur, consumer_id)
+        cur = relative_pack(INT32, buf, cur, len(grouped_payloads))
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = write_short_string_into(buf, cur, topic)
+            cur = relative_pack(INT32, buf, cur, len(topic_payloads))
 
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqq', partition, payload.offset,
-                                       payload.timestamp)
-                message += write_short_string(payload.metadata)
+                cur = relative_pack(_COMMIT_PARTITION, buf, cur, partition,
+                                    payload.offset, payload.timestamp)
+                cur = write_short_string_into(buf, cur, payload.metadata)
 
-        return struct.pack('>%ds' % len(message), message)
+        return bytes(buf)
 
     @classmethod
     def decode_offset_commit_response(cls, data):
@@ -514,15 +1078,16 @@ class KafkaCodec(object):
 
         :param bytes data: bytes to decode
         """
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+        ((correlation_id, num_topics), cur) = relative_unpack(
+            _INT32_PAIR, data, 0)
 
         for i in xrange(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack(INT32, data, cur)
 
             for i in xrange(num_partitions):
-                ((partition, error), cur) = relative_unpack('>ih', data, cur)
+                ((partition, error), cur) = relative_unpack(
+                    _PARTITION_ERROR, data, cur)
                 yield OffsetCommitResponse(topic, partition, error)
 
     @classmethod
@@ -537,21 +1102,29 @@ class KafkaCodec(object):
         :param list payloads: list of :class:`OffsetFetchRequest`
         """
         grouped_payloads = group_by_topic_and_partition(payloads)
-        message = cls._encode_message_header(
-            client_id, correlation_id, KafkaCodec.OFFSET_FETCH_KEY,
+
+        size = (cls._message_header_size(client_id) +
+                short_string_size(group) + INT32.size)
+        for topic, topic_payloads in grouped_payloads.items():
+            size += (short_string_size(topic) + INT32.size +
+                     len(topic_payloads) * INT32.size)
+
+        buf = bytearray(size)
+        cur = cls._write_message_header(
+            buf, 0, client_id, correlation_id, KafkaCodec.OFFSET_FETCH_KEY,
             api_version=1)
 
-        message += write_short_string(group)
-        message += struct.pack('>i', len(grouped_payloads))
+        cur = write_short_string_into(buf, cur, group)
+        cur = relative_pack(INT32, buf, cur, len(grouped_payloads))
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = write_short_string_into(buf, cur, topic)
+            cur = relative_pack(INT32, buf, cur, len(topic_payloads))
 
-            for partition, payload in topic_payloads.items():
-                message += struct.pack('>i', partition)
+            for partition in topic_payloads:
+                cur = relative_pack(INT32, buf, cur, partition)
 
-        return struct.pack('>%ds' % len(message), message)
+        return bytes(buf)
 
     @classmethod
     def decode_offset_fetch_response(cls, data):
@@ -561,22 +1134,55 @@ class KafkaCodec(object):
         :param bytes data: bytes to decode
         """
 
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+        ((correlation_id, num_topics), cur) = relative_unpack(
+            _INT32_PAIR, data, 0)
 
         for i in range(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack(INT32, data, cur)
 
             for i in range(num_partitions):
-                ((partition, offset), cur) = relative_unpack('>iq', data, cur)
+                ((partition, offset), cur) = relative_unpack(
+                    _PARTITION_OFFSET, data, cur)
                 (metadata, cur) = read_short_string(data, cur)
-                ((error,), cur) = relative_unpack('>h', data, cur)
+                ((error,), cur) = relative_unpack(INT16, data, cur)
 
                 yield OffsetFetchResponse(topic, partition, offset,
                                           metadata, error)
 
 
+def _decode_message_set_batch_task(topic, partition, data, min_offset=None,
+                                   check_crcs=CRC_CHECK_ALL):
+    """
+    Decode a MessageSet into a MessageBatch, in a worker process
+
+    Messages before `min_offset` are dropped. To save sending a copy of
+    `data` back to the caller, who has it already, the batch's data is set to
+    None if it would be `data` itself. Rather than raising, returns (True,
+    batch) on success and (False, exception) on failure, as the
+    multiprocessing.Pool.apply_async() callback only hears of success. The
+    batch of a ChecksumError is trimmed likewise.
+    """
+    def trim(batch):
+        if min_offset is not None:
+            skip = bisect_left(batch.offsets, min_offset)
+            if skip:
+                batch = batch[skip:]
+        if batch.data is data:
+            batch.data = None
+        return batch
+
+    try:
+        batch = KafkaCodec.decode_message_set_batch(
+            topic, partition, data, check_crcs=check_crcs)
+    except ChecksumError as e:
+        e.batch = trim(e.batch)
+        return (False, e)
+    except Exception as e:
+        return (False, e)
+    return (True, trim(batch))
+
+
 def create_message(payload, key=None):
     """
     Construct a :class:`Message`
@@ -587,7 +1193,7 @@ def create_message(payload, key=None):
     return Message(0, 0, key, payload)
 
 
-def create_gzip_message(message_set):
+def create_gzip_message(message_set, compresslevel=GZIP_DEFAULT_LEVEL):
     """
     Construct a gzip-compressed message containing multiple messages
 
@@ -595,16 +1201,17 @@ def create_gzip_message(message_set):
     message to Kafka.
 
     :param list message_set: a list of :class:`Message` instances
+    :param int compresslevel: the zlib compression level, 0-9
     """
     encoded_message_set = KafkaCodec._encode_message_set(message_set)
 
-    gzipped = gzip_encode(encoded_message_set)
+    gzipped = gzip_encode(encoded_message_set, compresslevel)
     codec = ATTRIBUTE_CODEC_MASK & CODEC_GZIP
 
     return Message(0, 0x00 | codec, None, gzipped)
 
 
-def create_snappy_message(message_set):
+def create_snappy_message(message_set, xerial_blocksize=None):
     """
     Construct a Snappy-compressed message containing multiple messages
 
@@ -612,16 +1219,41 @@ def create_snappy_message(message_set):
     message to Kafka.
 
     :param list message_set: a list of :class:`Message` instances
+    :param int xerial_blocksize:
+        If given, frame the compressed data in xerial's blocking format, as
+        the Java client does, with blocks of this many uncompressed bytes
     """
     encoded_message_set = KafkaCodec._encode_message_set(message_set)
 
-    snapped = snappy_encode(encoded_message_set)
+    if xerial_blocksize is None:
+        snapped = snappy_encode(encoded_message_set)
+    else:
+        snapped = snappy_encode(encoded_message_set, xerial_compatible=True,
+                                xerial_blocksize=xerial_blocksize)
     codec = ATTRIBUTE_CODEC_MASK & CODEC_SNAPPY
 
     return Message(0, 0x00 | codec, None, snapped)
 
 
-def create_message_set(requests, codec=CODEC_NONE):
+def create_lz4_message(message_set):
+    """
+    Construct an LZ4-compressed message containing multiple messages
+
+    The given messages will be encoded, compressed, and sent as a single atomic
+    message to Kafka.
+
+    :param list message_set: a list of :class:`Message` instances
+    """
+    encoded_message_set = KafkaCodec._encode_message_set(message_set)
+
+    compressed = lz4_encode(encoded_message_set)
+    codec = ATTRIBUTE_CODEC_MASK & CODEC_LZ4
+
+    return Message(0, 0x00 | codec, None, compressed)
+
+
+def create_message_set(requests, codec=CODEC_NONE, compresslevel=None,
+                       xerial_blocksize=None):
     """
     Create a message set from a list of requests.
 
@@ -635,6 +1267,16 @@ def create_message_set(requests, codec=CODEC_NONE):
           * :const:`CODEC_NONE`
           * :const:`CODEC_GZIP`
           * :const:`CODEC_SNAPPY`
+          * :const:`CODEC_LZ4`
+
+    :param int compresslevel:
+        Compression level for :const:`CODEC_GZIP`, or `None` for the
+        codec's default.
+
+    :param int xerial_blocksize:
+        For :const:`CODEC_SNAPPY`, frame the compressed data in xerial's
+        blocking format with blocks of this many uncompressed bytes, or
+        `None` for plain snappy.
 
     :raises: :exc:`UnsupportedCodecError` for an unsupported codec
     """
@@ -645,8 +1287,14 @@ def create_message_set(requests, codec=CODEC_NONE):
     if codec == CODEC_NONE:
         return msglist
     elif codec == CODEC_GZIP:
-        return [create_gzip_message(msglist)]
+        if compresslevel is None:
+            return [create_gzip_message(msglist)]
+        return [create_gzip_message(msglist, compresslevel)]
     elif codec == CODEC_SNAPPY:
-        return [create_snappy_message(msglist)]
+        if xerial_blocksize is None:
+            return [create_snappy_message(msglist)]
+        return [create_snappy_message(msglist, xerial_blocksize)]
+    elif codec == CODEC_LZ4:
+        return [create_lz4_message(msglist)]
     else:
         raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
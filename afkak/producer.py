@@ -14,6 +14,8 @@ from twisted.internet.defer import (
     CancelledError as tid_CancelledError,
     )
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
 from .common import (
     ProduceRequest, UnsupportedCodecError, NoResponseError,
@@ -25,7 +27,10 @@ from .common import (
     PRODUCER_ACK_NOT_REQUIRED,
     )
 from .partitioner import (RoundRobinPartitioner)
-from .kafkacodec import CODEC_NONE, ALL_CODECS, create_message_set
+from .kafkacodec import (
+    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, ALL_CODECS, create_message_set,
+    )
+from .timingwheel import TimingWheel
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -53,6 +58,21 @@ class Producer(object):
     req_retries:
         Number of times we will retry a request to Kafka before failing the
         request.
+    codec:
+        The codec with which to compress message sets: CODEC_NONE (the
+        default), CODEC_GZIP, CODEC_SNAPPY or CODEC_LZ4. May also be a tuple of
+        (CODEC_GZIP, level) to choose the zlib compression level: 1 is
+        fastest, 9 (the default) compresses best.
+    xerial_blocksize:
+        If set with CODEC_SNAPPY, message sets are framed in xerial's blocking
+        format, as the Java client sends them, with blocks of this many bytes
+        of uncompressed data (the xerial library uses 32768).
+    compression_threads:
+        If non-zero, message sets are compressed in a pool of up to this
+        many threads, rather than on the reactor thread. Message sets for
+        different topic/partitions are compressed in parallel, as zlib and
+        snappy release the GIL while compressing. Has no effect without a
+        codec.
     batch_send:
         If True, messages are sent in batches.
     batch_every_n:
@@ -78,6 +98,8 @@ class Producer(object):
                  max_req_attempts=DEFAULT_REQ_ATTEMPTS,
                  retry_interval=INIT_RETRY_INTERVAL,
                  codec=None,
+                 compression_threads=0,
+                 xerial_blocksize=None,
                  batch_send=False,
                  batch_every_n=BATCH_SEND_MSG_COUNT,
                  batch_every_b=BATCH_SEND_MSG_BYTES,
@@ -139,6 +161,15 @@ class Producer(object):
         self._batch_send_d = None  # Outstanding client request to send msgs
 
         # Are we compressing messages, or just sending 'raw'?
+        codec_level = None
+        if isinstance(codec, tuple):
+            codec, codec_level = codec
+            if codec != CODEC_GZIP:
+                raise ValueError("Codec: %r has no compression level" % codec)
+            if not isinstance(codec_level, Integral) or \
+                    not 0 <= codec_level <= 9:
+                raise ValueError(
+                    "Compression level: %r unsupported" % codec_level)
         if codec is None:
             codec = CODEC_NONE
         elif codec not in ALL_CODECS:
@@ -146,6 +177,25 @@ class Producer(object):
                 raise TypeError("Codec: %r unsupported" % codec)
             raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
         self.codec = codec
+        self.codec_level = codec_level
+        if xerial_blocksize is not None:
+            if codec != CODEC_SNAPPY:
+                raise ValueError(
+                    "Codec: %r has no xerial block size" % codec)
+            if not isinstance(xerial_blocksize, Integral) or \
+                    xerial_blocksize <= 0:
+                raise ValueError(
+                    "xerial_blocksize: %r unsupported" % xerial_blocksize)
+        self.xerial_blocksize = xerial_blocksize
+
+        # Compress in a thread pool, rather than on the reactor thread?
+        if not isinstance(compression_threads, Integral) or \
+                compression_threads < 0:
+            raise ValueError("compression_threads: %r unsupported" %
+                             compression_threads)
+        self.compression_threads = compression_threads
+        self._compression_pool = None  # Created when first needed
+        self._compression_pool_trigger = None  # Reactor shutdown trigger
 
     def __repr__(self):
         return '<Producer {}:{}:{}:{}>'.format(self.partitioner_class,
@@ -199,16 +249,68 @@ class Producer(object):
                 self.sendLooper.stop()
         # Make sure requests that wasn't cancelled above are now
         self._cancel_outstanding()
+        # Stop our compression threads, if we started any
+        if self._compression_pool is not None:
+            self._get_reactor().removeSystemEventTrigger(
+                self._compression_pool_trigger)
+            self._compression_pool.stop()
+            self._compression_pool = self._compression_pool_trigger = None
 
     # # Private Methods # #
 
     def _get_clock(self):
-        # Reactor to use for connecting, callLater, etc [test]
+        # Reactor to use for connecting, callLater, etc [test], or the
+        # timing wheel of our client
         if self._clock is None:
-            from twisted.internet import reactor
-            self._clock = reactor
+            wheel = getattr(self.client, 'timing_wheel', None)
+            if isinstance(wheel, TimingWheel):
+                self._clock = wheel
+            else:
+                from twisted.internet import reactor
+                self._clock = reactor
         return self._clock
 
+    def _get_reactor(self):
+        # Reactor to hand work to and from threads with [test]: our clock,
+        # or that of the timing wheel it is
+        clock = self._get_clock()
+        if isinstance(clock, TimingWheel):
+            return clock._get_clock()
+        return clock
+
+    def _get_compression_pool(self):
+        # Thread pool in which to compress message sets, started on first use
+        if self._compression_pool is None:
+            reactor = self._get_reactor()
+            pool = ThreadPool(minthreads=0,
+                              maxthreads=self.compression_threads,
+                              name='afkak-producer-compression')
+            pool.start()
+            self._compression_pool_trigger = reactor.addSystemEventTrigger(
+                'during', 'shutdown', pool.stop)
+            self._compression_pool = pool
+        return self._compression_pool
+
+    def _compress_in_threads(self, reqsByTopicPart):
+        """Create the message sets for each topic/partition in our thread pool
+
+        Returns a Deferred which fires with a list of (TopicAndPartition,
+        message set) pairs once all have been created, or with the first
+        failure.
+        """
+        reactor = self._get_reactor()
+        pool = self._get_compression_pool()
+        topicParts = reqsByTopicPart.keys()
+        d_list = [deferToThreadPool(reactor, pool, create_message_set,
+                                    reqsByTopicPart[topicPart], self.codec,
+                                    self.codec_level, self.xerial_blocksize)
+                  for topicPart in topicParts]
+        d = DeferredList(d_list, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(
+            lambda results: zip(topicParts, [r for (_, r) in results]),
+            lambda f: f.value.subFailure)
+        return d
+
     def _send_timer_failed(self, fail):
         """
         Our _send_batch() function called by the LoopingCall failed. Some
@@ -311,16 +413,30 @@ class Producer(object):
         # payloads as a list to the client for sending to the various
         # brokers. The finest granularity of success/failure is at the
         # payload (topic/partition) level.
+        if not reqsByTopicPart:
+            return
+        if self.compression_threads and self.codec != CODEC_NONE:
+            # Compress off the reactor thread, then send
+            d = self._compress_in_threads(reqsByTopicPart)
+            d.addCallbacks(self._send_payloads, self._fail_requests,
+                           (payloadsByTopicPart, deferredsByTopicPart),
+                           errbackArgs=(deferredsByTopicPart,))
+            return d
+        msgSets = [(topicPart, create_message_set(reqs, self.codec,
+                                                  self.codec_level,
+                                                  self.xerial_blocksize))
+                   for topicPart, reqs in reqsByTopicPart.items()]
+        return self._send_payloads(msgSets, payloadsByTopicPart,
+                                   deferredsByTopicPart)
+
+    def _send_payloads(self, msgSets, payloadsByTopicPart,
+                       deferredsByTopicPart):
+        """Send the (TopicAndPartition, message set) pairs to Kafka"""
         payloads = []
-        for (topic, partition), reqs in reqsByTopicPart.items():
-            msgSet = create_message_set(reqs, self.codec)
-            req = ProduceRequest(topic, partition, msgSet)
-            topicPart = TopicAndPartition(topic, partition)
+        for topicPart, msgSet in msgSets:
+            req = ProduceRequest(topicPart.topic, topicPart.partition, msgSet)
             payloads.append(req)
             payloadsByTopicPart[topicPart] = req
-        # Make sure we have some payloads to send
-        if not payloads:
-            return
         # send the request
         d = self.client.send_produce_request(
             payloads, acks=self.req_acks, timeout=self.ack_timeout,
@@ -331,6 +447,14 @@ class Producer(object):
                   deferredsByTopicPart)
         return d
 
+    def _fail_requests(self, failure, deferredsByTopicPart):
+        """Errback the callers' deferreds, as creating the batch failed"""
+        for d_list in deferredsByTopicPart.values():
+            for d in d_list:
+                # Unless the request was cancelled
+                if not d.called:
+                    d.errback(failure)
+
     def _complete_batch_send(self, resp):
         """Complete the processing of our batch send operation
 
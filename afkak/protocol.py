@@ -4,28 +4,176 @@
 from __future__ import absolute_import
 
 import logging
+import socket
+import struct
 
 from twisted.internet.error import ConnectionDone
-from twisted.protocols.basic import Int32StringReceiver
+from twisted.protocols.basic import Int32StringReceiver, StringTooLongError
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+_LENGTH_PREFIX = struct.Struct('>i')
+
+# The socket options which can be set on broker connections
+SOCKET_OPTIONS = ('nodelay', 'keepalive', 'sndbuf', 'rcvbuf')
+_SOCKET_BUFFERS = {'sndbuf': socket.SO_SNDBUF, 'rcvbuf': socket.SO_RCVBUF}
+
+
+def check_socket_options(options):
+    """Raise ValueError unless options is a valid dict of socket options"""
+    if options is None:
+        return
+    for name, value in options.iteritems():
+        if name not in SOCKET_OPTIONS:
+            raise ValueError("socket option: %r unsupported" % (name,))
+        if name in _SOCKET_BUFFERS and (
+                not isinstance(value, (int, long)) or value <= 0):
+            raise ValueError("socket option %s: %r unsupported" % (
+                name, value))
+
 
 class KafkaProtocol(Int32StringReceiver):
     """
-    Very thin wrapper around the Int32StringReceiver
+    Thin wrapper around the Int32StringReceiver
     Simply knows to call its factory.handleResponse()
     method with the string received by stringReceived() and
     to cleanup the factory reference when the connection is lost
+
+    Int32StringReceiver re-concatenates its buffer with every chunk that
+    arrives, which makes receiving a multi-megabyte fetch response
+    quadratic. Instead, frames which arrive whole within a chunk are sliced
+    straight out of it, while a frame spanning chunks is copied, once, into
+    a bytearray allocated at its full length when the length prefix is
+    read. The completed frame is handed on as a read-only buffer onto that
+    bytearray: slicing it yields strings, and struct and zlib read it in
+    place.
     """
     factory = None
     closing = False  # set by factory so we know to expect connectionLost
+    # Socket options to apply when connected, set by the factory, and the
+    # values then in effect, as read back from the socket
+    socketOptions = None
+    appliedSocketOptions = None
     MAX_LENGTH = 2 ** 31 - 1  # Max a signed Int32 can represent
 
+    _header = ''  # Partial length prefix carried between chunks
+    _frame = None  # The bytearray being filled with a partial frame
+    _frame_view = None  # A memoryview of _frame, to fill it in place
+    _filled = 0  # How many bytes of _frame have been received
+    _unprocessed = ''  # Data held back while paused
+
+    def dataReceived(self, data):
+        """Deliver each complete length-prefixed frame to stringReceived()
+
+        While paused, data is held back unprocessed, to be delivered when
+        resumeProducing() is called.
+        """
+        if self._unprocessed:
+            data, self._unprocessed = self._unprocessed + data, ''
+        cur = 0
+        end = len(data)
+        while cur < end and not self.paused:
+            if self._frame is not None:
+                # Continue filling a frame which spans chunks
+                size = min(len(self._frame) - self._filled, end - cur)
+                self._frame_view[self._filled:self._filled + size] = \
+                    data[cur:cur + size]
+                self._filled += size
+                cur += size
+                if self._filled == len(self._frame):
+                    frame = self._frame
+                    self._frame = self._frame_view = None
+                    self.stringReceived(buffer(frame))
+                continue
+
+            # Read the length prefix, which may itself span chunks
+            if self._header or end - cur < _LENGTH_PREFIX.size:
+                need = _LENGTH_PREFIX.size - len(self._header)
+                self._header += data[cur:cur + need]
+                cur += need
+                if len(self._header) < _LENGTH_PREFIX.size:
+                    return
+                (length,) = _LENGTH_PREFIX.unpack(self._header)
+                self._header = ''
+            else:
+                (length,) = _LENGTH_PREFIX.unpack_from(data, cur)
+                cur += _LENGTH_PREFIX.size
+            if length > self.MAX_LENGTH or length < 0:
+                self.lengthLimitExceeded(length)
+                return
+
+            if end - cur >= length:
+                # The whole frame is within this chunk
+                frame = data[cur:cur + length]
+                cur += length
+                self.stringReceived(frame)
+            else:
+                self._frame = bytearray(length)
+                self._frame_view = memoryview(self._frame)
+                self._filled = 0
+        if cur < end:
+            # Paused by stringReceived() with some of the chunk unread
+            self._unprocessed = data[cur:]
+
+    def resumeProducing(self):
+        """Resume reading, delivering any frames held back while paused"""
+        self.paused = False
+        self.transport.resumeProducing()
+        data, self._unprocessed = self._unprocessed, ''
+        self.dataReceived(data)
+
+    def connectionMade(self):
+        if self.socketOptions:
+            self.appliedSocketOptions = self._applySocketOptions(
+                self.socketOptions)
+            log.debug("Connected to Kafka Broker %r with socket options: %r",
+                      self.transport.getPeer(), self.appliedSocketOptions)
+
+    def _applySocketOptions(self, options):
+        """Set socket options on our transport, returning those in effect
+
+        The kernel may adjust the buffer sizes asked for (Linux doubles
+        them), so the values returned are read back from the socket.
+        """
+        applied = {}
+        transport = self.transport
+        try:
+            if 'nodelay' in options:
+                transport.setTcpNoDelay(options['nodelay'])
+                applied['nodelay'] = bool(transport.getTcpNoDelay())
+            if 'keepalive' in options:
+                transport.setTcpKeepAlive(options['keepalive'])
+                applied['keepalive'] = bool(transport.getTcpKeepAlive())
+            for name, opt in _SOCKET_BUFFERS.iteritems():
+                if name in options:
+                    sock = transport.getHandle()
+                    sock.setsockopt(socket.SOL_SOCKET, opt, options[name])
+                    applied[name] = sock.getsockopt(socket.SOL_SOCKET, opt)
+        except (AttributeError, socket.error) as e:
+            # Not a TCP transport, or the option was refused
+            log.warning("Failed to set socket options: %r on %r: %r",
+                        options, transport, e)
+        return applied
+
     def stringReceived(self, string):
         self.factory.handleResponse(string)
 
+    def sendSequence(self, strings):
+        """Send the concatenation of strings as one length-prefixed frame
+
+        The strings are handed to the transport's writeSequence() as they
+        are, rather than being joined into one string here. (The transport
+        joins its write buffer into one string to send it, so that is the
+        one copy made of them.)
+        """
+        length = sum(len(string) for string in strings)
+        if length > self.MAX_LENGTH:
+            raise StringTooLongError(
+                "Try to send %s bytes whereas maximum is %s" % (
+                    length, self.MAX_LENGTH))
+        self.transport.writeSequence([_LENGTH_PREFIX.pack(length)] + strings)
+
     def connectionLost(self, reason=None):
         # If we are closing, or if the connection was cleanly closed (as
         # Kafka brokers will do after 10 minutes of idle connection) we log
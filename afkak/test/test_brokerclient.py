@@ -9,6 +9,7 @@ from __future__ import division, absolute_import
 
 import struct
 import logging
+from itertools import count
 
 from mock import Mock, patch
 
@@ -28,7 +29,12 @@ from twisted.trial import unittest
 import afkak.brokerclient as brokerclient
 from afkak.brokerclient import KafkaBrokerClient
 from afkak.kafkacodec import KafkaCodec, create_message
-from afkak.common import (ClientError, DuplicateRequestError, CancelledError)
+from afkak.common import (
+    ClientError, DuplicateRequestError, CancelledError, RequestQueueFullError,
+    ConnectionError,
+)
+
+from .testutil import benchmark, time_per_call
 
 DEBUGGING = True
 setDebugging(DEBUGGING)
@@ -279,6 +285,33 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         c.connector.factory = c  # MemoryReactor doesn't make this connection.
         self.assertRaises(ClientError, c._connect)
 
+    def test_connectEagerly(self):
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('test_connectEagerly', reactor=reactor)
+        c.connect()
+        self.assertEqual(len(reactor.tcpClients), 1)
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        # Already connecting, so connect() does nothing more
+        c.connect()
+        self.assertEqual(len(reactor.tcpClients), 1)
+        c.close()
+        c.connect()
+        self.assertEqual(len(reactor.tcpClients), 1)
+
+    def test_buildProtocolResetsDelay(self):
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('test_buildProtocolResetsDelay',
+                              reactor=reactor)
+        c.connect()
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        # Failed connection attempts grow the delay between them...
+        for _ in range(3):
+            c.retry(c.connector)
+        self.assertGreater(c.delay, c.initialDelay)
+        # ...until one succeeds
+        c.buildProtocol(None)
+        self.assertEqual(c.delay, c.initialDelay)
+
     def test_connectNotify(self):
         from afkak.protocol import KafkaProtocol
         reactor = MemoryReactorClock()
@@ -428,6 +461,18 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         fail1 = eb1.call_args[0][0]  # The actual failure sent to errback
         self.assertTrue(fail1.check(CancelledError))
 
+    def test_makeRequest_sequence(self):
+        id1 = 54322
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('testmakeRequest', reactor=reactor)
+        c.proto = Mock()
+        request = ['header', 'value' * 10, 'trailer']
+        d = c.makeRequest(id1, request, expectResponse=False)
+        # A request encoded as a sequence is written as a sequence
+        c.proto.sendSequence.assert_called_once_with(request)
+        self.assertFalse(c.proto.sendString.called)
+        self.assertIsNone(self.successResultOf(d))
+
     def test_makeRequest_fails(self):
         id1 = 15432
         reactor = MemoryReactorClock()
@@ -485,6 +530,85 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         d.cancel()
         self.assertTrue(errBackCalled[0])
 
+    def test_makeRequest_maxInFlight(self):
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('test_maxInFlight', reactor=reactor,
+                              maxInFlight=2)
+        c._connect()
+        c.connector.factory = c
+        c.proto = Mock()
+        requests = [KafkaCodec.encode_fetch_request('test_maxInFlight', i)
+                    for i in range(5)]
+        ds = [c.makeRequest(i, request) for i, request in enumerate(requests)]
+        # Only two are sent, the rest wait their turn
+        self.assertEqual([args for args, _ in
+                          c.proto.sendString.call_args_list],
+                         [(requests[0],), (requests[1],)])
+        self.assertEqual(c._queuedBytes, sum(len(r) for r in requests[2:]))
+
+        # A response makes room for the next one
+        c.handleResponse(struct.pack('>i', 0))
+        self.assertEqual(self.successResultOf(ds[0]), struct.pack('>i', 0))
+        c.proto.sendString.assert_called_with(requests[2])
+        # As does cancelling one in flight
+        ds[1].addErrback(lambda f: f.trap(CancelledError))
+        ds[1].cancel()
+        c.proto.sendString.assert_called_with(requests[3])
+        self.assertEqual(c.proto.sendString.call_count, 4)
+
+        # When the connection drops, those in flight are requeued, and on
+        # reconnecting, only maxInFlight are sent
+        c.proto = None
+        c._handlePending(None)
+        self.assertEqual(c._inFlight, 0)
+        self.assertEqual(c._queuedBytes, sum(len(r) for r in requests[2:]))
+        c.proto = Mock()
+        c._sendQueued()
+        self.assertEqual([args for args, _ in
+                          c.proto.sendString.call_args_list],
+                         [(requests[2],), (requests[3],)])
+        for d in ds[2:]:
+            d.addErrback(lambda f: f.trap(CancelledError))
+        c.close()
+
+    def test_makeRequest_maxQueuedBytes(self):
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('test_maxQueuedBytes', reactor=reactor,
+                              maxQueuedBytes=25)
+        # Not connected, so requests are queued
+        d1 = c.makeRequest(1, 'x' * 10)
+        d2 = c.makeRequest(2, 'x' * 10)
+        d3 = c.makeRequest(3, 'x' * 10)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        # The third would overflow the queue, so fails fast, with a deferred
+        # which fires once there's room
+        err = self.failureResultOf(d3, RequestQueueFullError).value
+        self.assertNotIn(3, c.requests)
+        self.assertNoResult(err.deferred)
+        d1.addErrback(lambda f: f.trap(CancelledError))
+        d1.cancel()
+        self.assertIsNone(self.successResultOf(err.deferred))
+        self.assertEqual(c._queuedBytes, 10)
+
+        # Sending the queued requests makes room too
+        d4 = c.makeRequest(4, 'x' * 10)
+        err = self.failureResultOf(c.makeRequest(5, 'x' * 10),
+                                   RequestQueueFullError).value
+        c.connector.factory = c
+        c.proto = Mock()
+        c._sendQueued()
+        self.assertEqual(c._queuedBytes, 0)
+        self.assertIsNone(self.successResultOf(err.deferred))
+
+        # A request bigger than the limit is queued if it is alone
+        c.proto = None
+        d6 = c.makeRequest(6, 'x' * 30)
+        self.assertNoResult(d6)
+        for d in (d2, d4, d6):
+            d.addErrback(lambda f: f.trap(CancelledError))
+        c.close()
+
     def test_cancelRequestNoReply(self):
         id2 = 87654
         reactor = MemoryReactorClock()
@@ -568,6 +692,96 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
         # And the request should be 'sent'
         self.assertTrue(c.requests[id1].sent)
 
+    def test_socketOptions(self):
+        options = {'nodelay': True}
+        c = KafkaBrokerClient('testsocketOptions', socketOptions=options,
+                              reactor=MemoryReactorClock())
+        self.assertIsNone(c.getSocketOptions())
+        proto = c.buildProtocol(None)
+        self.assertEqual(proto.socketOptions, options)
+        transport = Mock()
+        transport.getTcpNoDelay.return_value = 1
+        proto.makeConnection(transport)
+        transport.setTcpNoDelay.assert_called_once_with(True)
+        self.assertEqual(c.getSocketOptions(), {'nodelay': True})
+        with self.assertRaises(ValueError):
+            KafkaBrokerClient('testsocketOptions', socketOptions={'x': 1})
+
+    def test_failOnDisconnect(self):
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('testfailOnDisconnect', reactor=reactor,
+                              failOnDisconnect=True, maxInFlight=1)
+        d1 = c.makeRequest(1, 'request1')
+        d2 = c.makeRequest(2, 'request2')
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        # One in flight, one queued behind it. Only the one in flight
+        # fails when the connection is lost
+        c.proto.sendString.assert_called_once_with('request1')
+        from twisted.internet.main import CONNECTION_LOST
+        c.clientConnectionLost(c.connector, Failure(CONNECTION_LOST))
+        reactor.advance(0.1)
+        self.failureResultOf(d1, ConnectionError)
+        self.assertNoResult(d2)
+        self.assertEqual(list(c.requests), [2])
+        self.assertEqual((c._inFlight, c._queuedBytes), (0, len('request2')))
+        # The queued one is sent once reconnected
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        c.proto.sendString.assert_called_once_with('request2')
+
+    def test_failOnDisconnect_connectFailed(self):
+        """
+        Requests queued while connecting are held when the attempt fails
+        """
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('testfailOnDisconnect', reactor=reactor,
+                              failOnDisconnect=True)
+        d = c.makeRequest(1, 'request1')
+        c.clientConnectionFailed(c.connector,
+                                 Failure(ConnectionRefusedError()))
+        reactor.advance(0.1)
+        self.assertNoResult(d)
+        self.assertEqual(list(c.requests), [1])
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        c.proto.sendString.assert_called_once_with('request1')
+
+    def test_requestsSentInOrder(self):
+        reactor = MemoryReactorClock()
+        c = KafkaBrokerClient('testrequestsSentInOrder', reactor=reactor)
+        requests = ['request{}'.format(i) for i in range(5)]
+        ds = [c.makeRequest(i, requests[i]) for i in range(3)]
+        # Cancelled while queued, so never sent
+        ds[1].cancel()
+        self.failureResultOf(ds[1], CancelledError)
+        c.connector.factory = c  # MemoryReactor doesn't make this connection.
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        self.assertEqual(c.proto.sendString.call_args_list,
+                         [((requests[0],),), ((requests[2],),)])
+        # Drop the connection, with those two in flight, and queue more
+        from twisted.internet.main import CONNECTION_LOST
+        c.clientConnectionLost(c.connector, Failure(CONNECTION_LOST))
+        reactor.advance(0.1)
+        d3 = c.makeRequest(3, requests[3])
+        c.makeRequest(4, requests[4])
+        c.cancelRequest(3)
+        self.failureResultOf(d3, CancelledError)
+        c.buildProtocol(None)
+        c.proto = Mock()
+        reactor.advance(0.1)
+        self.assertEqual(c.proto.sendString.call_args_list,
+                         [((requests[0],),), ((requests[2],),),
+                          ((requests[4],),)])
+        self.assertEqual(len(c._unsent), 0)
+
     def test_handleResponse(self):
         def make_fetch_response(id):
             t1 = "topic1"
@@ -648,3 +862,33 @@ class KafkaBrokerClientTestCase(unittest.TestCase):
 
         tReq = _Request(5, "data", True)
         self.assertEqual(tReq.__repr__(), '_Request:5:True')
+
+
+class KafkaBrokerClientBenchmark(unittest.TestCase):
+    """Timings for the request lifecycle. See testutil.benchmark()"""
+
+    @benchmark
+    def test_request_throughput(self):
+        # Deferred debugging captures a stack per deferred: not our costs
+        setDebugging(False)
+        self.addCleanup(setDebugging, DEBUGGING)
+        print("\n{:>12} {:>14}".format("in flight", "requests/s"))
+        for outstanding in (1, 100, 1000, 10000):
+            c = KafkaBrokerClient('bench', reactor=MemoryReactorClock())
+            proto = c.buildProtocol(None)
+            proto.makeConnection(proto_helpers.StringTransport())
+            ids = count()
+            for i in xrange(outstanding):
+                c.makeRequest(next(ids), 'request')
+
+            # Each request is sent over the loopback, and a response
+            # received for the oldest in flight
+            def request():
+                requestId = next(ids)
+                c.makeRequest(requestId, 'request')
+                proto.dataReceived(
+                    struct.pack('>ii', 4, requestId - outstanding))
+                proto.transport.clear()
+
+            per_call = time_per_call(request, 10000)
+            print("{:>12} {:>14.0f}".format(outstanding, 1 / per_call))
@@ -12,14 +12,20 @@ from copy import copy
 from twisted.trial import unittest
 from twisted.internet.base import DelayedCall
 from twisted.internet.defer import (
-    Deferred, succeed, fail, setDebugging,
+    Deferred, succeed, fail, maybeDeferred, setDebugging, inlineCallbacks,
+    returnValue, CancelledError as t_CancelledError,
     )
-from twisted.internet.error import ConnectionRefusedError
-from twisted.test.proto_helpers import MemoryReactorClock
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import (
+    ConnectionRefusedError, ConnectionLost, ConnectionDone,
+    )
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
 from twisted.names import dns
-from twisted.names.dns import RRHeader, Record_A, Record_CNAME
+from twisted.names.dns import RRHeader, Record_A, Record_AAAA, Record_CNAME
 from twisted.names.error import DNSNameError
 
+import collections
 import struct
 import logging
 
@@ -36,11 +42,17 @@ from afkak.common import (
     DefaultKafkaPort, LeaderUnavailableError, PartitionUnavailableError,
     FailedPayloadsError, NotLeaderForPartitionError, OffsetAndMessage,
     UnknownTopicOrPartitionError, ConsumerCoordinatorNotAvailableError,
-    NotCoordinatorForConsumerError,
+    NotCoordinatorForConsumerError, MessageBatch, SourcedMessage,
+    ConsumerFetchSizeTooSmall, ConnectionError, ChecksumError,
 )
 from afkak.kafkacodec import (create_message, KafkaCodec)
-from afkak.client import _collect_hosts, _get_IP_addresses
+from afkak.test.test_kafkacodec import create_encoded_metadata_response
+from afkak.test.testutil import benchmark, time_per_call
+from afkak.client import (
+    _collect_hosts, _get_IP_addresses, TRAFFIC_FETCH, TRAFFIC_PRODUCE,
+)
 import afkak.client as kclient  # for patching
+from afkak.timingwheel import TimingWheel
 
 DEBUGGING = True
 setDebugging(DEBUGGING)
@@ -92,14 +104,19 @@ def brkrAndReqsForTopicAndPartition(client, topic, part=0):
 class TestKafkaClient(unittest.TestCase):
     testMetaData = createMetadataResp()
 
-    def getLeaderWrapper(self, c, *args, **kwArgs):
+    def getLeaderWrapper(self, c, topic, partition, errs=None):
+        payload = FetchRequest(topic, partition, 0, 1024)
         with patch.object(KafkaClient, '_send_broker_unaware_request',
                           side_effect=lambda a, b: succeed(self.testMetaData)):
-            d = c._get_leader_for_partition(*args)
+            d = maybeDeferred(c._payloads_by_leader, [payload])
+            # Send the metadata request queued
+            c._get_clock().advance(0)
 
-        if 'errs' not in kwArgs:
-            return self.successResultOf(d)
-        return self.failureResultOf(d, kwArgs['errs'])
+        if errs is None:
+            [(leader, payloads)] = self.successResultOf(d).items()
+            self.assertEqual(payloads, [payload])
+            return leader
+        return self.failureResultOf(d, errs)
 
     def test_repr(self):
         c = KafkaClient('kafka.example.com', clientId='MyClient')
@@ -107,11 +124,23 @@ class TestKafkaClient(unittest.TestCase):
         self.assertEqual(c.__repr__(), "<KafkaClient clientId=MyClient "
                          "brokers=[('kafka.example.com', 9092)] timeout=10.0>")
 
+    def test_socket_options(self):
+        options = {'rcvbuf': 4 * 1024 * 1024}
+        c = KafkaClient('kafka.example.com', socket_options=options)
+        broker = c._get_brokerclient('kafka.example.com', 9092)
+        self.assertEqual(broker.socketOptions, options)
+        broker.close()
+        with self.assertRaises(ValueError):
+            KafkaClient('kafka.example.com', socket_options={'rcvbuf': -1})
+
     def test_update_cluster_hosts(self):
         c = KafkaClient(hosts='www.example.com')
+        c._dns_cache['meep.org'] = (float('inf'), ['10.0.0.1'])
         c.update_cluster_hosts('meep.org')
         self.assertEqual(c._hosts, 'meep.org')
         self.assertEqual(c._collect_hosts_d, True)
+        # Resolved afresh, not from the cache
+        self.assertEqual(c._dns_cache, {})
 
     def test_send_broker_unaware_request_fail(self):
         """
@@ -244,6 +273,35 @@ class TestKafkaClient(unittest.TestCase):
             self.failUnlessFailure(respD, KafkaUnavailableError))
         self.assertTrue(cbArg[0].check(RequestTimedOutError))
 
+    def test_make_request_to_broker_timing_wheel(self):
+        """test_make_request_to_broker_timing_wheel
+        Test that request timeouts are scheduled on the timing wheel
+        """
+        d = Deferred()
+        mocked_brokers = {('kafka31', 9092): MagicMock()}
+        mocked_brokers[('kafka31', 9092)].makeRequest.return_value = d
+        mocked_brokers[(
+            'kafka31', 9092)].cancelRequest.side_effect = \
+            lambda rId, reason: d.errback(reason)
+
+        reactor = MemoryReactorClock()
+        wheel = TimingWheel(reactor=reactor)
+        client = KafkaClient(hosts='kafka31:9092', reactor=reactor,
+                             timing_wheel=wheel)
+        client.clients = mocked_brokers
+        client._collect_hosts_d = None
+        respD = client._send_broker_unaware_request(1, 'fake request')
+        self.assertEqual(len(wheel.getDelayedCalls()), 2)
+        self.assertEqual(len(reactor.getDelayedCalls()), 1)
+        reactor.advance(client.timeout + 1)  # fire the timeout errback
+        self.successResultOf(
+            self.failUnlessFailure(respD, KafkaUnavailableError))
+        self.assertEqual(wheel.getDelayedCalls(), [])
+
+    def test_bad_timing_wheel(self):
+        with self.assertRaises(TypeError):
+            KafkaClient(hosts='kafka31:9092', timing_wheel=MemoryReactorClock())
+
     def test_make_request_to_broker_alerts_when_blocked(self):
         """test_make_request_to_broker_alerts_when_blocked
         Test that a blocked reactor will cause an error to be logged.
@@ -377,12 +435,14 @@ class TestKafkaClient(unittest.TestCase):
             }
             return succeed(None)
 
+        payload = FetchRequest(T1, 0, 0, 1024)
         with patch.object(KafkaClient, 'load_metadata_for_topics',
                           side_effect=fake_lmdft) as lmdft:
-            # Call _get_leader_for_partition and ensure it
+            # Look up the payload's leader and ensure it
             # calls load_metadata_for_topics
-            leader = client._get_leader_for_partition('topic_no_partitions', 0)
-            self.assertEqual(brokers[0], self.successResultOf(leader))
+            d = client._payloads_by_leader([payload])
+            self.assertEqual({brokers[0]: [payload]},
+                             self.successResultOf(d))
             lmdft.assert_called_once_with('topic_no_partitions')
 
     @patch('afkak.client.KafkaCodec')
@@ -404,7 +464,8 @@ class TestKafkaClient(unittest.TestCase):
 
         with patch.object(KafkaClient, '_send_broker_unaware_request',
                           side_effect=lambda a, b: succeed(self.testMetaData)):
-            client = KafkaClient(hosts=['broker_1:4567'], timeout=None)
+            client = KafkaClient(hosts=['broker_1:4567'], timeout=None,
+                                 reactor=MemoryReactorClock())
 
         self.assertDictEqual({}, client.topics_to_brokers)
 
@@ -419,14 +480,14 @@ class TestKafkaClient(unittest.TestCase):
         self.assertEqual(eFail.args, fail1.value.args)
 
     @patch('afkak.client.KafkaCodec')
-    def test_get_leader_returns_none_when_noleader(self, kCodec):
+    def test_get_leader_raises_when_noleader(self, kCodec):
         """
-        test_get_leader_returns_none_when_noleader
-        Confirm that _get_leader_for_partition() returns None when
-        the partiion has no leader.
+        test_get_leader_raises_when_noleader
+        Confirm that _payloads_by_leader() raises LeaderUnavailableError
+        when a partition has no leader.
         Test by creating a client, patch afkak.client.KafkaCodec to return
         our special metadata, patch _send_broker_unaware_request to avoid
-        making a connection, and then confirm that None is returned.
+        making a connection, and then confirm that the error is raised.
         """
 
         brokers = {}
@@ -442,12 +503,10 @@ class TestKafkaClient(unittest.TestCase):
         kCodec.decode_metadata_response.return_value = (brokers, topics)
 
         client = KafkaClient(hosts=['broker_1:4567', 'broker_2:5678'],
-                             timeout=None)
+                             timeout=None, reactor=MemoryReactorClock())
 
-        with patch.object(KafkaClient, '_send_broker_unaware_request',
-                          side_effect=lambda a, b: succeed(
-                              self.testMetaData)):
-            client._get_leader_for_partition('topic_noleader', 0)
+        self.getLeaderWrapper(client, 'topic_noleader', 0,
+                              errs=LeaderUnavailableError)
         self.assertDictEqual(
             {
                 TopicAndPartition('topic_noleader', 0): None,
@@ -455,10 +514,10 @@ class TestKafkaClient(unittest.TestCase):
             },
             client.topics_to_brokers)
 
-        self.assertIsNone(
-            self.getLeaderWrapper(client, 'topic_noleader', 0))
-        self.assertIsNone(
-            self.getLeaderWrapper(client, 'topic_noleader', 1))
+        self.getLeaderWrapper(client, 'topic_noleader', 0,
+                              errs=LeaderUnavailableError)
+        self.getLeaderWrapper(client, 'topic_noleader', 1,
+                              errs=LeaderUnavailableError)
 
         topics['topic_noleader'] = TopicMetadata(
             'topic_noleader', 0, {
@@ -495,7 +554,8 @@ class TestKafkaClient(unittest.TestCase):
 
         with patch.object(KafkaClient, '_send_broker_unaware_request',
                           side_effect=lambda a, b: succeed(self.testMetaData)):
-            client = KafkaClient(hosts=['broker_1:4567'], timeout=None)
+            client = KafkaClient(hosts=['broker_1:4567'], timeout=None,
+                                 reactor=MemoryReactorClock())
 
             # create a list of requests (really just one)
             requests = [
@@ -504,6 +564,7 @@ class TestKafkaClient(unittest.TestCase):
             # Attempt to send it, and ensure the returned deferred fails
             # properly
             fail1 = client.send_produce_request(requests)
+            client.clock.advance(0)
             self.successResultOf(
                 self.failUnlessFailure(fail1, LeaderUnavailableError))
 
@@ -573,14 +634,55 @@ class TestKafkaClient(unittest.TestCase):
             ('localhost', 9092),
         ]))
 
+    @patch('afkak.client._get_IP_addresses')
+    def test__collect_hosts__ipv6(self, IP_addresses):
+        hosts = '[::1]:1234,[fe80::1],kafka01:9093'
+        IP_addresses.side_effect = [['::1'], ['fe80::1'], ['10.0.0.1']]
+        result = self.successResultOf(_collect_hosts(hosts))
+        self.assertEqual(set(result), set([
+            ('::1', 1234),
+            ('fe80::1', 9092),
+            ('10.0.0.1', 9093),
+        ]))
+
+    @patch('afkak.client._get_IP_addresses')
+    def test__collect_hosts__concurrent(self, IP_addresses):
+        """
+        All the names are looked up at once, each only once, and a failed
+        lookup doesn't lose the others' addresses
+        """
+        lookups = {
+            'kafka01': Deferred(),
+            'kafka02': Deferred(),
+            'kafka03': Deferred(),
+        }
+        IP_addresses.side_effect = lambda host, cache, clock: lookups[host]
+        d = _collect_hosts('kafka01,kafka02:9093,kafka03,kafka01:9093')
+        self.assertEqual(
+            [c[0][0] for c in IP_addresses.call_args_list],
+            ['kafka01', 'kafka02', 'kafka03'])
+        self.assertNoResult(d)
+
+        lookups['kafka03'].callback(['10.0.0.3'])
+        lookups['kafka02'].errback(DNSNameError('No Such Name!'))
+        self.assertNoResult(d)
+        lookups['kafka01'].callback(['10.0.0.1'])
+        self.assertEqual(set(self.successResultOf(d)), set([
+            ('10.0.0.1', 9092),
+            ('10.0.0.1', 9093),
+            ('10.0.0.3', 9092),
+        ]))
+
+    @patch('afkak.client.DNSclient.lookupIPV6Address')
     @patch('afkak.client.DNSclient.lookupAddress')
-    def test__get_IP_addresses_success(self, lookupAddress):
+    def test__get_IP_addresses_success(self, lookupAddress, lookupIPV6):
         name = 'fully.qualified.domain.name.'
         ip_address = '127.0.0.1'
         answer = RRHeader(
             name=name, type=dns.A,
             payload=Record_A(address=ip_address))
         lookupAddress.return_value = ([answer], [], [])
+        lookupIPV6.return_value = ([], [], [])
         result = self.successResultOf(_get_IP_addresses(name))
         self.assertEqual(result, [ip_address])
 
@@ -590,8 +692,13 @@ class TestKafkaClient(unittest.TestCase):
         result = self.successResultOf(_get_IP_addresses(name))
         self.assertEqual(result, [ip_address])
 
+    def test__get_IP_addresses_ipv6_addr(self):
+        result = self.successResultOf(_get_IP_addresses('fe80::1'))
+        self.assertEqual(result, ['fe80::1'])
+
+    @patch('afkak.client.DNSclient.lookupIPV6Address')
     @patch('afkak.client.DNSclient.lookupAddress')
-    def test__get_IP_addresses_cname(self, lookupAddress):
+    def test__get_IP_addresses_cname(self, lookupAddress, lookupIPV6):
         cname = 'cname.qualified.domain.name.'
         name = 'fully.qualified.domain.name.'
         ip_address = '127.0.0.1'
@@ -602,16 +709,75 @@ class TestKafkaClient(unittest.TestCase):
             name=name, type=dns.A,
             payload=Record_A(address=ip_address))
         lookupAddress.return_value = ([cname, answer], [], [])
+        lookupIPV6.return_value = ([cname], [], [])
         result = self.successResultOf(_get_IP_addresses(name))
         self.assertEqual(result, [ip_address])
 
+    @patch('afkak.client.DNSclient.lookupIPV6Address')
     @patch('afkak.client.DNSclient.lookupAddress')
-    def test__get_IP_addresses_fail(self, lookupAddress):
+    def test__get_IP_addresses_aaaa(self, lookupAddress, lookupIPV6):
+        """
+        AAAA answers are returned after the A ones, and the failure of one
+        of the lookups doesn't lose the other's answers
+        """
+        name = 'fully.qualified.domain.name.'
+        lookupAddress.return_value = ([RRHeader(
+            name=name, type=dns.A,
+            payload=Record_A(address='127.0.0.1'))], [], [])
+        lookupIPV6.return_value = ([RRHeader(
+            name=name, type=dns.AAAA,
+            payload=Record_AAAA(address='fe80::1'))], [], [])
+        result = self.successResultOf(_get_IP_addresses(name))
+        self.assertEqual(result, ['127.0.0.1', 'fe80::1'])
+
+        lookupAddress.side_effect = DNSNameError('No Such Name!')
+        result = self.successResultOf(_get_IP_addresses(name))
+        self.assertEqual(result, ['fe80::1'])
+
+    @patch('afkak.client.DNSclient.lookupIPV6Address')
+    @patch('afkak.client.DNSclient.lookupAddress')
+    def test__get_IP_addresses_fail(self, lookupAddress, lookupIPV6):
         name = 'nosuch.qualified.domain.name.'
         lookupAddress.side_effect = DNSNameError('No Such Name!')
+        lookupIPV6.side_effect = DNSNameError('No Such Name!')
         result = self.successResultOf(_get_IP_addresses(name))
         self.assertEqual(result, [])
 
+    @patch('afkak.client.DNSclient.lookupIPV6Address')
+    @patch('afkak.client.DNSclient.lookupAddress')
+    def test__get_IP_addresses_cached(self, lookupAddress, lookupIPV6):
+        """
+        Answers are served from the cache for their smallest TTL, and
+        failures aren't cached
+        """
+        name = 'fully.qualified.domain.name.'
+        lookupAddress.return_value = ([
+            RRHeader(name=name, type=dns.A, ttl=60,
+                     payload=Record_A(address='127.0.0.1')),
+            RRHeader(name=name, type=dns.A, ttl=30,
+                     payload=Record_A(address='127.0.0.2')),
+        ], [], [])
+        lookupIPV6.return_value = ([], [], [])
+        cache, clock = {}, MemoryReactorClock()
+
+        result = self.successResultOf(_get_IP_addresses(name, cache, clock))
+        self.assertEqual(result, ['127.0.0.1', '127.0.0.2'])
+        clock.advance(29)
+        result = self.successResultOf(_get_IP_addresses(name, cache, clock))
+        self.assertEqual(result, ['127.0.0.1', '127.0.0.2'])
+        self.assertEqual(lookupAddress.call_count, 1)
+        self.assertEqual(lookupIPV6.call_count, 1)
+
+        # Expired: looked up again, and as that fails, not cached
+        clock.advance(1)
+        lookupAddress.side_effect = DNSNameError('No Such Name!')
+        lookupIPV6.side_effect = DNSNameError('No Such Name!')
+        result = self.successResultOf(_get_IP_addresses(name, cache, clock))
+        self.assertEqual(result, [])
+        self.assertEqual(cache, {})
+        result = self.successResultOf(_get_IP_addresses(name, cache, clock))
+        self.assertEqual(lookupAddress.call_count, 3)
+
     @patch('afkak.client.KafkaBrokerClient')
     def test_get_brokerclient(self, broker):
         """
@@ -648,6 +814,62 @@ class TestKafkaClient(unittest.TestCase):
         # Assure we got broker_2 twice
         self.assertEqual(len(broker_2.call_args_list), 2)
 
+    @patch('afkak.client.KafkaBrokerClient')
+    def test_get_brokerclient_dedicated_connections(self, broker):
+        broker.side_effect = lambda *args, **kw: MagicMock()
+        with self.assertRaises(ValueError):
+            KafkaClient(hosts='broker_1', dedicated_connections=['bulk'])
+
+        client = KafkaClient(hosts='broker_1',
+                             dedicated_connections=[TRAFFIC_FETCH])
+        control = client._get_brokerclient('broker_1', 9092)
+        fetch = client._get_brokerclient('broker_1', 9092, TRAFFIC_FETCH)
+        produce = client._get_brokerclient('broker_1', 9092, TRAFFIC_PRODUCE)
+        self.assertIsNot(fetch, control)
+        # Produce traffic has no dedicated connection, so shares the control
+        self.assertIs(produce, control)
+        self.assertIs(
+            client._get_brokerclient('broker_1', 9092, TRAFFIC_FETCH), fetch)
+        self.assertEqual(client.clients, {
+            ('broker_1', 9092): control,
+            ('broker_1', 9092, TRAFFIC_FETCH): fetch,
+        })
+        broker.assert_any_call('broker_1', 9092,
+                               clientId=client.clientId + ':fetch',
+                               subscribers=[client._update_broker_state],
+                               maxInFlight=None, maxQueuedBytes=None,
+                               socketOptions=None, failOnDisconnect=False,
+                               reactor=None)
+
+        # Removing the broker closes all its connections
+        client._update_brokers([('broker_2', 9092)], remove=True)
+        control.close.assert_called_once_with()
+        fetch.close.assert_called_once_with()
+        self.assertEqual(client.clients.keys(), [('broker_2', 9092)])
+
+    def test_send_requests_dedicated_connections(self):
+        client = KafkaClient(
+            hosts='kafka41', reactor=MemoryReactorClock(),
+            dedicated_connections=[TRAFFIC_FETCH, TRAFFIC_PRODUCE])
+        client.topic_partitions = {'topic': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition('topic', 0): BrokerMetadata(1, 'kafka41', 9092),
+        }
+        with patch.object(KafkaBrokerClient, '_connect'):
+            fetchD = client.send_fetch_request(
+                [FetchRequest('topic', 0, 0, 1024)])
+            produceD = client.send_produce_request(
+                [ProduceRequest('topic', 0, [create_message('msg')])])
+        # Each request is queued on its own class's connection
+        fetch = client.clients[('kafka41', 9092, TRAFFIC_FETCH)]
+        produce = client.clients[('kafka41', 9092, TRAFFIC_PRODUCE)]
+        self.assertEqual(len(fetch.requests), 1)
+        self.assertEqual(len(produce.requests), 1)
+        self.assertNotIn(('kafka41', 9092), client.clients)
+        client.close()
+        self.failureResultOf(fetchD, FailedPayloadsError)
+        self.failureResultOf(produceD, FailedPayloadsError)
+
     @patch('afkak.client._collect_hosts')
     def test_update_broker_state(self, collected_hosts):
         """
@@ -660,13 +882,37 @@ class TestKafkaClient(unittest.TestCase):
                                         ('broker_2', 9092),
                                         ('broker_3', 45678)]
         e = ConnectionRefusedError()
-        bkr = "aBroker"
-        client.reset_all_metadata = MagicMock()
+        bkr = Mock(host='broker_1', port=4567)
+        brokers = [BrokerMetadata(1, 'broker_1', 4567),
+                   BrokerMetadata(2, 'broker_2', 9092)]
+        client.topic_partitions = {'topic1': [0, 1], 'topic2': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition('topic1', 0): brokers[0],
+            TopicAndPartition('topic1', 1): brokers[1],
+            TopicAndPartition('topic2', 0): brokers[0],
+        }
+        client.consumer_group_to_brokers = {'g1': brokers[0],
+                                            'g2': brokers[1]}
         client.load_metadata_for_topics = MagicMock()
         client._collect_hosts_d = None
         client._update_broker_state(bkr, False, e)
-        client.reset_all_metadata.assert_called_once_with()
-        client.load_metadata_for_topics.assert_called_once_with()
+        # Only the metadata routing to the broker is forgotten...
+        self.assertEqual(client.topics_to_brokers, {
+            TopicAndPartition('topic1', 1): brokers[1]})
+        self.assertEqual(client.consumer_group_to_brokers, {'g2': brokers[1]})
+        self.assertEqual(client.topic_partitions,
+                         {'topic1': [0, 1], 'topic2': [0]})
+        # ...and only the topics we use are reloaded
+        self.assertEqual(
+            sorted(client.load_metadata_for_topics.call_args[0]),
+            ['topic1', 'topic2'])
+        self.assertTrue(client._collect_hosts_d)
+
+        # With no topics in use, there's nothing to reload
+        client.topic_partitions = {}
+        client.load_metadata_for_topics.reset_mock()
+        client._update_broker_state(bkr, False, e)
+        self.assertFalse(client.load_metadata_for_topics.called)
 
     @patch('afkak.client.KafkaBrokerClient')
     def test_update_brokers(self, broker):
@@ -708,6 +954,179 @@ class TestKafkaClient(unittest.TestCase):
         for brkr in beforeClients.values():
             brkr.close.assert_called_once_with()
 
+    @patch('afkak.client.KafkaBrokerClient')
+    def test_update_brokers_connect_eagerly(self, broker):
+        broker.side_effect = lambda *args, **kw: MagicMock()
+        client = KafkaClient(hosts='broker_1', connect_eagerly=True,
+                             dedicated_connections=[TRAFFIC_FETCH])
+        client._update_brokers([('broker_1', 9092), ('broker_2', 9092)])
+        self.assertEqual(len(client.clients), 4)
+        for brokerClient in client.clients.values():
+            brokerClient.connect.assert_called_once_with()
+        # Only brokers new to us are connected to
+        client._update_brokers([('broker_1', 9092), ('broker_2', 9092)])
+        for brokerClient in client.clients.values():
+            brokerClient.connect.assert_called_once_with()
+
+    @patch('afkak.client.KafkaBrokerClient')
+    def test_update_brokers_connect_lazily(self, broker):
+        broker.side_effect = lambda *args, **kw: MagicMock()
+        client = KafkaClient(hosts='broker_1')
+        client._update_brokers([('broker_1', 9092)])
+        self.assertFalse(client.clients[('broker_1', 9092)].connect.called)
+
+    def test_keepalive(self):
+        reactor = MemoryReactorClock()
+        with self.assertRaises(ValueError):
+            KafkaClient(hosts='broker_1', keepalive_every_ms=0)
+        client = KafkaClient(hosts='broker_1', reactor=reactor,
+                             keepalive_every_ms=60000)
+        idle, busy, down = MagicMock(), MagicMock(), MagicMock()
+        idle.requests = {}
+        busy.requests = {1: Mock()}
+        down.requests = {}
+        down.proto = None
+        client.clients = {('broker_1', 9092): idle,
+                          ('broker_2', 9092): busy,
+                          ('broker_3', 9092): down}
+        d = Deferred()
+        idle.makeRequest.return_value = d
+        idle.cancelRequest.side_effect = \
+            lambda rId, reason: d.errback(reason)
+        reactor.advance(59)
+        self.assertFalse(idle.makeRequest.called)
+        reactor.advance(1)
+        # Only the connected, idle, broker is sent a keepalive
+        request = KafkaCodec.encode_offset_request(client.clientId, 1)
+        idle.makeRequest.assert_called_once_with(1, request)
+        self.assertFalse(busy.makeRequest.called)
+        self.assertFalse(down.makeRequest.called)
+        # A keepalive which times out is not an error
+        reactor.advance(client.timeout)
+        idle.cancelRequest.assert_called_once_with(1, reason=ANY)
+        self.assertIsNone(self.successResultOf(d))
+        # Closing stops the keepalives
+        client.close()
+        reactor.advance(60)
+        self.assertEqual(idle.makeRequest.call_count, 1)
+
+    def test_load_metadata_for_topics_single_flight(self):
+        reactor = MemoryReactorClock()
+        client = KafkaClient(hosts='kafka', reactor=reactor)
+        requests = []
+
+        def send(requestId, request):
+            requests.append((request, Deferred()))
+            return requests[-1][1]
+
+        with patch.object(client, '_send_broker_unaware_request',
+                          side_effect=send):
+            # Many lookups of the same topics within a reactor tick...
+            ds = [client.load_metadata_for_topics('topic1')
+                  for _ in range(500)]
+            ds.append(client.load_metadata_for_topics('topic2', 'topic1'))
+            cancelled = client.load_metadata_for_topics('topic1')
+            cancelled.cancel()
+            self.assertEqual(requests, [])
+            reactor.advance(0)
+            # ...are sent as one request
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(requests[0][0], KafkaCodec.encode_metadata_request(
+                client.clientId, client.correlation_id, ['topic1', 'topic2']))
+            # And while it is in flight, the topics aren't asked for again
+            ds.append(client.load_metadata_for_topics('topic2'))
+            reactor.advance(0)
+            self.assertEqual(len(requests), 1)
+            requests[0][1].callback(self.testMetaData)
+            for d in ds:
+                self.assertTrue(self.successResultOf(d))
+            self.failureResultOf(cancelled, t_CancelledError)
+
+            # Once it has arrived, they can be loaded again, and a failure
+            # reaches every waiter
+            ds = [client.load_metadata_for_topics('topic1'),
+                  client.load_metadata_for_topics('topic1', 'topic3')]
+            reactor.advance(0)
+            self.assertEqual(len(requests), 2)
+            requests[1][1].errback(KafkaUnavailableError())
+            for d in ds:
+                self.failureResultOf(d, KafkaUnavailableError)
+
+            # Closing drops those queued
+            d = client.load_metadata_for_topics('topic1')
+            client.close()
+            reactor.advance(0)
+            self.assertEqual(len(requests), 2)
+            self.assertIsNone(self.successResultOf(d))
+
+    def test_metadata_refresh(self):
+        with self.assertRaises(ValueError):
+            KafkaClient(hosts='kafka', metadata_max_age_ms=0)
+        reactor = MemoryReactorClock()
+        client = KafkaClient(hosts='kafka', reactor=reactor,
+                             metadata_max_age_ms=10000)
+        requests = []
+
+        def send(requestId, request):
+            requests.append(Deferred())
+            return requests[-1]
+
+        payloads = [FetchRequest('topic1', 0, 0, 1024)]
+
+        def use():
+            return client._payloads_by_leader(payloads)
+
+        key = TopicAndPartition('topic1', 0)
+        with patch.object(client, '_send_broker_unaware_request',
+                          side_effect=send), \
+                patch.object(client, 'load_metadata_for_topics',
+                             wraps=client.load_metadata_for_topics) as load:
+            # All topics: only those requests are sent for are refreshed
+            d = client.load_metadata_for_topics()
+            reactor.advance(0)
+            requests[0].callback(self.testMetaData)
+            self.assertTrue(self.successResultOf(d))
+            # topic3 is in error, so its metadata isn't kept
+            self.assertEqual(sorted(client.topic_loaded_at),
+                             ['topic1', 'topic2'])
+            leader = client.topics_to_brokers[key]
+            self.assertEqual(use(), {leader: payloads})
+            reactor.pump([1.25] * 5)
+            self.assertEqual(len(requests), 1)
+            # Refreshed in the background as it nears its max age...
+            reactor.advance(1.25)
+            self.assertEqual(len(requests), 2)
+            load.assert_called_with('topic1')
+            # ...while the metadata we have is still used
+            self.assertEqual(use(), {leader: payloads})
+            self.assertEqual(len(requests), 2)
+            requests[1].callback(self.testMetaData)
+            self.assertEqual(client.topic_loaded_at['topic1'], 7.5)
+
+            # Not refreshed again unless requests are sent for it
+            reactor.pump([1.25] * 6)
+            self.assertEqual(len(requests), 2)
+            self.assertEqual(use(), {leader: payloads})
+            # Should the refresh fail...
+            reactor.advance(1.25)
+            self.assertEqual(len(requests), 3)
+            requests[2].errback(KafkaUnavailableError())
+            reactor.pump([1.25] * 2)
+            self.assertEqual(len(requests), 4)
+            # ...the expired metadata is reloaded before it is used, here
+            # by waiting on the refresh in progress
+            d = use()
+            reactor.advance(0)
+            self.assertEqual(len(requests), 4)
+            self.assertNoResult(d)
+            requests[3].callback(self.testMetaData)
+            self.assertEqual(self.successResultOf(d), {leader: payloads})
+
+        # Closing stops the refreshes
+        client.close()
+        reactor.advance(10)
+        self.assertEqual(len(requests), 4)
+
     def test_send_broker_aware_request(self):
         """
         test_send_broker_aware_request
@@ -1071,6 +1490,105 @@ class TestKafkaClient(unittest.TestCase):
                     req_d, ConsumerCoordinatorNotAvailableError))
             client.close()
 
+    def test_send_produce_request_resent_on_disconnect(self):
+        """test_send_produce_request_resent_on_disconnect
+        Test that a request failed by the loss of its connection is sent
+        again to the partition's new leader, only if that is asked for
+        """
+        T1 = "Topic1"
+        brokers = [
+            BrokerMetadata(node_id=1, host='kafka31', port=9092),
+            BrokerMetadata(node_id=2, host='kafka32', port=9092),
+            ]
+        mocked_brokers = {
+            ('kafka31', 9092): MagicMock(),
+            ('kafka32', 9092): MagicMock(),
+        }
+        resp = struct.pack('>iih%dsiihq' % (len(T1)),
+                           1, 1, len(T1), T1, 1, 0, 0, 10L)
+        mocked_brokers[('kafka31', 9092)].makeRequest.side_effect = \
+            lambda *args, **kw: fail(ConnectionError())
+        mocked_brokers[('kafka32', 9092)].makeRequest.return_value = \
+            succeed(resp)
+
+        def mock_get_brkr(host, port, traffic=None):
+            return mocked_brokers[(host, port)]
+
+        def mock_load_metadata(*topics):
+            # The new leader
+            self.assertEqual(topics, (T1,))
+            client.topics_to_brokers[key] = brokers[1]
+            return succeed(None)
+
+        payloads = [ProduceRequest(T1, 0, [create_message("message")])]
+        key = TopicAndPartition(topic=T1, partition=0)
+        for fail_on_disconnect, resend in (
+                (True, True), (True, False), (False, False)):
+            client = KafkaClient(hosts='kafka31:9092,kafka32:9092',
+                                 fail_on_disconnect=fail_on_disconnect,
+                                 resend_produce_on_disconnect=resend)
+            client.topic_partitions = {T1: [0, 1], "Topic2": [0]}
+            client.topics_to_brokers = {
+                key: brokers[0],
+                TopicAndPartition(T1, 1): brokers[0],
+                TopicAndPartition("Topic2", 0): brokers[1],
+                }
+            with patch.object(KafkaClient, '_get_brokerclient',
+                              side_effect=mock_get_brkr), \
+                    patch.object(client, 'load_metadata_for_topics',
+                                 side_effect=mock_load_metadata):
+                respD = client.send_produce_request(payloads)
+            if resend:
+                self.assertEqual(list(self.successResultOf(respD)),
+                                 [ProduceResponse(T1, 0, 0, 10L)])
+            else:
+                # Failed, and only the partitions routed to the failed broker
+                # are forgotten
+                self.failureResultOf(respD, FailedPayloadsError)
+                self.assertEqual(client.topics_to_brokers, {
+                    TopicAndPartition("Topic2", 0): brokers[1]})
+
+    def test_send_offset_request_resent_on_disconnect(self):
+        """test_send_offset_request_resent_on_disconnect
+        Test that requests other than produce requests are sent again to
+        the new leader with just fail_on_disconnect set
+        """
+        T1 = "Topic1"
+        brokers = [
+            BrokerMetadata(node_id=1, host='kafka31', port=9092),
+            BrokerMetadata(node_id=2, host='kafka32', port=9092),
+            ]
+        mocked_brokers = {
+            ('kafka31', 9092): MagicMock(),
+            ('kafka32', 9092): MagicMock(),
+        }
+        resp = struct.pack('>iih%dsiihiq' % (len(T1)),
+                           1, 1, len(T1), T1, 1, 0, 0, 1, 96)
+        mocked_brokers[('kafka31', 9092)].makeRequest.side_effect = \
+            lambda *args, **kw: fail(ConnectionError())
+        mocked_brokers[('kafka32', 9092)].makeRequest.return_value = \
+            succeed(resp)
+
+        def mock_get_brkr(host, port, traffic=None):
+            return mocked_brokers[(host, port)]
+
+        def mock_load_metadata(*topics):
+            client.topics_to_brokers[key] = brokers[1]
+            return succeed(None)
+
+        key = TopicAndPartition(topic=T1, partition=0)
+        client = KafkaClient(hosts='kafka31:9092,kafka32:9092',
+                             fail_on_disconnect=True)
+        client.topic_partitions = {T1: [0]}
+        client.topics_to_brokers = {key: brokers[0]}
+        with patch.object(KafkaClient, '_get_brokerclient',
+                          side_effect=mock_get_brkr), \
+                patch.object(client, 'load_metadata_for_topics',
+                             side_effect=mock_load_metadata):
+            respD = client.send_offset_request([OffsetRequest(T1, 0, -1, 1)])
+        self.assertEqual(list(self.successResultOf(respD)),
+                         [OffsetResponse(T1, 0, 0, (96,))])
+
     def test_send_produce_request(self):
         """test_send_produce_request
         Test send_produce_request
@@ -1088,7 +1606,7 @@ class TestKafkaClient(unittest.TestCase):
         mocked_brokers[('kafka31', 9092)].makeRequest.side_effect = ds[0]
         mocked_brokers[('kafka32', 9092)].makeRequest.side_effect = ds[1]
 
-        def mock_get_brkr(host, port):
+        def mock_get_brkr(host, port, traffic=None):
             return mocked_brokers[(host, port)]
 
         client = KafkaClient(hosts='kafka31:9092,kafka32:9092')
@@ -1212,7 +1730,7 @@ class TestKafkaClient(unittest.TestCase):
         mocked_brokers[('kafka41', 9092)].makeRequest.side_effect = ds[0]
         mocked_brokers[('kafka42', 9092)].makeRequest.side_effect = ds[1]
 
-        def mock_get_brkr(host, port):
+        def mock_get_brkr(host, port, traffic=None):
             return mocked_brokers[(host, port)]
 
         client = KafkaClient(hosts='kafka41:9092,kafka42:9092')
@@ -1294,6 +1812,128 @@ class TestKafkaClient(unittest.TestCase):
                                                OffsetAndMessage(49, msgs[4])])]
         self.assertEqual(expect, expanded_responses)
 
+    def test_send_fetch_request_decode_pool(self):
+        class FakePool(object):
+            """Runs tasks synchronously, as a multiprocessing.Pool would"""
+            calls = []
+
+            def apply_async(self, func, args, callback):
+                self.calls.append(args)
+                callback(func(*args))
+
+        client = KafkaClient(hosts='kafka41:9092')
+        client.clock = Mock()
+        client.clock.callFromThread.side_effect = lambda f, *a: f(*a)
+        client.DECODE_POOL_MIN_BYTES = 100
+        msgs = [create_message("m%d" % i) for i in range(4)]
+        big_set = KafkaCodec._encode_message_set(msgs, offset=10)
+        small_set = KafkaCodec._encode_message_set(msgs[:1], offset=20)
+        truncated_set = big_set[:10]
+        resps = [FetchResponse("T1", 0, 0, 14, buffer(big_set)),
+                 FetchResponse("T1", 1, 0, 21, buffer(small_set)),
+                 FetchResponse("T2", 0, 0, 14, buffer(truncated_set))]
+        payloads = [FetchRequest("T1", 0, 12, 1024),
+                    FetchRequest("T1", 1, 0, 1024),
+                    FetchRequest("T2", 0, 0, 1024)]
+
+        pool = FakePool()
+        with patch.object(KafkaClient, '_send_broker_aware_request',
+                          return_value=succeed(resps)) as sbar:
+            d = client.send_fetch_request(payloads, fail_on_error=False,
+                                          decode_pool=pool)
+        # The message sets were left undecoded for the pool
+        self.assertTrue(sbar.call_args[0][2].keywords['raw_message_sets'])
+        [r1, r2, r3] = self.successResultOf(d)
+        # Only the large message set was sent to the pool
+        self.assertEqual([args[:2] for args in pool.calls], [("T1", 0)])
+        self.assertIsInstance(r1.messages, MessageBatch)
+        self.assertEqual(list(r1.messages), [
+            SourcedMessage("T1", 0, 12, msgs[2]),
+            SourcedMessage("T1", 0, 13, msgs[3])])
+        # The worker didn't send the message set back, but the batch has it
+        self.assertEqual(str(buffer(r1.messages.data)), big_set)
+        self.assertEqual(list(r2.messages),
+                         [SourcedMessage("T1", 1, 20, msgs[0])])
+        # The decode error is raised when the messages are iterated
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            list(r3.messages)
+
+    def test_send_fetch_request_decode_pool_checksum_error(self):
+        """
+        The messages before one with a bad CRC are yielded before the
+        ChecksumError is raised, as when the message set isn't pooled
+        """
+        client = KafkaClient(hosts='kafka41:9092')
+        client.clock = Mock()
+        client.clock.callFromThread.side_effect = lambda f, *a: f(*a)
+        client.DECODE_POOL_MIN_BYTES = 10
+        pool = Mock()
+        pool.apply_async.side_effect = \
+            lambda func, args, callback: callback(func(*args))
+        msgs = [create_message("m%d" % i) for i in range(3)]
+        message_set = bytearray(KafkaCodec._encode_message_set(msgs, 10))
+        message_set[-1] ^= 0xff  # Corrupt the last message
+        resps = [FetchResponse("T1", 0, 0, 13, buffer(message_set))]
+
+        with patch.object(KafkaClient, '_send_broker_aware_request',
+                          return_value=succeed(resps)):
+            d = client.send_fetch_request([FetchRequest("T1", 0, 11, 1024)],
+                                          decode_pool=pool)
+        [resp] = self.successResultOf(d)
+        self.assertEqual(next(resp.messages), OffsetAndMessage(11, msgs[1]))
+        with self.assertRaises(ChecksumError):
+            next(resp.messages)
+
+    def test_send_fetch_request_decode_pool_fails(self):
+        """
+        The fetch fails, rather than hang, when the pool never completes a
+        task, or refuses it
+        """
+        class StuckPool(object):
+            """A pool whose workers have died"""
+            def apply_async(self, func, args, callback):
+                pass
+
+        class ClosedPool(object):
+            def apply_async(self, func, args, callback):
+                raise ValueError("Pool not running")
+
+        reactor = MemoryReactorClock()
+        reactor.callFromThread = Mock()
+        client = KafkaClient(hosts='kafka41:9092', reactor=reactor)
+        client.DECODE_POOL_MIN_BYTES = 10
+        msgs = [create_message("m%d" % i) for i in range(4)]
+        resps = [FetchResponse("T1", 0, 0, 14, buffer(
+            KafkaCodec._encode_message_set(msgs, offset=10)))]
+        payloads = [FetchRequest("T1", 0, 10, 1024)]
+
+        with patch.object(KafkaClient, '_send_broker_aware_request',
+                          return_value=succeed(resps)):
+            d = client.send_fetch_request(payloads, decode_pool=StuckPool())
+        reactor.advance(client.timeout - 0.1)
+        self.assertNoResult(d)
+        reactor.advance(0.1)
+        self.failureResultOf(d, RequestTimedOutError)
+
+        with patch.object(KafkaClient, '_send_broker_aware_request',
+                          return_value=succeed(resps)):
+            d = client.send_fetch_request(payloads, decode_pool=ClosedPool())
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(reactor.getDelayedCalls(), [])
+
+        # The timeout is scheduled on the client's timing wheel, if it has one
+        wheel = TimingWheel(reactor=reactor)
+        client = KafkaClient(hosts='kafka41:9092', reactor=reactor,
+                             timing_wheel=wheel)
+        client.DECODE_POOL_MIN_BYTES = 10
+        with patch.object(KafkaClient, '_send_broker_aware_request',
+                          return_value=succeed(resps)):
+            d = client.send_fetch_request(payloads, decode_pool=StuckPool())
+        self.assertEqual(len(wheel.getDelayedCalls()), 1)
+        reactor.advance(client.timeout + 1)
+        self.failureResultOf(d, RequestTimedOutError)
+        self.assertEqual(wheel.getDelayedCalls(), [])
+
     def test_send_fetch_request_bad_timeout(self):
         client = KafkaClient(hosts='kafka41:9092,kafka42:9092')
         payload = [FetchRequest('T1', 0, 0, 1024)]
@@ -1318,7 +1958,7 @@ class TestKafkaClient(unittest.TestCase):
         mocked_brokers[('kafka51', 9092)].makeRequest.side_effect = ds[0]
         mocked_brokers[('kafka52', 9092)].makeRequest.side_effect = ds[1]
 
-        def mock_get_brkr(host, port):
+        def mock_get_brkr(host, port, traffic=None):
             return mocked_brokers[(host, port)]
 
         client = KafkaClient(hosts='kafka51:9092,kafka52:9092')
@@ -1433,7 +2073,7 @@ class TestKafkaClient(unittest.TestCase):
             G2: brokers[1],
             }
 
-        def mock_get_brkr(host, port):
+        def mock_get_brkr(host, port, traffic=None):
             return mocked_brokers[(host, port)]
 
         def mock_load_cmfg(group):
@@ -1547,7 +2187,7 @@ class TestKafkaClient(unittest.TestCase):
             G2: brokers[1],
             }
 
-        def mock_get_brkr(host, port):
+        def mock_get_brkr(host, port, traffic=None):
             return mocked_brokers[(host, port)]
 
         def mock_load_cmfg(group):
@@ -1622,7 +2262,7 @@ class TestKafkaClient(unittest.TestCase):
             G2: brokers[1],
             }
 
-        def mock_get_brkr(host, port):
+        def mock_get_brkr(host, port, traffic=None):
             return mocked_brokers[(host, port)]
 
         def mock_load_cmfg(group):
@@ -1733,6 +2373,8 @@ class TestKafkaClient(unittest.TestCase):
         # Alter the client's brokerclient dict
         client.clients = mocked_brokers
         client._collect_hosts_d = None
+        # The cached address of the host, which has since changed
+        client._dns_cache['kafka01'] = (float('inf'), ['10.0.0.1'])
         # Get the deferred (should be already failed)
         fail1 = client._send_broker_unaware_request(1, 'fake request')
         # check it
@@ -1747,12 +2389,14 @@ class TestKafkaClient(unittest.TestCase):
             brkr.makeRequest.assert_called_with(1, 'fake request')
 
         # Patch the lookup and retry the request
-        with patch("afkak.client.DNSclient.lookupAddress") as lookupAddr:
+        with patch("afkak.client.DNSclient.lookupAddress") as lookupAddr, \
+                patch("afkak.client.DNSclient.lookupIPV6Address") as lookup6:
             answer = Mock(
-                **{'type': dns.A,
+                **{'type': dns.A, 'ttl': 300,
                    'payload.dottedQuad.return_value': "1.2.3.4",})
             lookupAddr.return_value = (
                 [answer], None, None)
+            lookup6.return_value = ([], None, None)
 
             # Patch away client._get_brokerclient. We'll end up with no brokers
             get_broker = Mock()
@@ -1766,3 +2410,246 @@ class TestKafkaClient(unittest.TestCase):
         # Check that the proper calls were made
         get_broker.assert_called_with('1.2.3.4', 9092)
         lookupAddr.assert_called_with('kafka01')
+        # ...and as every broker failed again, the answer isn't kept
+        self.assertEqual(client._dns_cache, {})
+
+
+class _FakeBroker(object):
+    """A broker of a _FakeCluster"""
+
+    def __init__(self, node_id, host, port):
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+        self.alive = True
+        self.answer_produce = True
+        self.produced = []
+        self.connections = []  # _FakeClusterConnectors connected to us
+
+
+class _FakeClusterConnector(object):
+    """The connector of a connection to a _FakeCluster"""
+
+    state = 'disconnected'
+    proto = None
+
+    def __init__(self, cluster, host, port, factory):
+        self.cluster = cluster
+        self.host = host
+        self.port = port
+        self.factory = factory
+
+    def getDestination(self):
+        return IPv4Address('TCP', self.host, self.port)
+
+    def connect(self):
+        self.state = 'connecting'
+        self.cluster.connect(self)
+
+    def stopConnecting(self):
+        self.state = 'disconnected'
+
+    def disconnect(self):
+        if self.state == 'connected':
+            self.cluster.disconnect(self, Failure(ConnectionDone()))
+
+
+class _FakeCluster(object):
+    """Brokers which answer the metadata and produce requests of a client
+
+    Drives the connections a KafkaClient makes on a MemoryReactorClock:
+    call :meth:`pump` to deliver the requests written to them.
+    """
+
+    def __init__(self, reactor, topic, brokers):
+        self.reactor = reactor
+        self.topic = topic
+        self.brokers = dict(((b.host, b.port), b) for b in brokers)
+        self.leader = brokers[0]
+        reactor.connectTCP = self.connectTCP
+
+    def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
+        connector = _FakeClusterConnector(self, host, port, factory)
+        factory.startedConnecting(connector)
+        connector.connect()
+        return connector
+
+    def connect(self, connector):
+        broker = self.brokers[connector.host, connector.port]
+        if not broker.alive:
+            connector.state = 'disconnected'
+            self.reactor.callLater(
+                0, connector.factory.clientConnectionFailed, connector,
+                Failure(ConnectionRefusedError()))
+            return
+        connector.state = 'connected'
+        connector.proto = connector.factory.buildProtocol(
+            IPv4Address('TCP', connector.host, connector.port))
+        connector.proto.makeConnection(StringTransport())
+        broker.connections.append(connector)
+
+    def disconnect(self, connector, reason):
+        self.brokers[connector.host, connector.port].connections.remove(
+            connector)
+        connector.state = 'disconnected'
+        connector.proto.connectionLost(reason)
+        connector.factory.clientConnectionLost(connector, reason)
+
+    def kill(self, broker, new_leader):
+        """Stop a broker, making another the leader"""
+        broker.alive = False
+        self.leader = new_leader
+        for connector in list(broker.connections):
+            self.disconnect(connector, Failure(ConnectionLost()))
+
+    def pump(self, step=0.01):
+        """Answer the requests sent, then let time pass"""
+        for broker in self.brokers.values():
+            for connector in list(broker.connections):
+                proto = connector.proto
+                data = proto.transport.value()
+                proto.transport.clear()
+                while data:
+                    (length,) = struct.unpack('>i', data[:4])
+                    self.answer(broker, proto, data[4:4 + length])
+                    data = data[4 + length:]
+        self.reactor.advance(step)
+
+    def answer(self, broker, proto, request):
+        api_key, _, correlation_id = struct.unpack('>hhi', request[:8])
+        if api_key == KafkaCodec.METADATA_KEY:
+            brokers = dict((b.node_id, BrokerMetadata(b.node_id, b.host,
+                                                      b.port))
+                           for b in self.brokers.values())
+            leader = self.leader.node_id
+            topics = {self.topic: TopicMetadata(self.topic, 0, {
+                0: PartitionMetadata(self.topic, 0, 0, leader, [leader],
+                                     [leader])})}
+            response = struct.pack('>i', correlation_id) + \
+                create_encoded_metadata_response(brokers, topics)[4:]
+        elif api_key == KafkaCodec.PRODUCE_KEY:
+            broker.produced.append(correlation_id)
+            if not broker.answer_produce:
+                return
+            response = struct.pack(
+                '>iih%dsiihq' % len(self.topic), correlation_id, 1,
+                len(self.topic), self.topic, 1, 0, 0, len(broker.produced))
+        proto.dataReceived(struct.pack('>i', len(response)) + response)
+
+
+class TestKafkaClientFailover(unittest.TestCase):
+    def test_failover(self):
+        """test_failover
+        Time how long a produce request in flight to a leader which fails
+        takes to reach the new leader, over a pair of fake brokers
+        """
+        T1 = "Topic1"
+        reactor = MemoryReactorClock()
+        brokers = [_FakeBroker(1, '10.0.0.1', 9092),
+                   _FakeBroker(2, '10.0.0.2', 9092)]
+        cluster = _FakeCluster(reactor, T1, brokers)
+        client = KafkaClient(hosts='10.0.0.1:9092,10.0.0.2:9092',
+                             reactor=reactor, fail_on_disconnect=True,
+                             resend_produce_on_disconnect=True)
+
+        def close():
+            d = client.close()
+            reactor.advance(0)
+            return d
+        self.addCleanup(close)
+        # The leader hangs on to the request when it fails
+        brokers[0].answer_produce = False
+        d = client.send_produce_request(
+            [ProduceRequest(T1, 0, [create_message("message")])])
+        while not brokers[0].produced:
+            cluster.pump()
+        start = reactor.seconds()
+        cluster.kill(brokers[0], brokers[1])
+        while not d.called and reactor.seconds() - start < client.timeout:
+            cluster.pump()
+        failover = reactor.seconds() - start
+
+        self.assertEqual(list(self.successResultOf(d)),
+                         [ProduceResponse(T1, 0, 0, 1)])
+        self.assertEqual(len(brokers[1].produced), 1)
+        # Well within the client's timeout, which the request would have
+        # waited out before
+        self.assertLess(failover, 0.1)
+
+    def test_connect_failed(self):
+        """test_connect_failed
+        A produce request to a leader which refuses the connection is held,
+        not failed, and sent when it comes back
+        """
+        T1 = "Topic1"
+        reactor = MemoryReactorClock()
+        brokers = [_FakeBroker(1, '10.0.0.1', 9092),
+                   _FakeBroker(2, '10.0.0.2', 9092)]
+        cluster = _FakeCluster(reactor, T1, brokers)
+        client = KafkaClient(hosts='10.0.0.1:9092,10.0.0.2:9092',
+                             reactor=reactor)
+
+        def close():
+            d = client.close()
+            reactor.advance(0)
+            return d
+        self.addCleanup(close)
+        brokers[0].alive = False
+        d = client.send_produce_request(
+            [ProduceRequest(T1, 0, [create_message("message")])])
+        for _ in range(100):
+            cluster.pump()
+        self.assertNoResult(d)
+
+        brokers[0].alive = True
+        while not d.called and reactor.seconds() < client.timeout:
+            cluster.pump()
+        self.assertEqual(list(self.successResultOf(d)),
+                         [ProduceResponse(T1, 0, 0, 1)])
+        self.assertEqual(len(brokers[0].produced), 1)
+
+
+class TestKafkaClientBenchmark(unittest.TestCase):
+    """Timings for routing requests. See testutil.benchmark()"""
+
+    @benchmark
+    def test_payloads_by_leader(self):
+        # Deferred debugging captures a stack per deferred: not our costs
+        setDebugging(False)
+        self.addCleanup(setDebugging, DEBUGGING)
+        client = KafkaClient(hosts='kafka', reactor=MemoryReactorClock())
+        brokers = [BrokerMetadata(i, 'kafka{}'.format(i), 9092)
+                   for i in range(5)]
+
+        @inlineCallbacks
+        def get_leader(topic, partition):
+            # How each leader was once looked up
+            key = TopicAndPartition(topic, partition)
+            if client.topics_to_brokers.get(key) is None or \
+                    client._metadata_expired(topic):
+                yield client.load_metadata_for_topics(topic)
+            returnValue(client.topics_to_brokers[key])
+
+        @inlineCallbacks
+        def per_payload(payloads):
+            # A deferred per payload
+            payloads_by_broker = collections.defaultdict(list)
+            for payload in payloads:
+                leader = yield get_leader(payload.topic, payload.partition)
+                payloads_by_broker[leader].append(payload)
+            returnValue(payloads_by_broker)
+
+        print("\n{:>12} {:>17} {:>14} {:>7}".format(
+            "partitions", "per payload (us)", "in bulk (us)", "gain"))
+        for partitions in (1, 100, 1000):
+            client.topics_to_brokers = dict(
+                (TopicAndPartition('topic', i), brokers[i % len(brokers)])
+                for i in range(partitions))
+            payloads = [FetchRequest('topic', i, 0, 1024)
+                        for i in range(partitions)]
+            number = max(10, 10000 // partitions)
+            old = time_per_call(lambda: per_payload(payloads), number)
+            new = time_per_call(
+                lambda: client._payloads_by_leader(payloads), number)
+            print("{:>12} {:>17.1f} {:>14.1f} {:>6.2f}x".format(
+                partitions, old * 1e6, new * 1e6, old / new))
@@ -1,16 +1,36 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2015 Cyan, Inc.
 
+import gzip
+import os
 import struct
 import unittest2
+from cStringIO import StringIO
 from mock import patch
 
 import afkak
 from afkak.codec import (
-    has_gzip, has_snappy, gzip_encode, gzip_decode,
-    snappy_encode, snappy_decode
+    has_gzip, has_snappy, has_lz4, gzip_encode, gzip_decode, gzip_decode_iter,
+    snappy_encode, snappy_decode, lz4_encode, lz4_decode
 )
-from testutil import (random_string)
+from testutil import (random_string, benchmark, time_per_call)
+
+
+def _gzipfile_encode(payload, compresslevel=9):
+    """gzip_encode() as it was, via GzipFile, for comparison"""
+    buf = StringIO()
+    handle = gzip.GzipFile(fileobj=buf, mode="w", compresslevel=compresslevel)
+    handle.write(payload)
+    handle.close()
+    return buf.getvalue()
+
+
+def _gzipfile_decode(payload):
+    """gzip_decode() as it was, via GzipFile, for comparison"""
+    handle = gzip.GzipFile(fileobj=StringIO(payload), mode='r')
+    result = handle.read()
+    handle.close()
+    return result
 
 
 class TestCodec(unittest2.TestCase):
@@ -21,6 +41,62 @@ class TestCodec(unittest2.TestCase):
             s2 = gzip_decode(gzip_encode(s1))
             self.assertEqual(s1, s2)
 
+    @unittest2.skipUnless(has_gzip(), "Gzip not available")
+    def test_gzip_levels(self):
+        s1 = 'afkak' * 1000
+        sizes = []
+        for level in (0, 1, 6, 9):
+            encoded = gzip_encode(s1, level)
+            sizes.append(len(encoded))
+            self.assertEqual(gzip_decode(encoded), s1)
+        self.assertEqual(sizes[0], max(sizes))
+        self.assertEqual(len(gzip_encode(s1)), sizes[-1])
+
+    @unittest2.skipUnless(has_gzip(), "Gzip not available")
+    def test_gzip_gzipfile_compatible(self):
+        s1 = random_string(1000)
+        self.assertEqual(_gzipfile_decode(gzip_encode(s1)), s1)
+        self.assertEqual(gzip_decode(_gzipfile_encode(s1)), s1)
+        # Concatenated members, with zero padding, as GzipFile supports
+        payload = gzip_encode(s1) + _gzipfile_encode(s1) + '\x00' * 8
+        self.assertEqual(gzip_decode(payload), s1 + s1)
+        self.assertEqual(gzip_decode(buffer(payload)), s1 + s1)
+
+    @unittest2.skipUnless(has_gzip(), "Gzip not available")
+    def test_gzip_decode_iter(self):
+        s1 = random_string(10000)
+        chunks = list(gzip_decode_iter(gzip_encode(s1), chunk_size=1000))
+        self.assertEqual(''.join(chunks), s1)
+        self.assertTrue(len(chunks) >= 10)
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+
+    @unittest2.skipUnless(has_gzip(), "Gzip not available")
+    def test_gzip_decode_iter_members(self):
+        s1 = random_string(100)
+        s2 = random_string(200)
+        # Concatenated members, with zero padding, as GzipFile supports
+        payload = gzip_encode(s1) + gzip_encode(s2) + '\x00' * 50
+        self.assertEqual(''.join(gzip_decode_iter(payload, 16)), s1 + s2)
+        self.assertEqual(''.join(gzip_decode_iter(payload)), s1 + s2)
+        self.assertEqual(list(gzip_decode_iter('')), [])
+
+    @unittest2.skipUnless(has_gzip(), "Gzip not available")
+    def test_gzip_truncated(self):
+        s1 = random_string(10000)
+        encoded = gzip_encode(s1)
+        for payload in (encoded[:len(encoded) // 2], encoded[:-1],
+                        encoded + encoded[:-8]):
+            with self.assertRaises(IOError):
+                gzip_decode(payload)
+            with self.assertRaises(IOError):
+                list(gzip_decode_iter(payload, 1000))
+        # The data there is is yielded first
+        chunks = []
+        with self.assertRaises(IOError):
+            for chunk in gzip_decode_iter(encoded[:-1], 1000):
+                chunks.append(chunk)
+        self.assertTrue(s1.startswith(''.join(chunks)))
+
     @unittest2.skipUnless(has_snappy(), "Snappy not available")
     def test_snappy(self):
         for i in xrange(100):
@@ -77,6 +153,28 @@ class TestCodec(unittest2.TestCase):
             to_test, xerial_compatible=True, xerial_blocksize=300)
         self.assertEqual(compressed, to_ensure)
 
+    @unittest2.skipUnless(has_snappy(), "Snappy not available")
+    def test_snappy_xerial_roundtrip(self):
+        s1 = random_string(10000)
+        for blocksize in (1, 100, 4096, 32 * 1024):
+            encoded = snappy_encode(s1, xerial_compatible=True,
+                                    xerial_blocksize=blocksize)
+            self.assertEqual(snappy_decode(encoded), s1)
+            self.assertEqual(snappy_decode(buffer(encoded)), s1)
+            self.assertEqual(snappy_decode(bytearray(encoded)), s1)
+
+    @unittest2.skipUnless(has_snappy(), "Snappy not available")
+    def test_snappy_decode_xerial_truncated(self):
+        encoded = snappy_encode(random_string(1000), xerial_compatible=True,
+                                xerial_blocksize=100)
+        # Cut off inside a block, and inside a block's length
+        for truncated in (encoded[:-1], encoded[:18]):
+            with self.assertRaises(IOError):
+                snappy_decode(truncated)
+        # A negative block length
+        with self.assertRaises(IOError):
+            snappy_decode(encoded[:16] + struct.pack('!i', -1) + encoded[20:])
+
     @unittest2.skipUnless(has_snappy(), "Snappy not available")
     def test_snappy_raises_when_not_present(self):
         with patch.object(afkak.codec, 'has_snappy',
@@ -86,9 +184,76 @@ class TestCodec(unittest2.TestCase):
             with self.assertRaises(NotImplementedError):
                 snappy_decode("Snappy not available")
 
+    @unittest2.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4(self):
+        for i in xrange(100):
+            s1 = random_string(120)
+            s2 = lz4_decode(lz4_encode(s1))
+            self.assertEqual(s1, s2)
+
+    @unittest2.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4_kafka_framing(self):
+        import lz4.frame
+        import xxhash
+        s1 = random_string(100000)
+        encoded = lz4_encode(s1)
+        # Magic, FLG with independent blocks, no content size, & Kafka's HC
+        self.assertEqual(encoded[:4], '\x04\x22\x4d\x18')
+        self.assertEqual(ord(encoded[4]) & 0x28, 0x20)
+        self.assertEqual(
+            ord(encoded[6]),
+            (xxhash.xxh32(encoded[:6]).intdigest() >> 8) & 0xff)
+        # Standard LZ4 frames are accepted too
+        self.assertEqual(lz4_decode(lz4.frame.compress(s1)), s1)
+
+    @unittest2.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4_raises_when_not_present(self):
+        with patch.object(afkak.codec, 'has_lz4', return_value=False):
+            with self.assertRaises(NotImplementedError):
+                lz4_encode("LZ4 not available")
+            with self.assertRaises(NotImplementedError):
+                lz4_decode("LZ4 not available")
+
+    def test_lz4_import_fails(self):
+        import sys
+        with patch.dict(sys.modules, values={'lz4.frame': None}):
+            reload(afkak.codec)
+            self.assertFalse(afkak.codec.has_lz4())
+        reload(afkak.codec)
+
     def test_snappy_import_fails(self):
         import sys
         with patch.dict(sys.modules, values={'snappy': None}):
             reload(afkak.codec)
             self.assertFalse(afkak.codec.has_snappy())
         reload(afkak.codec)
+
+
+class TestCodecBenchmark(unittest2.TestCase):
+    """Timings for the codecs. See testutil.benchmark()"""
+
+    @benchmark
+    def test_gzip_throughput(self):
+        print("\n{:<24} {:>10} {:>10} {:>7}".format(
+            "payload", "GzipFile", "zlib", "gain"))
+        for size in (1024, 16 * 1024, 256 * 1024, 1024 * 1024,
+                     10 * 1024 * 1024):
+            # Half random, half repetitive, to be somewhat compressible
+            payload = os.urandom(size // 2) + 'afkak' * (size // 10)
+            payload += ' ' * (size - len(payload))
+            number = max(1, (1024 * 1024) // size)
+            encoded = gzip_encode(payload)
+            cases = [
+                ("encode", lambda: _gzipfile_encode(payload),
+                 lambda: gzip_encode(payload)),
+                ("encode level 1", lambda: _gzipfile_encode(payload, 1),
+                 lambda: gzip_encode(payload, 1)),
+                ("decode", lambda: _gzipfile_decode(encoded),
+                 lambda: gzip_decode(encoded)),
+            ]
+            for name, old, new in cases:
+                old = time_per_call(old, number)
+                new = time_per_call(new, number)
+                print("{:<24} {:>7.1f}MB/s {:>7.1f}MB/s {:>6.2f}x".format(
+                    "{} {}KB".format(name, size // 1024),
+                    size / old / 1e6, size / new / 1e6, old / new))
@@ -16,6 +16,7 @@ from afkak.common import (
     OffsetOutOfRangeError, OffsetMetadataTooLargeError,
     NotCoordinatorForConsumerError, OffsetsLoadInProgressError,
     ConsumerCoordinatorNotAvailableError, ConsumerMetadataResponse,
+    MessageBatch, SourcedMessage, Message,
 )
 
 
@@ -57,3 +58,44 @@ class TestAfkakCommon(unittest2.TestCase):
 
         for resp, e in responses:
             self.assertTrue(isinstance(check_error(resp, False), e))
+
+
+class TestMessageBatch(unittest2.TestCase):
+    def _make_batch(self):
+        data = 'k0v0v1k2v2'
+        return MessageBatch(
+            'topic', 2, data, offsets=[10, 11, 12], attributes=[0, 0, 0],
+            key_starts=[0, 4, 6], key_lengths=[2, -1, 2],
+            value_starts=[2, 4, 8], value_lengths=[2, 2, 2])
+
+    def test_sequence(self):
+        batch = self._make_batch()
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch[0], SourcedMessage(
+            'topic', 2, 10, Message(0, 0, 'k0', 'v0')))
+        self.assertEqual(batch[-1], SourcedMessage(
+            'topic', 2, 12, Message(0, 0, 'k2', 'v2')))
+        self.assertEqual(batch[1].message.key, None)
+        self.assertEqual([m.offset for m in batch], [10, 11, 12])
+        with self.assertRaises(IndexError):
+            batch[3]
+        with self.assertRaises(IndexError):
+            batch[-4]
+
+    def test_slice(self):
+        batch = self._make_batch()
+        tail = batch[1:]
+        self.assertIsInstance(tail, MessageBatch)
+        self.assertIs(tail.data, batch.data)
+        self.assertEqual(list(tail), list(batch)[1:])
+        self.assertEqual(len(batch[5:]), 0)
+
+    def test_columns(self):
+        batch = self._make_batch()
+        self.assertEqual(list(batch.offsets), [10, 11, 12])
+        self.assertEqual(list(batch.keys()), ['k0', None, 'k2'])
+        self.assertEqual(list(batch.values()), ['v0', 'v1', 'v2'])
+        self.assertEqual(batch.value(1), 'v1')
+        self.assertEqual(batch.key(1), None)
+        self.assertEqual(
+            repr(batch), '<MessageBatch topic=topic partition=2 messages=3>')
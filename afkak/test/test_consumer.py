@@ -14,19 +14,20 @@ from twisted.trial import unittest
 from afkak.consumer import (Consumer, FETCH_BUFFER_SIZE_BYTES,)
 from afkak.common import (
     KafkaUnavailableError, OffsetOutOfRangeError,
-    InvalidConsumerGroupError, ConsumerFetchSizeTooSmall,
+    InvalidConsumerGroupError, ConsumerFetchSizeTooSmall, ChecksumError,
     OperationInProgress,
     OffsetFetchRequest, OffsetFetchResponse,
     OffsetCommitRequest, OffsetCommitResponse,
     OffsetRequest, OffsetResponse,
     FetchRequest, FetchResponse,
-    Message, SourcedMessage,
+    Message, SourcedMessage, MessageBatch,
     KAFKA_SUCCESS,
     OFFSET_EARLIEST, OFFSET_LATEST, OFFSET_COMMITTED,
     TIMESTAMP_INVALID)
 
-from afkak.kafkacodec import (create_message, KafkaCodec)
+from afkak.kafkacodec import (create_message, KafkaCodec, CRC_CHECK_OUTER)
 import afkak.consumer as kconsumer  # for patching
+from afkak.timingwheel import TimingWheel
 
 log = logging.getLogger(__name__)
 
@@ -128,6 +129,11 @@ class TestAfkakConsumer(unittest.TestCase):
         self.assertEqual(clock, mockClock)
         self.assertEqual(consumer._clock, mockClock)
 
+    def test_consumer_get_clock_timing_wheel(self):
+        wheel = TimingWheel(reactor=MemoryReactorClock())
+        consumer = Consumer(Mock(timing_wheel=wheel), 'topic', 23, Mock())
+        self.assertIs(consumer._get_clock(), wheel)
+
     def test_consumer_repr(self):
         mockClient = Mock()
         processor = '<function consume_msgs() at 0x12345678>'
@@ -987,6 +993,132 @@ class TestAfkakConsumer(unittest.TestCase):
         consumer.stop()
         mockback.assert_called_once_with('Stopped')
 
+    def test_consumer_message_batches(self):
+        topic = 'message_batches'
+        part = 3
+        offset = 11
+        mock_proc = Mock()
+        mockclient = Mock()
+        reqs_ds = [Deferred(), Deferred()]
+        mockclient.send_fetch_request.side_effect = reqs_ds
+
+        consumer = Consumer(mockclient, topic, part, mock_proc,
+                            message_batches=True)
+        consumer.start(offset)
+        request = FetchRequest(topic, part, offset, consumer.buffer_size)
+        mockclient.send_fetch_request.assert_called_once_with(
+            [request], max_wait_time=consumer.fetch_max_wait_time,
+            min_bytes=consumer.fetch_min_bytes, raw_message_sets=True)
+
+        # Deliver a raw message set starting before our fetch offset, as
+        # happens with compressed message sets
+        messages = [create_message("v9"), create_message("v10"),
+                    create_message("v11"), create_message("v12")]
+        message_set = KafkaCodec._encode_message_set(messages, 9)
+        responses = [
+            FetchResponse(topic, part, KAFKA_SUCCESS, 99, message_set)]
+        reqs_ds[0].callback(responses)
+
+        batch = mock_proc.call_args[0][1]
+        self.assertIsInstance(batch, MessageBatch)
+        self.assertEqual(list(batch), [
+            SourcedMessage(topic, part, 11, create_message("v11")),
+            SourcedMessage(topic, part, 12, create_message("v12"))])
+        self.assertEqual(consumer._fetch_offset, 13)
+        consumer.stop()
+
+    def test_consumer_message_batches_checksum_error(self):
+        """
+        The messages before one with a bad CRC are processed, as when the
+        message set is iterated, and the fetch is retried from the bad one
+        """
+        topic = 'message_batches'
+        part = 3
+        mock_proc = Mock()
+        mockclient = Mock()
+        reqs_ds = [Deferred(), Deferred()]
+        mockclient.send_fetch_request.side_effect = reqs_ds
+        clock = MemoryReactorClock()
+
+        consumer = Consumer(mockclient, topic, part, mock_proc,
+                            message_batches=True)
+        consumer._clock = clock
+        retry_delay = consumer.retry_delay
+        consumer.start(11)
+        messages = [create_message("v11"), create_message("v12")]
+        message_set = bytearray(KafkaCodec._encode_message_set(messages, 11))
+        message_set[-1] ^= 0xff  # Corrupt v12
+        reqs_ds[0].callback([FetchResponse(
+            topic, part, KAFKA_SUCCESS, 99, bytes(message_set))])
+
+        mock_proc.assert_called_once_with(consumer, ANY)
+        self.assertEqual(list(mock_proc.call_args[0][1]), [
+            SourcedMessage(topic, part, 11, messages[0])])
+        self.assertEqual(consumer._fetch_offset, 12)
+        self.assertIsNone(consumer._request_d)
+        clock.advance(retry_delay)
+        request = FetchRequest(topic, part, 12, consumer.buffer_size)
+        mockclient.send_fetch_request.assert_called_with(
+            [request], max_wait_time=consumer.fetch_max_wait_time,
+            min_bytes=consumer.fetch_min_bytes, raw_message_sets=True)
+        consumer.stop()
+
+    def test_consumer_decode_pool(self):
+        topic = 'decode_pool'
+        part = 3
+        offset = 11
+        mock_proc = Mock()
+        mockclient = Mock()
+        reqs_ds = [Deferred(), Deferred(), Deferred()]
+        mockclient.send_fetch_request.side_effect = reqs_ds
+        pool = Mock()
+
+        consumer = Consumer(mockclient, topic, part, mock_proc,
+                            decode_pool=pool)
+        consumer.start(offset)
+        request = FetchRequest(topic, part, offset, consumer.buffer_size)
+        mockclient.send_fetch_request.assert_called_once_with(
+            [request], max_wait_time=consumer.fetch_max_wait_time,
+            min_bytes=consumer.fetch_min_bytes, decode_pool=pool)
+
+        # The client delivers a batch decoded by the pool, which we hand to
+        # the processor as a list of SourcedMessage
+        messages = [create_message("v11"), create_message("v12")]
+        batch = KafkaCodec.decode_message_set_batch(
+            topic, part, KafkaCodec._encode_message_set(messages, 11))
+        reqs_ds[0].callback(
+            [FetchResponse(topic, part, KAFKA_SUCCESS, 99, batch)])
+        mock_proc.assert_called_once_with(consumer, [
+            SourcedMessage(topic, part, 11, messages[0]),
+            SourcedMessage(topic, part, 12, messages[1])])
+        self.assertEqual(consumer._fetch_offset, 13)
+
+        # A message set the pool failed to decode raises from its messages
+        def raise_too_small():
+            raise ConsumerFetchSizeTooSmall()
+            yield  # pragma: no cover
+        buffer_size = consumer.buffer_size
+        consumer._do_fetch()
+        reqs_ds[1].callback(
+            [FetchResponse(topic, part, KAFKA_SUCCESS, 99, raise_too_small())])
+        self.assertEqual(consumer.buffer_size, buffer_size * 2)
+        consumer.stop()
+
+    def test_consumer_check_crcs(self):
+        with self.assertRaises(ValueError):
+            Consumer(Mock(), 'topic', 0, Mock(), check_crcs='bogus')
+
+        mockclient = Mock()
+        mockclient.send_fetch_request.return_value = Deferred()
+        consumer = Consumer(mockclient, 'check_crcs', 0, Mock(),
+                            check_crcs=CRC_CHECK_OUTER)
+        consumer.start(5)
+        request = FetchRequest('check_crcs', 0, 5, consumer.buffer_size)
+        mockclient.send_fetch_request.assert_called_once_with(
+            [request], max_wait_time=consumer.fetch_max_wait_time,
+            min_bytes=consumer.fetch_min_bytes, check_crcs=CRC_CHECK_OUTER)
+        consumer.stop()
+
     def test_consumer_do_fetch_not_reentrant(self):
         # This test is a bit of a hack to get coverage
         mockclient = Mock()
@@ -10,6 +10,9 @@ from __future__ import division, absolute_import
 from unittest2 import TestCase, SkipTest
 
 from contextlib import contextmanager
+from fractions import Fraction
+import multiprocessing
+import pickle
 import struct
 
 import mock
@@ -22,18 +25,23 @@ from afkak.common import (
     ConsumerFetchSizeTooSmall, ProduceResponse, FetchResponse,
     OffsetAndMessage, BrokerMetadata, PartitionMetadata, TopicMetadata,
     ProtocolError, UnsupportedCodecError, InvalidMessageError,
-    ConsumerMetadataResponse,
+    ConsumerMetadataResponse, BufferUnderflowError, MessageBatch,
+    SourcedMessage,
 )
 from afkak.codec import (
-    has_snappy, gzip_decode, snappy_decode
+    has_snappy, has_lz4, gzip_encode, gzip_decode, snappy_decode, lz4_decode
 )
 import afkak.kafkacodec
+import afkak.util
 from afkak.kafkacodec import (
-    ATTRIBUTE_CODEC_MASK, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY,
+    ATTRIBUTE_CODEC_MASK, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4,
+    CRC_CHECK_ALL, CRC_CHECK_OUTER, validate_check_crcs,
     create_message, create_gzip_message, create_snappy_message,
+    create_lz4_message,
     create_message_set, KafkaCodec
 )
-from .testutil import make_send_requests
+from .testutil import (
+    make_send_requests, random_string, benchmark, time_per_call)
 
 
 def create_encoded_metadata_response(broker_data, topic_data):
@@ -133,6 +141,18 @@ class TestKafkaCodec(TestCase):
 
         self.assertEqual(decoded, expect)
 
+
+    def test_create_snappy_xerial(self):
+        if not has_snappy():
+            raise SkipTest("Snappy not available")  # pragma: no cover
+        message_list = [create_message("v3" * 100, key='84'),
+                        create_message("v4" * 100, None)]
+        msg = create_snappy_message(message_list, xerial_blocksize=64)
+        self.assertEqual(msg.attributes, ATTRIBUTE_CODEC_MASK & CODEC_SNAPPY)
+        self.assertTrue(msg.value.startswith(b'\x82SNAPPY\x00'))
+        self.assertEqual(snappy_decode(msg.value),
+                         KafkaCodec._encode_message_set(message_list))
+
     def test_encode_message_header(self):
         expect = "".join([
             struct.pack(">h", 10),              # API Key
@@ -176,6 +196,32 @@ class TestKafkaCodec(TestCase):
         self.assertEqual(returned_offset, offset)
         self.assertEqual(decoded_message, create_message("test", "key"))
 
+    def test_decode_message_in_place(self):
+        encoded = "".join([
+            struct.pack(">i", -1427009701),  # CRC
+            struct.pack(">bb", 0, 0),        # Magic, flags
+            struct.pack(">i", 3),            # Length of key
+            "key",                           # key
+            struct.pack(">i", 4),            # Length of value
+            "test",                          # value
+        ])
+        # The message may be anywhere in a larger buffer
+        frame = bytearray("junk" + encoded + "more junk")
+
+        (returned_offset, decoded_message), = list(
+            KafkaCodec._decode_message(frame, 7, 4, 4 + len(encoded)))
+
+        self.assertEqual(returned_offset, 7)
+        self.assertEqual(decoded_message, create_message("test", "key"))
+        self.assertIs(type(decoded_message.key), str)
+        self.assertIs(type(decoded_message.value), str)
+
+    def test_decode_message_truncated(self):
+        encoded = KafkaCodec._encode_message(create_message("test", "key"))
+        self.assertRaises(
+            BufferUnderflowError, list,
+            KafkaCodec._decode_message(encoded, 0, 0, 5))
+
     def test_encode_message_failure(self):
         self.assertRaises(ProtocolError,
                           KafkaCodec._encode_message,
@@ -264,6 +310,126 @@ class TestKafkaCodec(TestCase):
         self.assertEqual(returned_offset2, 0)
         self.assertEqual(decoded_message2, create_message("v2"))
 
+    def test_decode_message_gzip_min_offset(self):
+        msgs = [create_message("v%d" % i) for i in range(100)]
+        # Offsets within a compressed message set count up from zero
+        inner = KafkaCodec._encode_message_set(msgs, 0)
+        gz = Message(0, CODEC_GZIP, None, gzip_encode(inner))
+        encoded = KafkaCodec._encode_message(gz)
+
+        with mock.patch.object(afkak.kafkacodec, '_copy_bytes',
+                               wraps=afkak.kafkacodec._copy_bytes) as copy:
+            messages = list(KafkaCodec._decode_message(encoded, 99, 0, None,
+                                                       95))
+        self.assertEqual([m for (o, m) in messages], msgs[95:])
+        self.assertEqual([o for (o, m) in messages], range(95, 100))
+        # Only the keys and values of the wanted messages were copied
+        self.assertEqual(copy.call_count, 10)
+
+    def _corrupt_gzip_message_set(self):
+        # A gzipped message whose own CRC is fine, but whose second inner
+        # message has a bad CRC
+        msgs = [create_message("v1"), create_message("v2")]
+        inner = bytearray(KafkaCodec._encode_message_set(msgs, 0))
+        inner[len(inner) // 2 + 12] ^= 0xff
+        gz = Message(0, CODEC_GZIP, None, gzip_encode(bytes(inner)))
+        return msgs, KafkaCodec._encode_message_set([gz], 1)
+
+    def test_decode_message_set_check_crcs(self):
+        msgs, encoded = self._corrupt_gzip_message_set()
+
+        for check_crcs in (CRC_CHECK_ALL, 1.0):
+            messages = KafkaCodec._decode_message_set_iter(
+                encoded, check_crcs=check_crcs)
+            self.assertEqual(next(messages), OffsetAndMessage(0, msgs[0]))
+            with self.assertRaises(ChecksumError) as cm:
+                list(messages)
+            self.assertIn("offset 1", str(cm.exception))
+            # As when iterating, the messages before the bad one are kept
+            with self.assertRaises(ChecksumError) as cm:
+                KafkaCodec.decode_message_set_batch(
+                    "topic", 0, encoded, check_crcs=check_crcs)
+            self.assertIn("offset 1", str(cm.exception))
+            self.assertEqual(list(cm.exception.batch),
+                             [SourcedMessage("topic", 0, 0, msgs[0])])
+
+        # The outer message's CRC is correct, so the inner ones are trusted
+        expect = [OffsetAndMessage(0, msgs[0]), OffsetAndMessage(1, msgs[1])]
+        for check_crcs in (CRC_CHECK_OUTER, 0.0):
+            self.assertEqual(list(KafkaCodec._decode_message_set_iter(
+                encoded, check_crcs=check_crcs)), expect)
+            batch = KafkaCodec.decode_message_set_batch(
+                "topic", 0, encoded, check_crcs=check_crcs)
+            self.assertEqual(list(batch.values()), ["v1", "v2"])
+
+    def test_decode_message_set_check_crcs_sample(self):
+        encoded = bytearray(KafkaCodec._encode_message_set(
+            [create_message("v1")]))
+        encoded[12] ^= 0xff  # Corrupt the CRC
+        encoded = bytes(encoded)
+        with mock.patch.object(afkak.kafkacodec.random, 'random',
+                               side_effect=[0.6, 0.4]):
+            # Not sampled
+            self.assertEqual(len(list(KafkaCodec._decode_message_set_iter(
+                encoded, check_crcs=0.5))), 1)
+            # Sampled
+            with self.assertRaises(ChecksumError):
+                list(KafkaCodec._decode_message_set_iter(
+                    encoded, check_crcs=0.5))
+
+    def test_validate_check_crcs(self):
+        for check_crcs in (CRC_CHECK_ALL, CRC_CHECK_OUTER, 0.0, 0.01, 1.0,
+                           0, 1, 1L, Fraction(1, 3)):
+            validate_check_crcs(check_crcs)
+        for check_crcs in (None, 'some', 2.0, -0.1, 2, -1, True):
+            with self.assertRaises(ValueError):
+                validate_check_crcs(check_crcs)
+
+    def test_decode_message_set_stream(self):
+        msgs = [create_message("v%d" % i, "k%d" % i) for i in range(10)]
+        encoded = KafkaCodec._encode_message_set(msgs, 5)
+
+        # Deliver the message set a byte at a time, and in one piece
+        for chunks in (list(encoded), [encoded]):
+            decoded = list(KafkaCodec._decode_message_set_stream(chunks, 9))
+            self.assertEqual(decoded, [OffsetAndMessage(5 + i, msg)
+                                       for i, msg in enumerate(msgs)][4:])
+
+    def test_decode_message_set_stream_truncated(self):
+        encoded = KafkaCodec._encode_message_set(
+            [create_message("v1"), create_message("v2")])
+        decoded = list(KafkaCodec._decode_message_set_stream([encoded[:-3]]))
+        self.assertEqual(decoded, [OffsetAndMessage(0, create_message("v1"))])
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            list(KafkaCodec._decode_message_set_stream([encoded[:20]]))
+
+    def test_create_lz4(self):
+        if not has_lz4():
+            raise SkipTest("LZ4 not available")  # pragma: no cover
+        message_list = [create_message("v5", key='42'),
+                        create_message("v6", None)]
+        msg = create_lz4_message(message_list)
+        self.assertEqual(msg.magic, 0)
+        self.assertEqual(msg.attributes, ATTRIBUTE_CODEC_MASK & CODEC_LZ4)
+        self.assertEqual(msg.key, None)
+        self.assertEqual(lz4_decode(msg.value),
+                         KafkaCodec._encode_message_set(message_list))
+
+    def test_decode_message_lz4(self):
+        if not has_lz4():
+            raise SkipTest("LZ4 not available")  # pragma: no cover
+        msgs = [create_message("v1", "k1"), create_message("v2")]
+        encoded = KafkaCodec._encode_message_set(
+            [create_message("plain"), create_lz4_message(msgs)])
+
+        decoded = list(KafkaCodec._decode_message_set_iter(encoded))
+        self.assertEqual(
+            decoded, [OffsetAndMessage(0, create_message("plain")),
+                      OffsetAndMessage(0, msgs[0]),
+                      OffsetAndMessage(0, msgs[1])])
+        batch = KafkaCodec.decode_message_set_batch("topic", 0, encoded)
+        self.assertEqual(list(batch.values()), ["plain", "v1", "v2"])
+
     def test_decode_message_snappy(self):
         if not has_snappy():
             raise SkipTest("Snappy not available")  # pragma: no cover
@@ -397,6 +563,60 @@ class TestKafkaCodec(TestCase):
             "client1", 2, requests, 2, 100)
         self.assertIn(encoded, [expected1, expected2])
 
+    def test_encode_produce_request_sequence(self):
+        big = random_string(afkak.kafkacodec.SCATTER_VALUE_SIZE)
+        bigger = random_string(afkak.kafkacodec.SCATTER_VALUE_SIZE * 3)
+        # A large value which isn't a str is copied in, as usual
+        big_array = bytearray(big)
+        requests = [
+            ProduceRequest("topic1", 0, [
+                create_message("a"),
+                create_message(big, "key"),
+                create_message(None),
+                create_message(bigger),
+            ]),
+            ProduceRequest("topic2", 1, [
+                create_message(big_array),
+                create_message("c"),
+            ]),
+            ProduceRequest("topic3", 0, []),
+        ]
+
+        sequence = KafkaCodec.encode_produce_request_sequence(
+            "client1", 2, requests, 2, 100)
+        self.assertEqual(''.join(sequence),
+                         KafkaCodec.encode_produce_request(
+                             "client1", 2, requests, 2, 100))
+        # The large str values are the original objects, between strings of
+        # the rest of the request
+        self.assertEqual(len(sequence), 5)
+        self.assertEqual([v for v in sequence if v is big or v is bigger],
+                         [big, bigger])
+        self.assertTrue(all(isinstance(v, str) for v in sequence))
+
+        # Without any large values, the request is a single string
+        sequence = KafkaCodec.encode_produce_request_sequence(
+            "client1", 2, requests[2:], 2, 100)
+        self.assertEqual(sequence, [KafkaCodec.encode_produce_request(
+            "client1", 2, requests[2:], 2, 100)])
+
+    def test_encode_produce_request_many_messages(self):
+        topic = "topic1"
+        msgs = [create_message("value%d" % i, "key%d" % i)
+                for i in range(10000)]
+        encoded = KafkaCodec.encode_produce_request(
+            "client1", 5, [ProduceRequest(topic, 3, msgs)])
+
+        # Header, acks/timeout/topics, topic, partitions, partition/size
+        set_start = 2 + 2 + 4 + 2 + 7 + 2 + 4 + 4 + 2 + 6 + 4 + 4 + 4
+        (partition, set_size) = struct.unpack_from('>ii', encoded,
+                                                   set_start - 8)
+        self.assertEqual(partition, 3)
+        self.assertEqual(set_start + set_size, len(encoded))
+        decoded = list(KafkaCodec._decode_message_set_iter(
+            encoded, set_start, len(encoded)))
+        self.assertEqual(decoded, [OffsetAndMessage(0, m) for m in msgs])
+
     def test_decode_produce_response(self):
         t1 = "topic1"
         t2 = "topic2"
@@ -478,6 +698,139 @@ class TestKafkaCodec(TestCase):
                                                OffsetAndMessage(0, msgs[4])])]
         self.assertEqual(expanded_responses, expect)
 
+        # KafkaProtocol hands over large responses as a buffer onto a
+        # bytearray, from which the same strings are decoded
+        responses = KafkaCodec.decode_fetch_response(
+            buffer(bytearray(encoded)))
+        self.assertEqual(map(expand_messages, responses), expect)
+
+    def test_decode_fetch_response_truncated_message_set(self):
+        t1 = "topic1"
+        ms1 = KafkaCodec._encode_message_set(
+            [create_message("message1"), create_message("message2")])
+        # Broker cut off the second message part way through
+        ms1 = ms1[:-3]
+        encoded = struct.pack('>iih%dsiihqi%ds' % (len(t1), len(ms1)),
+                              4, 1, len(t1), t1, 1, 0, 0, 10, len(ms1), ms1)
+
+        response, = list(KafkaCodec.decode_fetch_response(encoded))
+        self.assertEqual(list(response.messages),
+                         [OffsetAndMessage(0, create_message("message1"))])
+
+    def test_decode_fetch_response_min_offsets(self):
+        t1 = "topic1"
+        ms1 = KafkaCodec._encode_message_set(
+            [create_message("message1"), create_message("message2"),
+             create_message("message3")], 20)
+        encoded = struct.pack('>iih%dsiihqi%ds' % (len(t1), len(ms1)),
+                              4, 1, len(t1), t1, 1, 0, 0, 30, len(ms1), ms1)
+
+        response, = list(KafkaCodec.decode_fetch_response(
+            encoded, min_offsets={(t1, 0): 21, (t1, 1): 100}))
+        self.assertEqual(list(response.messages),
+                         [OffsetAndMessage(21, create_message("message2")),
+                          OffsetAndMessage(22, create_message("message3"))])
+
+    def test_decode_fetch_response_raw_message_sets(self):
+        t1 = "topic1"
+        ms1 = KafkaCodec._encode_message_set(
+            [create_message("message1"), create_message("message2")])
+        encoded = struct.pack('>iih%dsiihqi%ds' % (len(t1), len(ms1)),
+                              4, 1, len(t1), t1, 1, 0, 0, 10, len(ms1), ms1)
+
+        response, = list(KafkaCodec.decode_fetch_response(
+            encoded, raw_message_sets=True))
+        self.assertEqual((response.topic, response.partition), (t1, 0))
+        self.assertEqual(str(response.messages), ms1)
+
+    def test_decode_message_set_batch(self):
+        msgs = [create_message("v1", "k1"), create_message("v2"),
+                create_message(None, "k3")]
+        ms = KafkaCodec._encode_message_set(msgs, 7)
+        # Surround the message set with junk, to decode it in place
+        data = 'junk' + ms + 'more junk'
+
+        batch = KafkaCodec.decode_message_set_batch(
+            "topic", 3, data, 4, 4 + len(ms))
+        self.assertIsInstance(batch, MessageBatch)
+        self.assertIs(batch.data, data)
+        self.assertEqual(list(batch.offsets), [7, 8, 9])
+        self.assertEqual(list(batch.keys()), ["k1", None, "k3"])
+        self.assertEqual(list(batch.values()), ["v1", "v2", None])
+        self.assertEqual(list(batch), [
+            SourcedMessage("topic", 3, 7 + i, msg)
+            for i, msg in enumerate(msgs)])
+
+    def test_decode_message_set_batch_compressed(self):
+        gz = create_gzip_message(
+            [create_message("g1"), create_message("g2")])
+        msgs = [create_message("v1"), gz, create_message("v2"), gz]
+        ms = KafkaCodec._encode_message_set(msgs)
+
+        batch = KafkaCodec.decode_message_set_batch("topic", 0, ms)
+        self.assertEqual(list(batch.values()),
+                         ["v1", "g1", "g2", "v2", "g1", "g2"])
+        self.assertEqual(list(batch.offsets), [0] * 6)
+        self.assertEqual(batch[1].message, create_message("g1"))
+
+        # A set holding only a compressed message refers to just its
+        # decompressed contents
+        batch = KafkaCodec.decode_message_set_batch(
+            "topic", 0, KafkaCodec._encode_message_set([gz]))
+        self.assertEqual(batch.data, gzip_decode(gz.value))
+        self.assertEqual(list(batch.values()), ["g1", "g2"])
+
+    def test_decode_message_set_batch_truncated(self):
+        ms = KafkaCodec._encode_message_set(
+            [create_message("message1"), create_message("message2")])
+
+        batch = KafkaCodec.decode_message_set_batch("topic", 0, ms[:-3])
+        self.assertEqual(list(batch.values()), ["message1"])
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            KafkaCodec.decode_message_set_batch("topic", 0, ms[:10])
+
+    def test_decode_message_set_batch_task(self):
+        msgs = [create_message("v%d" % i) for i in range(4)]
+        ms = KafkaCodec._encode_message_set(msgs, 10)
+
+        success, batch = afkak.kafkacodec._decode_message_set_batch_task(
+            "topic", 1, ms, 12)
+        self.assertTrue(success)
+        self.assertEqual(list(batch.offsets), [12, 13])
+        # The caller has the data already, so the batch doesn't carry it
+        self.assertIs(batch.data, None)
+
+        success, error = afkak.kafkacodec._decode_message_set_batch_task(
+            "topic", 1, ms[:10])
+        self.assertFalse(success)
+        self.assertIsInstance(error, ConsumerFetchSizeTooSmall)
+
+        # A ChecksumError carries the messages before the bad one, trimmed
+        corrupt = bytearray(ms)
+        corrupt[-1] ^= 0xff
+        success, error = afkak.kafkacodec._decode_message_set_batch_task(
+            "topic", 1, bytes(corrupt), 11)
+        self.assertFalse(success)
+        self.assertIsInstance(error, ChecksumError)
+        # It survives being sent back from a worker process
+        error = pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(list(error.batch.offsets), [11, 12])
+        self.assertIs(error.batch.data, None)
+
+    def test_decode_message_set_batch_task_process_pool(self):
+        gz = create_gzip_message([create_message("v1"), create_message("v2")])
+        ms = KafkaCodec._encode_message_set([gz])
+        pool = multiprocessing.Pool(1)
+        try:
+            success, batch = pool.apply(
+                afkak.kafkacodec._decode_message_set_batch_task,
+                ("topic", 1, ms))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertTrue(success)
+        self.assertEqual(list(batch.values()), ["v1", "v2"])
+
     def test_encode_metadata_request_no_topics(self):
         expected = "".join([
             struct.pack('>h', 3),           # API key metadata fetch
@@ -741,7 +1094,9 @@ class TestKafkaCodec(TestCase):
                                return_value=sentinel.gzip_message)
         p3 = mock.patch.object(afkak.kafkacodec, "create_snappy_message",
                                return_value=sentinel.snappy_message)
-        with p1, p2, p3:
+        p4 = mock.patch.object(afkak.kafkacodec, "create_lz4_message",
+                               return_value=sentinel.lz4_message)
+        with p1, p2, p3, p4:
             yield
 
     def test_create_message_set(self):
@@ -772,6 +1127,12 @@ class TestKafkaCodec(TestCase):
             message_set = create_message_set(reqs, CODEC_SNAPPY)
         self.assertEqual(message_set, expect)
 
+        # CODEC_LZ4: Expect list of one LZ4-encoded message.
+        expect = [sentinel.lz4_message]
+        with self.mock_create_message_fns():
+            message_set = create_message_set(reqs, CODEC_LZ4)
+        self.assertEqual(message_set, expect)
+
         # Unknown codec should raise UnsupportedCodecError.
         self.assertRaises(UnsupportedCodecError,
                           create_message_set, reqs, -1)
@@ -801,3 +1162,87 @@ class TestKafkaCodec(TestCase):
         ])
         decoded = KafkaCodec.decode_consumermetadata_response(encoded)
         self.assertEqual(decoded, expected)
+
+
+class TestKafkaCodecBenchmark(TestCase):
+    """Timings for the hot encode/decode paths. See testutil.benchmark()"""
+
+    def _report(self, name, old, new):
+        print("{:<40} {:>9.2f}us {:>9.2f}us {:>6.2f}x".format(
+            name, old * 1e6, new * 1e6, old / new))
+
+    @benchmark
+    def test_struct_vs_format_string(self):
+        print("\n{:<40} {:>11} {:>11} {:>7}".format(
+            "layout", "fmt string", "Struct", "gain"))
+        client_id = "afkak-client"
+        topic = "benchmark-topic"
+        compiled = afkak.kafkacodec
+        cases = [
+            ("request header",
+             lambda: struct.pack('>hhih%ds' % len(client_id), 0, 0, 1,
+                                 len(client_id), client_id),
+             lambda: compiled._REQUEST_HEADER.pack(
+                 0, 0, 1, len(client_id)) + client_id),
+            ("topic name + partition count",
+             lambda: struct.pack('>h%dsi' % len(topic), len(topic), topic, 1),
+             lambda: afkak.util.write_short_string(topic) +
+             afkak.util.INT32.pack(1)),
+            ("fetch partition header",
+             lambda: struct.pack('>iqi', 1, 1000, 4096),
+             lambda: compiled._PARTITION_OFFSET_SIZE.pack(1, 1000, 4096)),
+            ("message set offset/size",
+             lambda: struct.unpack('>qi', '\x00' * 12),
+             lambda: compiled._OFFSET_SIZE.unpack('\x00' * 12)),
+            ("metadata partition row",
+             lambda: afkak.util.relative_unpack('>hiii', '\x00' * 14, 0),
+             lambda: afkak.util.relative_unpack(
+                 compiled._METADATA_PARTITION, '\x00' * 14, 0)),
+        ]
+        for name, old, new in cases:
+            self._report(name, time_per_call(old, 10000),
+                         time_per_call(new, 10000))
+
+    @benchmark
+    def test_produce_fetch_round_trip(self):
+        topic = "benchmark-topic"
+        msgs = [create_message("x" * 100, "key") for _ in range(10)]
+        produce_payloads = [ProduceRequest(topic, p, msgs) for p in range(10)]
+        fetch_payloads = [FetchRequest(topic, p, 0, 4096) for p in range(10)]
+        produce_response = struct.pack('>iih%dsi' % len(topic), 1, 1,
+                                       len(topic), topic, 10)
+        fetch_response = struct.pack('>iih%dsi' % len(topic), 1, 1,
+                                     len(topic), topic, 10)
+        msg_set = KafkaCodec._encode_message_set(msgs)
+        for p in range(10):
+            produce_response += struct.pack('>ihq', p, 0, 100)
+            fetch_response += struct.pack('>ihqi', p, 0, 100, len(msg_set))
+            fetch_response += msg_set
+
+        def produce():
+            KafkaCodec.encode_produce_request(
+                "afkak-client", 1, produce_payloads)
+            list(KafkaCodec.decode_produce_response(produce_response))
+
+        def fetch():
+            KafkaCodec.encode_fetch_request("afkak-client", 1, fetch_payloads)
+            for resp in KafkaCodec.decode_fetch_response(fetch_response):
+                list(resp.messages)
+
+        print("\nproduce round trip (10 x 10 msgs): {:.2f}us".format(
+            time_per_call(produce, 200) * 1e6))
+        print("fetch round trip (10 x 10 msgs): {:.2f}us".format(
+            time_per_call(fetch, 200) * 1e6))
+
+    @benchmark
+    def test_encode_produce_request_scaling(self):
+        print("\n{:>10} {:>12} {:>14}".format(
+            "messages", "encode (ms)", "per msg (us)"))
+        for count in (1000, 10000, 100000):
+            msgs = [create_message("x" * 100, "key")] * count
+            payloads = [ProduceRequest("benchmark-topic", 0, msgs)]
+            per_call = time_per_call(
+                lambda: KafkaCodec.encode_produce_request(
+                    "afkak-client", 1, payloads), number=3)
+            print("{:>10} {:>12.2f} {:>14.3f}".format(
+                count, per_call * 1e3, per_call * 1e6 / count))
@@ -18,6 +18,7 @@ from twisted.trial import unittest
 
 from afkak.producer import (Producer)
 import afkak.producer as aProducer
+from afkak.timingwheel import TimingWheel
 
 from afkak.common import (
     ProduceRequest,
@@ -34,7 +35,8 @@ from afkak.common import (
     PRODUCER_ACK_NOT_REQUIRED,
     )
 
-from afkak.kafkacodec import (create_message_set)
+from afkak.kafkacodec import (
+    create_message_set, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4)
 from testutil import (random_string, make_send_requests)
 
 log = logging.getLogger(__name__)
@@ -70,6 +72,12 @@ class TestAfkakProducer(unittest.TestCase):
             "Unbatched:1:1000>")
         producer.stop()
 
+    def test_producer_timing_wheel(self):
+        client = Mock(timing_wheel=TimingWheel(reactor=MemoryReactorClock()))
+        producer = Producer(client)
+        self.assertIs(producer._get_clock(), client.timing_wheel)
+        producer.stop()
+
     def test_producer_init_batch(self):
         producer = Producer(Mock(), batch_send=True)
         looper = producer.sendLooper
@@ -92,6 +100,156 @@ class TestAfkakProducer(unittest.TestCase):
             p = Producer(Mock(), codec='bogus')
             p.__repr__()  # pragma: no cover  # STFU pyflakes
 
+    def test_producer_codec_lz4(self):
+        p = Producer(Mock(), codec=CODEC_LZ4)
+        self.assertEqual(p.codec, CODEC_LZ4)
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=(CODEC_LZ4, 1))
+
+    def test_producer_codec_level(self):
+        p = Producer(Mock(), codec=(CODEC_GZIP, 1))
+        self.assertEqual((p.codec, p.codec_level), (CODEC_GZIP, 1))
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=(CODEC_GZIP, 10))
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=(CODEC_NONE, 1))
+
+    def test_producer_send_messages_codec_level(self):
+        client = Mock()
+        ret = Deferred()
+        client.send_produce_request.return_value = ret
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        msgs = [self.msg("one"), self.msg("two")]
+
+        producer = Producer(client, codec=(CODEC_GZIP, 1))
+        with patch.object(aProducer, 'create_message_set',
+                          wraps=create_message_set) as cms:
+            d = producer.send_messages(self.topic, msgs=msgs)
+        cms.assert_called_once_with(ANY, CODEC_GZIP, 1, None)
+        ret.callback([ProduceResponse(self.topic, 0, 0, 10L)])
+        self.successResultOf(d)
+        producer.stop()
+
+    def test_producer_xerial_blocksize(self):
+        p = Producer(Mock(), codec=CODEC_SNAPPY, xerial_blocksize=1024)
+        self.assertEqual((p.codec, p.xerial_blocksize), (CODEC_SNAPPY, 1024))
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=CODEC_GZIP, xerial_blocksize=1024)
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=CODEC_SNAPPY, xerial_blocksize=0)
+
+    def test_producer_send_messages_xerial_blocksize(self):
+        client = Mock()
+        ret = Deferred()
+        client.send_produce_request.return_value = ret
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        msgs = [self.msg("one"), self.msg("two")]
+
+        producer = Producer(client, codec=CODEC_SNAPPY, xerial_blocksize=1024)
+        with patch.object(aProducer, 'create_message_set',
+                          return_value=[]) as cms:
+            d = producer.send_messages(self.topic, msgs=msgs)
+        cms.assert_called_once_with(ANY, CODEC_SNAPPY, None, 1024)
+        ret.callback([ProduceResponse(self.topic, 0, 0, 10L)])
+        self.successResultOf(d)
+        producer.stop()
+
+    def test_producer_bad_compression_threads(self):
+        with self.assertRaises(ValueError):
+            Producer(Mock(), codec=CODEC_GZIP, compression_threads=-1)
+
+    def test_producer_send_messages_compression_threads(self):
+        client = Mock()
+        ret = Deferred()
+        client.send_produce_request.return_value = ret
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        msgs = [self.msg("one"), self.msg("two")]
+        calls = []
+
+        def fake_deferToThreadPool(reactor, pool, f, *args):
+            calls.append((pool, f, args))
+            return succeed(f(*args))
+
+        producer = Producer(client, codec=(CODEC_GZIP, 1),
+                            compression_threads=2)
+        with patch.object(aProducer, 'deferToThreadPool',
+                          fake_deferToThreadPool):
+            d = producer.send_messages(self.topic, msgs=msgs)
+        # The message set was created in the producer's pool
+        pool = producer._compression_pool
+        self.assertEqual(pool.max, 2)
+        [(call_pool, call_f, (reqs, codec, level, _))] = calls
+        self.assertEqual((call_pool, call_f, codec, level),
+                         (pool, create_message_set, CODEC_GZIP, 1))
+        self.assertEqual([r.messages for r in reqs], [msgs])
+        msgSet = create_message_set(make_send_requests(msgs), CODEC_GZIP, 1)
+        req = ProduceRequest(self.topic, 0, msgSet)
+        client.send_produce_request.assert_called_once_with(
+            [req], acks=producer.req_acks, timeout=producer.ack_timeout,
+            fail_on_error=False)
+        ret.callback([ProduceResponse(self.topic, 0, 0, 10L)])
+        self.successResultOf(d)
+        # Stopping the producer stops the pool
+        producer.stop()
+        self.assertIs(producer._compression_pool, None)
+        self.assertFalse(pool.started)
+
+    def test_producer_compression_threads_clock(self):
+        """
+        The thread pool's results are handed back through the producer's
+        clock, or that of its client's timing wheel
+        """
+        client = Mock()
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+        reactors = []
+
+        def fake_deferToThreadPool(reactor, pool, f, *args):
+            reactors.append(reactor)
+            return Deferred()
+
+        clock = Mock()
+        client.timing_wheel = TimingWheel(reactor=clock)
+        for producer in (
+                Producer(client, codec=CODEC_GZIP, compression_threads=1,
+                         clock=Mock()),
+                Producer(client, codec=CODEC_GZIP, compression_threads=1)):
+            with patch.object(aProducer, 'deferToThreadPool',
+                              fake_deferToThreadPool):
+                d = producer.send_messages(self.topic,
+                                           msgs=[self.msg("one")])
+            reactor = reactors.pop()
+            self.assertIs(reactor, producer._get_reactor())
+            reactor.addSystemEventTrigger.assert_called_once_with(
+                'during', 'shutdown', producer._compression_pool.stop)
+            trigger = producer._compression_pool_trigger
+            producer.stop()
+            self.failureResultOf(d, tid_CancelledError)
+            reactor.removeSystemEventTrigger.assert_called_once_with(
+                trigger)
+        self.assertIs(reactor, clock)
+
+    def test_producer_send_messages_compression_threads_failure(self):
+        client = Mock()
+        client.topic_partitions = {self.topic: [0]}
+        client.metadata_error_for_topic.return_value = False
+
+        def fake_deferToThreadPool(reactor, pool, f, *args):
+            return fail(NotImplementedError("Snappy codec is not available"))
+
+        producer = Producer(client, codec=CODEC_GZIP, compression_threads=1)
+        with patch.object(aProducer, 'deferToThreadPool',
+                          fake_deferToThreadPool):
+            d = producer.send_messages(self.topic, msgs=[self.msg("one")])
+        self.assertFalse(client.send_produce_request.called)
+        # The caller hears of the failure, and the batch is done with
+        self.failureResultOf(d, NotImplementedError)
+        self.assertIs(producer._batch_send_d, None)
+        producer.stop()
+
     def test_producer_send_empty_messages(self):
         client = Mock()
         producer = Producer(client)
@@ -1,14 +1,33 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2015 Cyan, Inc.
 
+import socket
+import struct
+
 import unittest2
 
 import afkak.protocol
-from afkak.protocol import KafkaProtocol
+from afkak.protocol import KafkaProtocol, check_socket_options
 from twisted.internet.error import ConnectionLost
+from twisted.protocols.basic import Int32StringReceiver, StringTooLongError
 from twisted.python.failure import Failure
 
-from mock import MagicMock
+from mock import MagicMock, Mock, patch
+
+from .testutil import random_string, benchmark, time_per_call
+
+
+def _frame(string):
+    return struct.pack('>i', len(string)) + string
+
+
+class _Collector(object):
+    """Stand-in factory which records the frames it is handed"""
+    def __init__(self):
+        self.responses = []
+
+    def handleResponse(self, response):
+        self.responses.append(str(response))
 
 
 class TestProtocol(unittest2.TestCase):
@@ -18,6 +37,106 @@ class TestProtocol(unittest2.TestCase):
         kp.stringReceived("testing")
         kp.factory.handleResponse.assert_called_once_with("testing")
 
+    def test_dataReceived_chunked(self):
+        strings = ["", "a", random_string(100), random_string(5000)]
+        data = ''.join(_frame(string) for string in strings)
+        # Deliver the same stream whole, in odd sized chunks (so length
+        # prefixes and frames span chunks), and a byte at a time
+        for chunk_size in (len(data), 4096, 7, 3, 1):
+            kp = KafkaProtocol()
+            kp.factory = _Collector()
+            for i in xrange(0, len(data), chunk_size):
+                kp.dataReceived(data[i:i + chunk_size])
+            self.assertEqual(kp.factory.responses, strings)
+            self.assertIsNone(kp._frame)
+            self.assertEqual(kp._header, '')
+
+    def test_dataReceived_spanning_frame(self):
+        string = random_string(1000)
+        kp = KafkaProtocol()
+        kp.factory = MagicMock()
+        data = _frame(string) + _frame("next")
+        kp.dataReceived(data[:500])
+        self.assertEqual(len(kp._frame), 1000)
+        kp.dataReceived(data[500:])
+        # The frame spanning chunks is handed over as a buffer
+        [(first,), (second,)] = [
+            args for args, _ in kp.factory.handleResponse.call_args_list]
+        self.assertIsInstance(first, buffer)
+        self.assertEqual(str(first), string)
+        self.assertEqual(second, "next")
+
+    def test_dataReceived_paused(self):
+        kp = KafkaProtocol()
+        kp.factory = MagicMock()
+        kp.transport = MagicMock()
+        kp.pauseProducing()
+        kp.dataReceived(_frame("testing"))
+        self.assertFalse(kp.factory.handleResponse.called)
+        kp.dataReceived(_frame("more"))
+        kp.resumeProducing()
+        self.assertEqual(
+            [c[0][0] for c in kp.factory.handleResponse.call_args_list],
+            ["testing", "more"])
+
+    def test_dataReceived_paused_mid_chunk(self):
+        """
+        Frames left in a chunk when stringReceived() pauses are delivered
+        on resumeProducing(), along with any which arrive in the meantime
+        """
+        kp = KafkaProtocol()
+        kp.factory = _Collector()
+        kp.transport = MagicMock()
+        kp.stringReceived = Mock(side_effect=lambda string: (
+            kp.factory.handleResponse(string), kp.pauseProducing()))
+        kp.dataReceived(_frame("one") + _frame("two") + _frame("three")[:5])
+        self.assertEqual(kp.factory.responses, ["one"])
+        kp.dataReceived(_frame("three")[5:] + _frame("four"))
+        self.assertEqual(kp.factory.responses, ["one"])
+        for _ in range(3):
+            kp.resumeProducing()
+        self.assertEqual(kp.factory.responses,
+                         ["one", "two", "three", "four"])
+        kp.resumeProducing()
+        self.assertEqual(kp.factory.responses,
+                         ["one", "two", "three", "four"])
+
+    def test_dataReceived_length_limit(self):
+        kp = KafkaProtocol()
+        kp.factory = MagicMock()
+        kp.MAX_LENGTH = 10
+        kp.lengthLimitExceeded = MagicMock()
+        kp.dataReceived(_frame("x" * 11) + _frame("testing"))
+        kp.lengthLimitExceeded.assert_called_once_with(11)
+        self.assertFalse(kp.factory.handleResponse.called)
+
+    def test_sendSequence(self):
+        kp = KafkaProtocol()
+        kp.transport = MagicMock()
+        kp.sendSequence(["abc", "", "defg"])
+        kp.transport.writeSequence.assert_called_once_with(
+            [struct.pack('>i', 7), "abc", "", "defg"])
+
+    def test_sendSequence_too_long(self):
+        kp = KafkaProtocol()
+        kp.transport = MagicMock()
+        kp.MAX_LENGTH = 255
+        with self.assertRaises(StringTooLongError):
+            kp.sendSequence(["a" * 200, "b" * 56])
+        self.assertFalse(kp.transport.writeSequence.called)
+
+    def test_sendSequence_too_long_for_signed_prefix(self):
+        class Huge(object):
+            """Stands in for a string too long for a signed Int32"""
+            def __len__(self):
+                return 2 ** 31
+
+        kp = KafkaProtocol()
+        kp.transport = MagicMock()
+        with self.assertRaises(StringTooLongError):
+            kp.sendSequence(["abc", Huge()])
+        self.assertFalse(kp.transport.writeSequence.called)
+
     def test_connectionLost_cleanly(self):
         kp = KafkaProtocol()
         logsave = afkak.protocol.log
@@ -62,3 +181,80 @@ class TestProtocol(unittest2.TestCase):
                 kp.MAX_LENGTH)
         finally:
             afkak.protocol.log = logsave
+
+    def test_connectionMade_socket_options(self):
+        kp = KafkaProtocol()
+        kp.socketOptions = {'nodelay': True, 'keepalive': True,
+                            'sndbuf': 65536, 'rcvbuf': 1024 * 1024}
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        kp.transport = MagicMock()
+        kp.transport.getHandle.return_value = sock
+        kp.transport.getTcpNoDelay.return_value = 1
+        kp.transport.getTcpKeepAlive.return_value = 1
+        kp.connectionMade()
+        kp.transport.setTcpNoDelay.assert_called_once_with(True)
+        kp.transport.setTcpKeepAlive.assert_called_once_with(True)
+        applied = kp.appliedSocketOptions
+        self.assertEqual(applied['nodelay'], True)
+        self.assertEqual(applied['keepalive'], True)
+        self.assertEqual(applied['rcvbuf'], sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF))
+        # The kernel may round, but won't give us less than we asked for
+        self.assertGreaterEqual(applied['rcvbuf'], 1024 * 1024)
+        self.assertGreaterEqual(applied['sndbuf'], 65536)
+
+    def test_connectionMade_socket_options_unsupported(self):
+        kp = KafkaProtocol()
+        kp.socketOptions = {'rcvbuf': 1024}
+        kp.transport = Mock(spec=['getPeer'])  # Not a TCP transport
+        with patch.object(afkak.protocol, 'log') as log:
+            kp.connectionMade()
+        self.assertEqual(kp.appliedSocketOptions, {})
+        self.assertEqual(log.warning.call_count, 1)
+
+    def test_connectionMade_no_socket_options(self):
+        kp = KafkaProtocol()
+        kp.transport = MagicMock()
+        kp.connectionMade()
+        self.assertIsNone(kp.appliedSocketOptions)
+        self.assertFalse(kp.transport.setTcpNoDelay.called)
+
+    def test_check_socket_options(self):
+        check_socket_options(None)
+        check_socket_options({'nodelay': False, 'rcvbuf': 4096})
+        for options in ({'linger': 1}, {'rcvbuf': 0}, {'sndbuf': '1k'}):
+            with self.assertRaises(ValueError):
+                check_socket_options(options)
+
+
+class TestProtocolBenchmark(unittest2.TestCase):
+    """Timings for receiving frames. See testutil.benchmark()"""
+
+    @benchmark
+    def test_receive_throughput(self):
+        print("\n{:<12} {:>19} {:>12} {:>7}".format(
+            "frame", "Int32StringReceiver", "KafkaProtocol", "gain"))
+        chunk_size = 64 * 1024  # As Twisted reads from a socket
+        for size in (64 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+                     16 * 1024 * 1024, 64 * 1024 * 1024):
+            data = _frame('\x00' * size)
+            chunks = [data[i:i + chunk_size]
+                      for i in xrange(0, len(data), chunk_size)]
+
+            def receive(cls):
+                proto = cls()
+                proto.MAX_LENGTH = KafkaProtocol.MAX_LENGTH
+                proto.stringReceived = lambda string: None
+                for chunk in chunks:
+                    proto.dataReceived(chunk)
+
+            number = max(1, (4 * 1024 * 1024) // size)
+            repeat = 1 if size > 4 * 1024 * 1024 else 3
+            old = time_per_call(
+                lambda: receive(Int32StringReceiver), number, repeat)
+            new = time_per_call(
+                lambda: receive(KafkaProtocol), number, repeat)
+            print("{:<12} {:>14.1f}MB/s {:>7.1f}MB/s {:>6.2f}x".format(
+                "{}KB".format(size // 1024),
+                size / old / 1e6, size / new / 1e6, old / new))
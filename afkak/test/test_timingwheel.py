@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Cyan, Inc.
+
+from __future__ import division, absolute_import
+
+import unittest2
+
+from mock import Mock, patch
+
+from twisted.internet.base import DelayedCall
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.internet.task import Clock, LoopingCall
+
+import afkak.timingwheel
+from afkak.timingwheel import TimingWheel
+
+from .testutil import benchmark, time_per_call
+
+
+class TestTimingWheel(unittest2.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(tick=0.1, slots=8, reactor=self.clock)
+
+    def test_bad_args(self):
+        with self.assertRaises(ValueError):
+            TimingWheel(tick=0)
+        with self.assertRaises(ValueError):
+            TimingWheel(slots=0)
+
+    def test_callLater(self):
+        f = Mock()
+        call = self.wheel.callLater(0.25, f, 1, b=2)
+        self.assertTrue(call.active())
+        self.assertEqual(call.getTime(), 0.25)
+        # Never early...
+        self.clock.advance(0.2)
+        self.assertFalse(f.called)
+        # ...and at most a tick late
+        self.clock.advance(0.1)
+        f.assert_called_once_with(1, b=2)
+        self.assertFalse(call.active())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_callLater_whole_ticks(self):
+        f = Mock()
+        self.clock.advance(0.3)
+        self.wheel.callLater(0.7, f)
+        self.clock.advance(0.7)
+        f.assert_called_once_with()
+
+    def test_callLater_beyond_one_revolution(self):
+        f = Mock()
+        # The wheel covers 0.8 seconds per revolution
+        self.wheel.callLater(2.05, f)
+        for _ in range(20):
+            self.clock.advance(0.1)
+        self.assertFalse(f.called)
+        self.clock.advance(0.1)
+        f.assert_called_once_with()
+
+    def test_callLater_no_delay(self):
+        f = Mock()
+        call = self.wheel.callLater(0, f)
+        self.assertIsInstance(call, DelayedCall)
+        self.clock.advance(0)
+        f.assert_called_once_with()
+
+    def test_one_reactor_call(self):
+        calls = [self.wheel.callLater(0.1 * i, Mock()) for i in range(1, 50)]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(len(self.wheel.getDelayedCalls()), 49)
+        for call in calls[::2]:
+            call.cancel()
+        self.assertEqual(len(self.wheel.getDelayedCalls()), 24)
+        self.clock.pump([0.1] * 50)
+        self.assertEqual([c.func.call_count for c in calls[1::2]], [1] * 24)
+        self.assertEqual([c.func.call_count for c in calls[::2]], [0] * 25)
+        # Idle, so nothing is left on the reactor
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_reactor_call_earliest_tick(self):
+        """
+        The reactor is called for the earliest tick with calls in it, rather
+        than every tick
+        """
+        f = Mock()
+        self.wheel.callLater(5, f, 1)
+        self.wheel.callLater(2.05, f, 2)
+        [call] = self.clock.getDelayedCalls()
+        self.assertAlmostEqual(call.getTime(), 2.1)
+        # An earlier call brings the reactor call forward
+        self.wheel.callLater(0.3, f, 3)
+        [call] = self.clock.getDelayedCalls()
+        self.assertAlmostEqual(call.getTime(), 0.3)
+        self.clock.advance(0.31)
+        f.assert_called_once_with(3)
+        [call] = self.clock.getDelayedCalls()
+        self.assertAlmostEqual(call.getTime(), 2.1)
+        self.clock.advance(1.8)
+        self.assertEqual(f.call_count, 2)
+        [call] = self.clock.getDelayedCalls()
+        self.assertAlmostEqual(call.getTime(), 5)
+        self.clock.advance(2.9)
+        self.assertEqual(f.call_count, 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_callLater_from_call(self):
+        f = Mock()
+        self.wheel.callLater(0.1, self.wheel.callLater, 1, f, 1)
+        self.wheel.callLater(0.5, f, 2)
+        self.clock.advance(0.11)
+        [call] = self.clock.getDelayedCalls()
+        self.assertAlmostEqual(call.getTime(), 0.5)
+        self.clock.pump([0.1] * 11)
+        self.assertEqual(f.call_args_list, [((2,),), ((1,),)])
+
+    def test_cancel(self):
+        f = Mock()
+        call = self.wheel.callLater(0.5, f)
+        call.cancel()
+        self.assertFalse(call.active())
+        self.assertRaises(AlreadyCancelled, call.cancel)
+        self.clock.advance(1)
+        self.assertFalse(f.called)
+        call = self.wheel.callLater(0.5, f)
+        self.clock.advance(1)
+        self.assertRaises(AlreadyCalled, call.cancel)
+
+    def test_cancel_from_call(self):
+        g = Mock()
+        later = self.wheel.callLater(0.15, g)
+        self.wheel.callLater(0.1, later.cancel)
+        self.clock.advance(0.2)
+        self.assertFalse(g.called)
+
+    def test_order(self):
+        order = []
+        for i in range(10):
+            self.wheel.callLater(0.31 - i * 0.001, order.append, i)
+        self.clock.advance(0.4)
+        self.assertEqual(order, range(10))
+
+    def test_idle(self):
+        f = Mock()
+        self.wheel.callLater(0.1, f)
+        self.clock.advance(0.1)
+        # After a long idle period, calls still run on time
+        self.clock.advance(1000)
+        self.wheel.callLater(0.25, f)
+        self.clock.advance(0.2)
+        self.assertEqual(f.call_count, 1)
+        self.clock.advance(0.1)
+        self.assertEqual(f.call_count, 2)
+
+    def test_reactor_starved(self):
+        f = Mock()
+        self.wheel.callLater(0.1, f, 1)
+        self.wheel.callLater(0.5, f, 2)
+        self.wheel.callLater(5, f, 3)
+        # All the ticks elapsed are run at once
+        self.clock.advance(2)
+        self.assertEqual(f.call_count, 2)
+        self.clock.advance(3)
+        self.assertEqual(f.call_count, 3)
+
+    def test_call_fails(self):
+        f = Mock()
+        self.wheel.callLater(0.1, Mock(side_effect=ValueError()))
+        self.wheel.callLater(0.1, f)
+        with patch.object(afkak.timingwheel, 'log') as log:
+            self.clock.advance(0.1)
+        self.assertEqual(log.exception.call_count, 1)
+        f.assert_called_once_with()
+
+    def test_looping_call(self):
+        f = Mock()
+        looper = LoopingCall(f)
+        looper.clock = self.wheel
+        looper.start(0.5, now=False)
+        self.clock.pump([0.1] * 21)
+        self.assertEqual(f.call_count, 4)
+        looper.stop()
+        self.clock.pump([0.1] * 10)
+        self.assertEqual(f.call_count, 4)
+        self.assertEqual(self.wheel.getDelayedCalls(), [])
+
+
+class TestTimingWheelBenchmark(unittest2.TestCase):
+    """Timings for request timeouts. See testutil.benchmark()"""
+
+    @benchmark
+    def test_schedule_cancel(self):
+        from twisted.internet import reactor
+        wheel = TimingWheel(reactor=reactor)
+
+        # Each request schedules a timeout, which the reactor files in its
+        # heap before the response arrives and cancels it. The delays are
+        # such that none of the calls fire while the benchmark runs.
+        def request(timer):
+            call = timer.callLater(3600, lambda: None)
+            reactor.runUntilCurrent()
+            call.cancel()
+
+        print("\n{:>12} {:>14} {:>14} {:>7}".format(
+            "outstanding", "reactor (us)", "wheel (us)", "gain"))
+        for outstanding in (100, 10000, 50000):
+            backlog = [timer.callLater(3600 + i * 1e-5, lambda: None)
+                       for timer in (reactor, wheel)
+                       for i in xrange(outstanding)]
+            reactor.runUntilCurrent()
+            old = time_per_call(lambda: request(reactor), 2000)
+            new = time_per_call(lambda: request(wheel), 2000)
+            print("{:>12} {:>14.2f} {:>14.2f} {:>6.2f}x".format(
+                outstanding, old * 1e6, new * 1e6, old / new))
+            for call in backlog:
+                if call.active():
+                    call.cancel()
+            reactor.runUntilCurrent()
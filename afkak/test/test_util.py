@@ -43,6 +43,26 @@ class TestUtil(unittest2.TestCase):
         with self.assertRaises(afkak.common.BufferUnderflowError):
             afkak.util.read_int_string('\x00\x00\x00\x021', 2)
 
+    def test_read_int_string_bounds(self):
+        self.assertEqual(
+            afkak.util.read_int_string_bounds('\xff\xff\xff\xff', 0),
+            (4, -1, 4))
+        self.assertEqual(
+            afkak.util.read_int_string_bounds('\x00\x00\x00\x00', 0),
+            (4, 0, 4))
+        self.assertEqual(
+            afkak.util.read_int_string_bounds(
+                'xx\x00\x00\x00\x0bsome string', 2), (6, 11, 17))
+
+    def test_read_int_string_bounds__end(self):
+        data = '\x00\x00\x00\x04abcd\x00\x00\x00\x04efgh'
+        self.assertEqual(
+            afkak.util.read_int_string_bounds(data, 0, 8), (4, 4, 8))
+        with self.assertRaises(afkak.common.BufferUnderflowError):
+            afkak.util.read_int_string_bounds(data, 0, 7)
+        with self.assertRaises(afkak.common.BufferUnderflowError):
+            afkak.util.read_int_string_bounds(data, 8, 10)
+
     def test_write_short_string(self):
         self.assertEqual(
             afkak.util.write_short_string('some string'),
@@ -87,6 +107,19 @@ class TestUtil(unittest2.TestCase):
             ((1, 0), 4)
         )
 
+    def test_relative_unpack__struct(self):
+        self.assertEqual(
+            afkak.util.relative_unpack(
+                struct.Struct('>hh'), '\x00\x01\x00\x00\x02', 1),
+            ((256, 2), 5)
+        )
+
+    def test_get_struct(self):
+        compiled = afkak.util.get_struct('>iqh')
+        self.assertIsInstance(compiled, struct.Struct)
+        self.assertEqual(compiled.format, '>iqh')
+        self.assertIs(afkak.util.get_struct('>iqh'), compiled)
+
     def test_relative_unpack__insufficient_data(self):
         with self.assertRaises(afkak.common.BufferUnderflowError):
             afkak.util.relative_unpack('>hh', '\x00', 0)
@@ -8,6 +8,7 @@ import random
 import socket
 import string
 import time
+import timeit
 import unittest2
 import uuid
 
@@ -26,6 +27,8 @@ __all__ = [
     'get_open_port',
     'make_send_requests',
     'kafka_versions',
+    'benchmark',
+    'time_per_call',
     'KafkaIntegrationTestCase',
 ]
 
@@ -79,6 +82,25 @@ def kafka_versions(*versions):
     return kafka_versions
 
 
+def benchmark(func):
+    """Skip the decorated benchmark unless AFKAK_BENCHMARK is set
+
+    Benchmarks report their timings on stdout, so run them with nose's '-s':
+        AFKAK_BENCHMARK=1 nosetests -s afkak.test.test_kafkacodec
+    """
+    @functools.wraps(func)
+    def wrapper(self):
+        if not os.environ.get('AFKAK_BENCHMARK'):
+            self.skipTest("AFKAK_BENCHMARK not set")  # pragma: no cover
+        return func(self)
+    return wrapper
+
+
+def time_per_call(func, number=1000, repeat=3):
+    """Return the best-of-`repeat` time in seconds for one call of func"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
 @inlineCallbacks
 def ensure_topic_creation(client, topic_name, timeout=5, reactor=None):
     '''
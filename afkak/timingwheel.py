@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Cyan, Inc.
+
+"""TimingWheel class.
+
+A coarse-grained timer service, for the many timeouts and periodic calls
+of a busy client, which schedules only a single call on the reactor.
+"""
+
+from __future__ import absolute_import
+
+import logging
+from math import ceil
+
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Slop when rounding a time to a tick, so that float error in a time which
+# is a whole number of ticks doesn't push it to a neighbouring tick
+_TICK_EPSILON = 1e-9
+
+
+class _WheelCall(object):
+
+    """Private class for a call scheduled on a TimingWheel.
+
+    Quacks like :class:`twisted.internet.base.DelayedCall`.
+    """
+
+    __slots__ = ('wheel', 'time', 'tick', 'seq', 'func', 'args', 'kw',
+                 'cancelled', 'called')
+
+    def __init__(self, wheel, time, tick, seq, func, args, kw):
+        self.wheel = wheel
+        self.time = time
+        self.tick = tick
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.cancelled = self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+
+    def __repr__(self):
+        return '<_WheelCall {} at {} {}>'.format(
+            self.seq, self.time,
+            'active' if self.active() else
+            'cancelled' if self.cancelled else 'called')
+
+
+class TimingWheel(object):
+
+    """Schedule calls on a hashed timing wheel, rather than the reactor.
+
+    Every :meth:`callLater` on the reactor adds to its heap of delayed
+    calls, and each cancel re-sorts it. A client making tens of thousands of
+    requests a second, each with a timeout, churns that heap. A
+    TimingWheel instead keeps its calls in a ring of `slots` sets, each
+    covering `tick` seconds, so that scheduling and cancelling a call is
+    O(1). It schedules just one reactor call, for the earliest tick with
+    calls in it, and only while it has calls pending, so long timeouts
+    don't wake the reactor every tick.
+
+    Calls run up to one tick late, never early, so the tick should be small
+    compared to the delays scheduled.  Calls with no delay are passed
+    straight to the reactor.
+
+    A TimingWheel provides the ``callLater()`` and ``seconds()`` of
+    :class:`twisted.internet.interfaces.IReactorTime`, so it can be used as
+    the clock of a :class:`twisted.internet.task.LoopingCall`. Pass one to
+    :class:`afkak.KafkaClient` as `timing_wheel` to run request timeouts on
+    it, and the :class:`afkak.Producer` and :class:`afkak.Consumer` objects
+    using that client run their periodic and retry calls on it too.
+    """
+
+    DEFAULT_TICK = 0.1  # Seconds
+    DEFAULT_SLOTS = 512
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, reactor=None):
+        if tick <= 0:
+            raise ValueError("tick: %r unsupported" % (tick,))
+        if slots < 1:
+            raise ValueError("slots: %r unsupported" % (slots,))
+        self.tick = tick
+        self.clock = reactor
+        self._slots = [set() for _ in xrange(slots)]
+        self._origin = None  # Reactor time of tick 0
+        self._next_tick = 0  # The next tick to be run
+        self._count = 0  # Number of pending calls
+        self._seq = 0  # For running the calls of a tick in the order made
+        self._call = None  # Reactor call to run the earliest pending tick
+        self._call_tick = None  # The tick for which _call is scheduled
+        self._advancing = False  # Running calls, to schedule once done
+
+    def __repr__(self):
+        return '<TimingWheel tick={} slots={} pending={}>'.format(
+            self.tick, len(self._slots), self._count)
+
+    def seconds(self):
+        return self._get_clock().seconds()
+
+    def callLater(self, delay, func, *args, **kw):
+        """Call func(*args, **kw) in `delay` seconds, within one tick
+
+        Returns an object which can be cancelled, as a DelayedCall.
+        """
+        clock = self._get_clock()
+        if delay <= 0:
+            return clock.callLater(0, func, *args, **kw)
+        now = clock.seconds()
+        if self._origin is None:
+            self._origin = now
+        if not self._count:
+            # Idle, so skip straight past the ticks that have elapsed
+            self._next_tick = max(self._next_tick, self._tick_at(now) + 1)
+        tick = max(self._tick_at(now + delay, ceil), self._next_tick)
+        self._seq += 1
+        call = _WheelCall(self, now + delay, tick, self._seq, func, args, kw)
+        self._slots[tick % len(self._slots)].add(call)
+        self._count += 1
+        if not self._advancing and (
+                self._call is None or tick < self._call_tick):
+            self._schedule(now, tick)
+        return call
+
+    def getDelayedCalls(self):
+        return [call for slot in self._slots for call in slot]
+
+    # # Private Methods # #
+
+    def _get_clock(self):
+        """Reactor to use for callLater, etc [for testing]."""
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        return self.clock
+
+    def _tick_at(self, time, rounding=None):
+        """The tick at or after (rounding=ceil) or before a reactor time"""
+        ticks = (time - self._origin) / self.tick
+        if rounding is ceil:
+            return int(ceil(ticks - _TICK_EPSILON))
+        return int(ticks + _TICK_EPSILON)
+
+    def _remove(self, call):
+        # The reactor call for the next tick is left to find nothing to do,
+        # rather than cancelled, sparing the reactor the churn
+        self._slots[call.tick % len(self._slots)].discard(call)
+        self._count -= 1
+
+    def _earliest_tick(self):
+        """The earliest tick with calls in it, of those pending"""
+        slots = self._slots
+        earliest = None
+        for tick in xrange(self._next_tick, self._next_tick + len(slots)):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            # The slot may hold only calls for later revolutions
+            first = min(call.tick for call in slot)
+            if first == tick:
+                return tick
+            if earliest is None or first < earliest:
+                earliest = first
+        return earliest
+
+    def _schedule(self, now, tick):
+        """Make the reactor run the given tick, rather than any later one"""
+        if self._call is not None:
+            self._call.cancel()
+        when = self._origin + tick * self.tick
+        self._call = self._get_clock().callLater(
+            max(0, when - now), self._advance)
+        self._call_tick = tick
+
+    def _advance(self):
+        """Run the calls due in all the ticks which have now elapsed"""
+        # The ticks before the one we were scheduled for had no calls
+        self._next_tick = max(self._next_tick, self._call_tick)
+        self._call = self._call_tick = None
+        now = self._get_clock().seconds()
+        last_tick = self._tick_at(now)
+        self._advancing = True
+        while self._count and self._next_tick <= last_tick:
+            tick = self._next_tick
+            self._next_tick += 1
+            slot = self._slots[tick % len(self._slots)]
+            due = [call for call in slot if call.tick <= tick]
+            if not due:
+                continue
+            due.sort(key=lambda call: call.seq)
+            for call in due:
+                # An earlier call may have cancelled this one
+                if call.cancelled:
+                    continue
+                slot.discard(call)
+                self._count -= 1
+                call.called = True
+                try:
+                    call.func(*call.args, **call.kw)
+                except Exception:
+                    log.exception('%r: call %r failed', self, call)
+        self._advancing = False
+        if not self._count:
+            self._next_tick = max(self._next_tick, last_tick + 1)
+        else:
+            self._schedule(now, self._earliest_tick())
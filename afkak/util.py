@@ -7,29 +7,80 @@ import sys
 
 from .common import BufferUnderflowError
 
+# Compiled struct.Struct objects, keyed by format string. See get_struct()
+_structs = {}
+
+
+def get_struct(fmt):
+    """Return a compiled :class:`struct.Struct` for the format string `fmt`
+
+    Compiled structs are cached, so repeated calls with the same format are
+    just a dict lookup, rather than a parse of the format string.
+    """
+    try:
+        return _structs[fmt]
+    except KeyError:
+        compiled = _structs[fmt] = struct.Struct(fmt)
+        return compiled
+
+
+INT16 = get_struct('>h')
+INT32 = get_struct('>i')
+INT64 = get_struct('>q')
+
 
 def write_int_string(s):
     if s is None:
-        return struct.pack('>i', -1)
+        return INT32.pack(-1)
     else:
-        return struct.pack('>i%ds' % len(s), len(s), s)
+        return INT32.pack(len(s)) + s
 
 
 def write_short_string(s):
     if s is None:
-        return struct.pack('>h', -1)
+        return INT16.pack(-1)
     elif len(s) > 32767 and sys.version < (2, 7):
         # Python 2.6 issues a deprecation warning instead of a struct error
         raise struct.error(len(s))
     else:
-        return struct.pack('>h%ds' % len(s), len(s), s)
+        return INT16.pack(len(s)) + s
+
+
+def short_string_size(s):
+    """Return the encoded size of s as an int16 length-prefixed string"""
+    return INT16.size if s is None else INT16.size + len(s)
+
+
+def int_string_size(s):
+    """Return the encoded size of s as an int32 length-prefixed string"""
+    return INT32.size if s is None else INT32.size + len(s)
+
+
+def write_short_string_into(buf, cur, s):
+    """Write s into the bytearray buf at cur, return the offset past it"""
+    if s is None:
+        return relative_pack(INT16, buf, cur, -1)
+    cur = relative_pack(INT16, buf, cur, len(s))
+    end = cur + len(s)
+    buf[cur:end] = s
+    return end
+
+
+def write_int_string_into(buf, cur, s):
+    """Write s into the bytearray buf at cur, return the offset past it"""
+    if s is None:
+        return relative_pack(INT32, buf, cur, -1)
+    cur = relative_pack(INT32, buf, cur, len(s))
+    end = cur + len(s)
+    buf[cur:end] = s
+    return end
 
 
 def read_short_string(data, cur):
     if len(data) < cur + 2:
         raise BufferUnderflowError("Not enough data left")
 
-    (strlen,) = struct.unpack('>h', data[cur:cur + 2])
+    (strlen,) = INT16.unpack_from(data, cur)
     if strlen == -1:
         return None, cur + 2
 
@@ -47,7 +98,7 @@ def read_int_string(data, cur):
             "Not enough data left to read string len (%d < %d)" %
             (len(data), cur + 4))
 
-    (strlen,) = struct.unpack('>i', data[cur:cur + 4])
+    (strlen,) = INT32.unpack_from(data, cur)
     if strlen == -1:
         return None, cur + 4
 
@@ -59,15 +110,57 @@ def read_int_string(data, cur):
     return out, cur + strlen
 
 
+def read_int_string_bounds(data, cur, end=None):
+    """Locate an int32 length-prefixed string without copying it
+
+    Returns a (start, length, next_cur) tuple describing where the string
+    lives within `data`. A null string is reported with a length of -1.
+    `end` bounds the readable region of `data`, defaulting to its length.
+    """
+    if end is None:
+        end = len(data)
+    if end < cur + 4:
+        raise BufferUnderflowError(
+            "Not enough data left to read string len (%d < %d)" %
+            (end, cur + 4))
+
+    (strlen,) = INT32.unpack_from(data, cur)
+    cur += 4
+    if strlen == -1:
+        return cur, -1, cur
+
+    if strlen < 0 or end < cur + strlen:
+        raise BufferUnderflowError("Not enough data left")
+
+    return cur, strlen, cur + strlen
+
+
 def relative_unpack(fmt, data, cur):
-    size = struct.calcsize(fmt)
+    """Unpack `fmt` from `data` at offset `cur`
+
+    `fmt` may be a format string, or a precompiled :class:`struct.Struct`.
+    Returns a tuple of the unpacked values and the offset past them.
+    """
+    if not isinstance(fmt, struct.Struct):
+        fmt = get_struct(fmt)
+    size = fmt.size
     if len(data) < cur + size:
         raise BufferUnderflowError("Not enough data left")
 
-    out = struct.unpack(fmt, data[cur:cur + size])
+    out = fmt.unpack_from(data, cur)
     return out, cur + size
 
 
+def relative_pack(fmt, buf, cur, *args):
+    """Pack args into the bytearray buf at offset cur
+
+    `fmt` is a precompiled :class:`struct.Struct`. Returns the offset just
+    past the packed values.
+    """
+    fmt.pack_into(buf, cur, *args)
+    return cur + fmt.size
+
+
 def group_by_topic_and_partition(tuples):
     out = collections.defaultdict(dict)
     for t in tuples:
@@ -11,6 +11,7 @@ setup(
     install_requires=['Twisted>=13.2.0'],
     extras_require={
         'FastMurmur2': ['Murmur>=0.1.3'],
+        'LZ4': ['lz4>=2.0.0', 'xxhash>=1.0.0'],
     },
 
     packages=find_packages(),
@@ -39,8 +40,8 @@ setup(
     long_description="""
 This module provides low-level protocol support for Apache Kafka as well as
 high-level consumer and producer classes. Request batching is supported by the
-protocol as well as broker-aware request routing. Gzip and Snappy compression
-is also supported for message sets.
+protocol as well as broker-aware request routing. Gzip, Snappy and LZ4
+compression is also supported for message sets.
 """,
     keywords=['Kafka client', 'distributed messaging', 'txkafka']
 )